@@ -0,0 +1,67 @@
+"""
+Benchmark of network parsing against the code it replaced.
+Lines: the regex with_netmask() that loading ran per line
+against strict pack() and batch pack_many().
+Rows: with_netmask() of `inet` values as asyncpg decodes them,
+which the export diff ran per row, against pack_inet().
+
+    make bench
+"""
+import ipaddress
+import random
+import timeit
+
+from vroute.packed import pack, pack_inet, pack_many
+from vroute.util import with_netmask
+
+
+def sample(count: int, prefixes: bool) -> list:
+    rnd = random.Random(0)
+    result = []
+    for _ in range(count):
+        addr = ".".join(str(rnd.randrange(256)) for _ in range(3))
+        if prefixes:
+            result.append(f"{addr}.0/{rnd.choice((16, 22, 24, 32))}")
+        else:
+            result.append(f"{addr}.{rnd.randrange(256)}")
+    return result
+
+
+def as_inet(network: str):
+    # asyncpg returns an address if the prefix is full
+    value = ipaddress.ip_interface(network)
+    return value.ip if value.network.prefixlen == value.max_prefixlen else value
+
+
+def best(func, repeat: int = 5) -> float:
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main(count: int = 100000):
+    samples = (
+        ("addresses", sample(count, prefixes=False)),
+        ("networks", sample(count, prefixes=True)),
+        ("mixed", sample(count // 2, prefixes=False) + sample(count // 2, prefixes=True)),
+    )
+    print("lines:")
+    for name, lines in samples:
+        old = best(lambda: [with_netmask(x) for x in lines])
+        single = best(lambda: [pack(x) for x in lines])
+        batch = best(lambda: pack_many(lines))
+        print(
+            f"{name:>10}: regex {old * 1e9 / count:6.0f} ns, pack {single * 1e9 / count:6.0f} ns,"
+            f" pack_many {batch * 1e9 / count:6.0f} ns per network ({old / batch:.1f}x)"
+        )
+    print("rows:")
+    for name, lines in samples:
+        rows = [as_inet(x) for x in lines]
+        old = best(lambda: [with_netmask(x) for x in rows])
+        new = best(lambda: [pack_inet(x) for x in rows])
+        print(
+            f"{name:>10}: regex {old * 1e9 / count:6.0f} ns,"
+            f" pack_inet {new * 1e9 / count:6.0f} ns per network ({old / new:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,71 +1,71 @@
-from copy import deepcopy
-from pathlib import Path
-import logging
+import os
 
 import pytest
-from vroute import web
-from vroute import console, VRoute, db, cfg
+from vroute import VRoute, cfg, routing, web
+from vroute.lock import FileLock
+from vroute.services import NetworkingService
 
-from . import Helpers, mock_network, mock_interface
-
-config_template = Path(__file__).parent.parent / "config-template.yml"
-
-
-def pytest_addoption(parser):
-    parser.addoption("--log-sql", action="store_true", help="Enable SQL logging")
-
-
-CONFIG = dict(
-    vpn=dict(table_id=10, rule={"priority": 40}, route_to={"interface": "tun0"}),
-    routeros=dict(addr="127.0.0.1", username="admin", password="", list_name="vpn"),
-)
+from . import MemoryManager
 
 
 @pytest.fixture()
-def config():
+def config(tmp_path):
     config = cfg.Configuration()
-    config.file = deepcopy(CONFIG)
+    config.file = dict(
+        db=dict(file=str(tmp_path / "db.sqlite3")),
+        lock_file=str(tmp_path / "lock"),
+        sync=dict(journal_dir=str(tmp_path / "journal"), interval=0),
+        devices=[dict(name="gateway", type="memory"), dict(name="router", type="memory")],
+    )
     return config
 
 
-@pytest.yield_fixture(autouse=True)
-def vrouteobj(pytestconfig, config, mocker):
+@pytest.fixture(autouse=True)
+def devices(monkeypatch):
+    """ Networks of memory devices by their names. """
+    monkeypatch.setitem(routing.MANAGERS, MemoryManager.name, MemoryManager)
+    monkeypatch.setattr(MemoryManager, "devices", {})
+    # threads of timed out devices may outlive the test
+    monkeypatch.setattr(MemoryManager, "active", set())
+    monkeypatch.setattr(MemoryManager, "max_active", 0)
+    return MemoryManager.devices
+
+
+@pytest.fixture()
+def vrouteobj(config):
     vrobj = VRoute()
     vrobj.cfg = config
-    if pytestconfig.getoption("--log-sql"):
-        sql_log = logging.getLogger("sqlalchemy")
-        sql_log.setLevel(logging.INFO)
-    vrobj.load_db(":memory:")
-    console.get_vroute = lambda: vrobj
-    mock_network(mocker.patch)
-    mock_interface(mocker.patch)
+    vrobj.lock = FileLock(config.lock_file)
     vrobj.connect()
     yield vrobj
     vrobj.disconnect()
 
 
-@pytest.fixture(autouse=True)
-def wipe_database(vrouteobj):
-    engine = vrouteobj.db.engine
-    db.Base.metadata.drop_all(bind=engine)
-    db.Base.metadata.create_all(bind=engine)
-
-
-@pytest.fixture
-def session(vrouteobj):
-    return vrouteobj.db.new_session()
+@pytest.fixture()
+def service(vrouteobj):
+    return vrouteobj.network_service
 
 
-@pytest.fixture
-def helpers(mocker, vrouteobj, session, loop, aiohttp_client):
-    webapp = web.get_webapp(app=vrouteobj)
-    return Helpers(
-        mocker,
-        session=session,
-        requests=loop.run_until_complete(aiohttp_client(webapp)),
-    )
+@pytest.fixture()
+async def client(vrouteobj, aiohttp_client):
+    return await aiohttp_client(web.get_webapp(app=vrouteobj))
 
 
-@pytest.fixture
-def query(session):
-    return session.query
+@pytest.fixture()
+async def pg_service():
+    """
+    Service of the PostgreSQL database in VROUTE_TEST_POSTGRES
+    (`host=... user=... database=...`), with tables emptied.
+    """
+    dsn = os.getenv("VROUTE_TEST_POSTGRES")
+    if not dsn:
+        pytest.skip("VROUTE_TEST_POSTGRES is not set")
+    service = NetworkingService({"password": "", **dict(x.split("=", 1) for x in dsn.split())})
+    async with service.connection() as conn:
+        await conn.execute(
+            "DROP TABLE IF EXISTS source_networks, sources;"
+            "CREATE TABLE IF NOT EXISTS networks (net inet PRIMARY KEY);"
+            "TRUNCATE networks;"
+        )
+    yield service
+    await service.close()
@@ -1,74 +1,147 @@
-from vroute.routing import RouteManager, RouterosManager
-from vroute.models import Address
-
-
-async def test_sync_initial(helpers):
-    helpers.add_host("example.com", "1.2.3.4")
-    helpers.mock_rule(exists=False)
-    helpers.mock_interface()
-    # no routes exist
-    helpers.mock_routes()
-    helpers.mock_ros_routes()
-    await helpers.post("/sync")
-    mgr = RouteManager
-    mgr.get_rules.assert_called_once_with(table=10)
-    mgr.rule.assert_called_once_with("add", priority=40, table=10)
-    mgr.get_routes.assert_called_once_with(table=10)
-    mgr.route.assert_called_once_with("add", dst="1.2.3.4/32", oif=7, table=10)
-    mgr = RouterosManager
-    mgr.get_raw_routes.assert_called_once_with()
-    mgr._add_network.assert_called_once_with({"address": "1.2.3.4/32", "list": "vpn"})
-
-
-async def test_sync_append(helpers):
-    helpers.add_host("example.com", "1.2.3.4")
-    helpers.add_host("example.org", "1.2.3.5")
-    helpers.mock_rule(exists=True)
-    helpers.mock_interface()
-    helpers.mock_routes("1.2.3.4")
-    helpers.mock_ros_routes("1.2.3.4")
-    await helpers.post("/sync")
-    assert not RouteManager.rule.called
-    RouteManager.route.assert_called_once_with("add", dst="1.2.3.5/32", oif=7, table=10)
-    RouterosManager._add_network.assert_called_once_with(
-        {"address": "1.2.3.5/32", "list": "vpn"}
-    )
-
-
-async def test_sync_none(helpers):
-    helpers.add_host("example.com", "1.2.3.4")
-    helpers.mock_rule(exists=True)
-    helpers.mock_interface()
-    helpers.mock_routes("1.2.3.4")
-    helpers.mock_ros_routes("1.2.3.4")
-    await helpers.post("/sync")
-    assert not RouteManager.route.called
-    assert not RouterosManager._add_network.called
-
-
-async def test_sync_address(helpers, session):
-    helpers.mock_rule()
-    helpers.mock_interface()
-    helpers.mock_routes()
-    helpers.mock_ros_routes()
-    # noinspection PyArgumentList
-    session.add(Address(value="1.2.128.0/17"))
-    session.commit()
-    await helpers.post("/sync")
-    RouteManager.route.assert_called_once_with(
-        "add", dst="1.2.128.0/17", oif=7, table=10
-    )
-    RouterosManager._add_network.assert_called_once_with(
-        {"address": "1.2.128.0/17", "list": "vpn"}
-    )
-
-
-async def test_purge(helpers):
-    # helpers.add_host("example.com", "1.2.3.4")
-    helpers.mock_rule()
-    helpers.mock_interface()
-    helpers.mock_routes("1.2.3.4")
-    helpers.mock_ros_routes("1.2.3.4")
-    await helpers.post("/purge")
-    RouteManager.route.assert_called_once_with("del", dst="1.2.3.4/32", oif=7, table=10)
-    RouterosManager._rm_route.assert_called_once_with("*1")
+import pytest
+from vroute import packed
+from vroute.journal import ADD, REMOVE, Journal
+from vroute.routing import MANAGERS, ThreadedBatchManager
+from vroute.sync import Syncer
+
+from . import MemoryManager
+
+
+class BatchMemoryManager(MemoryManager, ThreadedBatchManager):
+    """ Memory device applying whole batches, like the native bulk paths. """
+
+    name = "memory-batch"
+    batches: list = []
+
+    def apply_batch(self, adds, removes):
+        self.batches.append(([packed.unpack(x) for x in adds], len(removes)))
+        for key in removes:
+            self.remove(packed.unpack(key))
+        for key in adds:
+            self.add(packed.unpack(key))
+        return len(adds), len(removes)
+
+
+async def test_sync_initial(client, service, devices):
+    await service.load_networks(["1.2.3.4"])
+    resp = await client.post("/sync")
+    stats = await resp.json()
+    assert devices == {"gateway": {"1.2.3.4/32"}, "router": {"1.2.3.4/32"}}
+    assert stats["gateway"]["added"] == stats["router"]["added"] == 1
+
+
+async def test_sync_append(client, service, devices):
+    await service.load_networks(["1.2.3.4", "1.2.3.5"])
+    devices.update(gateway={"1.2.3.4/32"}, router={"1.2.3.4/32"})
+    stats = await (await client.post("/sync")).json()
+    assert devices["gateway"] == devices["router"] == {"1.2.3.4/32", "1.2.3.5/32"}
+    assert stats["gateway"]["added"] == stats["router"]["added"] == 1
+
+
+async def test_sync_none(client, service, devices):
+    await service.load_networks(["1.2.3.4"])
+    devices.update(gateway={"1.2.3.4/32"}, router={"1.2.3.4/32"})
+    stats = await (await client.post("/sync")).json()
+    assert stats["gateway"]["added"] == stats["router"]["added"] == 0
+
+
+async def test_sync_address(client, service, devices):
+    await service.load_networks(["1.2.128.0/17"])
+    await client.post("/sync")
+    assert devices["gateway"] == devices["router"] == {"1.2.128.0/17"}
+
+
+async def test_prune(client, config, service, devices):
+    await service.load_networks(["1.2.3.4"])
+    devices.update(gateway={"1.2.3.4/32", "1.2.3.5/32"})
+    # outdated networks are kept unless pruning is enabled
+    await client.post("/sync")
+    assert devices["gateway"] == {"1.2.3.4/32", "1.2.3.5/32"}
+    config.file["sync"]["prune"] = True
+    stats = await (await client.post("/sync")).json()
+    assert devices["gateway"] == {"1.2.3.4/32"}
+    assert stats["gateway"]["removed"] == 1
+
+
+async def test_sync_isolation(config, service, devices):
+    config.file["devices"] = [
+        dict(name="gateway", type="memory"),
+        dict(name="slow", type="memory", delay=0.5, timeout=0.1),
+        dict(name="broken", type="memory", fail=True),
+    ]
+    await service.load_networks(["1.2.3.4"])
+    results = {x.device: x for x in await Syncer.fromconf(config, service).run()}
+    # failed and timed out devices don't affect others
+    assert results["gateway"].ok
+    assert devices["gateway"] == {"1.2.3.4/32"}
+    assert results["slow"].error == "timed out after 0.1 seconds"
+    assert results["broken"].error == "broken is unreachable"
+    assert results["slow"].elapsed < 0.5
+
+
+async def test_sync_workers(config, service, devices):
+    config.file["devices"] = [dict(name=f"dev{i}", type="memory", delay=0.05) for i in range(6)]
+    config.file["sync"]["workers"] = 2
+    await service.load_networks(["1.2.3.4"])
+    results = await Syncer.fromconf(config, service).run()
+    assert all(x.ok for x in results)
+    assert all(devices[f"dev{i}"] == {"1.2.3.4/32"} for i in range(6))
+    assert MemoryManager.max_active == 2
+
+
+@pytest.mark.parametrize("strategy", ["server", "merge"])
+async def test_sync_strategies(config, service, devices, caplog, strategy):
+    config.file["devices"] = [
+        dict(name="gateway", type="memory"),
+        dict(name="broken", type="memory", fail=True),
+    ]
+    config.file["sync"].update(diff=strategy, prune=True)
+    await service.load_networks(["1.2.3.4"])
+    devices["gateway"] = {"8.8.8.8/32"}
+    results = {x.device: x for x in await Syncer.fromconf(config, service).run()}
+    # storage diffs are fanned out with failures isolated, too
+    assert (results["gateway"].added, results["gateway"].removed) == (1, 1)
+    assert devices["gateway"] == {"1.2.3.4/32"}
+    assert results["broken"].error == "broken is unreachable"
+    assert "diff isn't used" not in caplog.text
+    # networks of route sets are always compared here
+    await service.load_networks(["5.5.5.5"], "office", "office")
+    (result, _) = await Syncer.fromconf(config, service).run()
+    assert result.ok and devices["gateway"] == {"1.2.3.4/32"}
+    assert f"{strategy.capitalize()} diff isn't used for gateway" in caplog.text
+
+
+async def test_sync_batches(config, service, devices, monkeypatch, tmp_path):
+    monkeypatch.setitem(MANAGERS, BatchMemoryManager.name, BatchMemoryManager)
+    monkeypatch.setattr(BatchMemoryManager, "batches", [])
+    confirmed = []
+    monkeypatch.setattr(Journal, "confirm", lambda self, op, done: confirmed.append((op, done)))
+    config.file["devices"] = [dict(name="gateway", type="memory-batch")]
+    config.file["sync"].update(batch_size=2, prune=True)
+    await service.load_networks([f"10.0.0.{i}" for i in range(5)])
+    devices["gateway"] = {"10.0.0.0/32", "8.8.8.8/32"}
+    (result,) = await Syncer.fromconf(config, service).run()
+    assert (result.added, result.removed) == (4, 1)
+    # journal batches are applied by the batch protocol of the manager
+    assert BatchMemoryManager.batches == [
+        (["10.0.0.1/32", "10.0.0.2/32"], 0), (["10.0.0.3/32", "10.0.0.4/32"], 0), ([], 1)
+    ]
+    assert confirmed == [(ADD, 2), (ADD, 4), (REMOVE, 1)]
+    assert devices["gateway"] == {f"10.0.0.{i}/32" for i in range(5)}
+
+
+async def test_sync_resume(config, service, devices):
+    journal = Journal(config.journal_dir / "gateway.journal")
+    # interrupted run planned to add two networks and added one of them
+    to_add = packed.Networks.fromkeys(map(packed.pack, ["10.0.0.1", "10.0.0.2"]))
+    journal.begin(to_add, packed.Networks())
+    journal.confirm(ADD, 1)
+    journal.close()
+    devices["gateway"] = {"10.0.0.1/32"}
+    await service.load_networks(["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+    results = {x.device: x for x in await Syncer.fromconf(config, service).run()}
+    assert results["gateway"].resumed
+    # networks desired since the interrupted run are added too
+    assert devices["gateway"] == {"10.0.0.1/32", "10.0.0.2/32", "10.0.0.3/32"}
+    assert results["gateway"].added == 2
+    assert not journal.path.exists()
@@ -1,12 +1,36 @@
-from datetime import timedelta, datetime
+import asyncio
+import bz2
+import io
+import ipaddress
+import json
+import logging
+import socket
+import socketserver
+import struct
+import threading
+import types
 
 import pytest
-import toml
 from vroute import __version__, models
-from vroute.routing import RouteManager, RouterosManager
-from vroute.db import Host, Address
+from vroute.routing import BatchManager, BirdManager, Manager, RouterosManager, as_batch
 from vroute.cfg import Configuration
 from vroute.util import WindowIterator, with_netmask, chunked
+from vroute import packed
+from vroute.throttle import AIMDController
+from vroute import journal
+from vroute.lock import Coalescer, FileLock, LockedError
+from vroute.mirror import RouteMirror
+from vroute.replay import RouteCache
+from vroute.extsort import sort_entries
+from vroute.local import LocalNetworkingService
+from vroute.services import DIFF_STRATEGIES, pipeline
+from vroute.buckets import Buckets, compare
+from vroute.bird import BirdControl, BirdError
+from vroute.aggregate import Aggregator
+from vroute import mrt
+from vroute import dnsproxy
+
+from . import MemoryManager
 
 # # # # # # #
 # utilities #
@@ -40,7 +64,787 @@ def test_chunked():
 
 
 
+def test_packed():
+    key = packed.pack("1.2.3.0/24")
+    assert packed.unpack(key) == "1.2.3.0/24"
+    assert packed.pack("1.2.3.4") == packed.pack("1.2.3.4/32")
+    assert packed.pack("1.2.3.0/24") < packed.pack("1.2.3.0/25")
+    to_add, to_remove = packed.diff([1, 2, 3], [3, 4])
+    assert list(to_add) == [1, 2] and list(to_remove) == [4]
+
+
+def test_pack_strict():
+    # host bits are masked
+    assert packed.pack("1.2.3.4/24") == packed.pack("1.2.3.0/24")
+    assert packed.unpack(packed.pack("2001:db8::1/32")) == "2001:db8::/32"
+    for network in ["999.1.1", "1.2.3", "1.2.3.4/99", "1.2.3.4/024", "1.2.3.4/", "::/129", ""]:
+        with pytest.raises(packed.NetworkError):
+            packed.pack(network)
+    networks = ["10.0.0.1", "1.2.3.4/24", "0.0.0.0/0"]
+    assert packed.pack_many(networks) == [packed.pack(x) for x in networks]
+    assert packed.pack_many(networks[1:]) == [packed.pack(x) for x in networks[1:]]
+    assert packed.pack_many(["::1", "1.2.3.4/8"]) == [packed.pack("::1"), packed.pack("1.0.0.0/8")]
+    # lines can't shift each other
+    with pytest.raises(packed.NetworkError) as exc:
+        packed.pack_many(["1.1.1.1/24/2.2.2.2", "3"])
+    assert exc.value.lineno == 1
+    with pytest.raises(packed.NetworkError, match="on line 2: invalid address"):
+        packed.pack_many(["1.1.1.1", "256.1.1.1"])
+
+
+def test_pack_inet():
+    # asyncpg decodes inet as an interface, or an address if the prefix is full
+    for value, network in [
+        (ipaddress.ip_interface("1.2.3.4/24"), "1.2.3.0/24"),
+        (ipaddress.ip_address("1.2.3.4"), "1.2.3.4/32"),
+        (ipaddress.ip_interface("2001:db8::1/32"), "2001:db8::/32"),
+        (ipaddress.ip_address("2001:db8::1"), "2001:db8::1/128"),
+    ]:
+        assert packed.pack_inet(value) == packed.pack(network)
+
+
+def test_packed_v6():
+    key = packed.pack("2001:db8::/32")
+    assert packed.is_v6(key)
+    assert packed.unpack(key) == "2001:db8::/32"
+    assert packed.pack("::1") == packed.pack("::1/128")
+    nets = packed.Networks.fromkeys(
+        packed.pack(x) for x in ["2001:db8::/32", "10.0.0.0/8", "::/0", "10.0.0.0/8"]
+    )
+    assert len(nets) == 3
+    assert [packed.unpack(x) for x in nets] == ["10.0.0.0/8", "::/0", "2001:db8::/32"]
+    assert key in nets
+    assert packed.pack("2001:db8::/33") not in nets
+    assert [packed.unpack(x) for x in nets[1:]] == ["::/0", "2001:db8::/32"]
+    # IPv6 network takes 17 bytes
+    assert nets.nbytes == 8 + 2 * 17
+    to_add, to_remove = nets.diff(packed.Networks.fromkeys([key, packed.pack("::2")]))
+    assert [packed.unpack(x) for x in to_add] == ["10.0.0.0/8", "::/0"]
+    assert [packed.unpack(x) for x in to_remove] == ["::2/128"]
+
+
+def test_copy_decoder():
+    def row(addr, bits):
+        return packed.ROW_HEADER.pack(1, 8, 2, bits, 0, 4) + bytes(addr)
+
+    data = (
+        packed.PGCOPY_HEADER.pack(packed.PGCOPY_SIGNATURE, 0, 0)
+        + row([1, 2, 3, 0], 24) * 3
+        + row([10, 0, 0, 1], 32)
+        + b"\xff\xff"
+    )
+    decoder = packed.InetCopyDecoder()
+    result = []
+    # split stream in the middle of rows
+    for i in range(0, len(data), 5):
+        result.extend(decoder.feed(data[i : i + 5]))
+    assert decoder.finished
+    assert [packed.unpack(x) for x in result] == ["1.2.3.0/24"] * 3 + ["10.0.0.1/32"]
+
+
+def test_copy_decoder_v6():
+    data = (
+        packed.PGCOPY_HEADER.pack(packed.PGCOPY_SIGNATURE, 0, 0)
+        + packed.ROW_HEADER.pack(1, 20, 3, 32, 0, 16)
+        + bytes([0x20, 0x01, 0x0D, 0xB8] + [0] * 12)
+        + packed.ROW_HEADER.pack(1, 8, 2, 8, 0, 4)
+        + bytes([10, 0, 0, 0])
+        + b"\xff\xff"
+    )
+    result = packed.InetCopyDecoder().feed(data)
+    assert [packed.unpack(x) for x in result] == ["10.0.0.0/8", "2001:db8::/32"]
+
+
+def test_copy_decoder_groups():
+    null = b"\x00\x01\xff\xff\xff\xff"
+    data = (
+        packed.PGCOPY_HEADER.pack(packed.PGCOPY_SIGNATURE, 0, 0)
+        + packed.ROW_HEADER.pack(1, 8, 2, 8, 0, 4)
+        + bytes([10, 0, 0, 0])
+        + null
+        + null
+        + packed.ROW_HEADER.pack(1, 8, 2, 16, 0, 4)
+        + bytes([10, 1, 0, 0])
+        + b"\xff\xff"
+    )
+    decoder = packed.InetCopyDecoder()
+    groups = [list(decoder.feed(data))]
+    while decoder.group_ended:
+        groups.append(list(decoder.feed(b"")))
+    assert decoder.finished
+    assert groups == [[packed.pack("10.0.0.0/8")], [], [packed.pack("10.1.0.0/16")]]
+
+
+def test_sort_entries():
+    entries = [(packed.pack(f"10.{i % 7}.{i % 251}.0/24"), str(i)) for i in range(1000)]
+    entries.append((packed.pack("2001:db8::/32"), ""))
+    # spilled into runs and merged
+    assert list(sort_entries(entries, buffer_size=64)) == sorted(entries)
+    assert list(sort_entries(entries)) == sorted(entries)
+
+
+def test_aimd():
+    ctl = AIMDController(initial_rate=10, min_rate=1, target_latency=0.1)
+    for _ in range(10):
+        ctl.observe(0.01)
+    assert ctl.rate > 10
+    assert ctl.in_flight > 1
+    rate, window = ctl.rate, ctl.window
+    ctl.observe(0.01, timeout=True)
+    assert ctl.rate == rate / 2
+    assert ctl.window == max(window / 2, 1)
+    # errors of the same window don't decrease it again
+    ctl.observe(0.01, error=True)
+    assert ctl.rate == rate / 2
+    ctl.observe_cpu(99)
+    assert ctl.cpu == 99
+
+
+def test_journal(tmp_path):
+    path = tmp_path / "device.journal"
+    jrnl = journal.Journal(path)
+    assert jrnl.load() is None
+    jrnl.begin(packed.Networks.fromkeys([1, 2, 3]), packed.Networks.fromkeys([4]))
+    jrnl.confirm(journal.ADD, 2)
+    jrnl.close()
+    plan = jrnl.load()
+    assert list(plan.pending_adds) == [3]
+    assert list(plan.pending_removes) == [4]
+    # torn record at the end is ignored
+    with path.open("ab") as fd:
+        fd.write(b"B\x09\x00")
+    assert jrnl.load().added == 2
+    jrnl.finish()
+    assert not path.exists()
+
+
+def test_file_lock(tmp_path):
+    lock = FileLock(tmp_path / "lock")
+    with lock:
+        # flock locks are per file description, so it's held against this one too
+        with pytest.raises(LockedError):
+            FileLock(tmp_path / "lock").acquire(blocking=False)
+    FileLock(tmp_path / "lock").acquire(blocking=False)
+
+
+async def test_coalescer():
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    run = Coalescer(work)
+    first = asyncio.ensure_future(run())
+    await asyncio.sleep(0.01)
+    # all of these are merged into one follow-up run
+    rest = await asyncio.gather(*(run() for _ in range(5)))
+    assert await first == 1
+    assert rest == [2] * 5
+    assert run.runs == 2 and not run.running
+    # waiters of cancelled runs don't hang
+    first = asyncio.ensure_future(run())
+    await asyncio.sleep(0.01)
+    second = asyncio.ensure_future(run())
+    await asyncio.sleep(0)
+    await run.close()
+    for waiter in (first, second):
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+    assert not run.running
+    assert await run() == 4
+
+
+class NetlinkEvent(dict):
+    def get_attr(self, name):
+        return dict(self["attrs"]).get(name)
+
+
+def route_event(event, dst, table=1000, pid=1, nh_id=None):
+    # tables above 255 are only in the attribute
+    via = ("RTA_NH_ID", nh_id) if nh_id else ("RTA_OIF", 5)
+    return NetlinkEvent(
+        event=event, family=socket.AF_INET, dst_len=24, table=252, header={"pid": pid},
+        attrs=[("RTA_DST", dst), via, ("RTA_TABLE", table)],
+    )
+
+
+def test_route_mirror():
+    mirror = RouteMirror(1000, "tun0", own_ports=lambda: {1})
+    assert mirror.snapshot() is None
+    mirror.synced.set()
+    mirror.apply(route_event("RTM_NEWROUTE", "1.2.3.0"))
+    mirror.apply(route_event("RTM_NEWROUTE", "1.2.4.0", pid=2))
+    mirror.apply(route_event("RTM_NEWROUTE", "1.2.5.0", table=10))
+    # applying events is idempotent
+    mirror.apply(route_event("RTM_DELROUTE", "1.2.3.0"))
+    mirror.apply(route_event("RTM_DELROUTE", "1.2.3.0"))
+    assert [x.with_netmask() for x in mirror.snapshot()] == ["1.2.4.0/24"]
+    assert mirror.drift == 1
+    # kernel drops routes of the interface going down silently
+    link = [("IFLA_IFNAME", "tun0")]
+    mirror.apply(NetlinkEvent(event="RTM_NEWLINK", index=5, state="down", attrs=link))
+    assert mirror.snapshot() == []
+    # the interface is recreated with another index
+    recreated = []
+    mirror.on_up = recreated.append
+    mirror.apply(NetlinkEvent(event="RTM_DELLINK", index=5, state="down", attrs=link))
+    mirror.apply(NetlinkEvent(event="RTM_NEWLINK", index=6, state="up", attrs=link))
+    mirror.apply(NetlinkEvent(event="RTM_NEWLINK", index=6, state="up", attrs=link))
+    assert [x.num for x in recreated] == [6]
+
+
+def test_route_mirror_nexthops():
+    mirror = RouteMirror(1000, "tun0", own_ports=lambda: {1}, nexthops=lambda: {1000})
+    mirror.synced.set()
+    mirror.apply(route_event("RTM_NEWROUTE", "1.2.3.0", nh_id=1000))
+    mirror.apply(route_event("RTM_NEWROUTE", "1.2.4.0", nh_id=2000))
+    assert mirror.routes["1.2.3.0/24"].via is None
+    # routes via nexthops of the interface are dropped with it too
+    link = [("IFLA_IFNAME", "tun0")]
+    mirror.apply(NetlinkEvent(event="RTM_NEWLINK", index=5, state="down", attrs=link))
+    assert [x.with_netmask() for x in mirror.snapshot()] == ["1.2.4.0/24"]
+
+
+def test_route_cache():
+    networks = packed.Networks.fromkeys(map(packed.pack, ["1.2.3.0/24", "2001:db8::/32"]))
+    cache = RouteCache.fromnetworks(networks, 1000)
+    assert cache.count == 2
+    (v4, v4_size, v4_oif), (v6, v6_size, v6_oif) = cache.blobs
+    assert len(v4) == v4_size and len(v6) == v6_size
+    # destination length and address
+    assert v4[17] == 24 and v4[32:36] == bytes([1, 2, 3, 0])
+    assert v6[17] == 32 and v6[32:48] == socket.inet_pton(socket.AF_INET6, "2001:db8::")
+    assert v4_oif == 40 and v6_oif == 52
+    # routes via nexthop don't depend on the interface
+    cache = RouteCache.fromnetworks(networks, 1000, {socket.AF_INET: 7, socket.AF_INET6: 8})
+    (v4, _, v4_oif), (v6, _, v6_oif) = cache.blobs
+    assert v4_oif is None and v6_oif is None
+    assert v4[36:44] == struct.pack("=HHI", 8, 30, 7)
+
+
+def test_ros_dump():
+    calls = []
+
+    class Resource:
+        def call_async(self, *args):
+            calls.append(args)
+            return [
+                {"id": "*1", "address": "1.2.3.0/24"},
+                {"id": "*2", "address": "1.2.4.5"},
+                # entries of others which aren't networks are skipped
+                {"id": "*3", "address": "1.1.1.1-1.1.1.5"},
+                {"id": "*4", "address": "example.com"},
+            ]
+
+    mgr = object.__new__(RouterosManager)
+    mgr.cmd, mgr.ipv6, mgr.list_name = Resource(), False, "vpn"
+    routes = mgr.current()
+    # entries are parsed lazily
+    assert not calls
+    assert [x.id for x in routes] == ["*1", "*2"]
+    assert calls == [("print", {"proplist": ".id,address"}, {"list": "vpn"})]
+    assert mgr._ids == {packed.pack("1.2.3.0/24"): "*1", packed.pack("1.2.4.5/32"): "*2"}
+    # removals are sent as lists of IDs
+    calls.clear()
+    mgr._send = lambda method, arg, network: calls.append(arg)
+    mgr.flush = lambda: None
+    removes = packed.Networks.fromkeys(
+        map(packed.pack, ["1.2.3.0/24", "1.2.4.5/32", "1.2.5.0/24"])
+    )
+    assert mgr.apply_batch(packed.Networks(), removes) == (0, 2)
+    assert calls == [("*1,*2", False)]
+
+
+async def test_sync_adapter():
+    class Legacy(Manager):
+        fromconf = None
+
+        def __init__(self):
+            self.routes = {"1.2.3.0/24", "1.2.4.0/24"}
+
+        def current(self):
+            return [models.RosRoute(x) for x in self.routes]
+
+        def add(self, network):
+            self.routes.add(network)
+
+        def remove(self, network):
+            self.routes.discard(network)
+
+    mgr = Legacy()
+    batch = as_batch(mgr)
+    assert not batch.bulk and not batch.atomic_swap
+    current = await batch.networks()
+    adds, removes = packed.Networks.fromkeys([packed.pack("1.2.5.0/24")]).diff(current)
+    assert await batch.apply(adds, removes) == (1, 2)
+    assert mgr.routes == {"1.2.5.0/24"}
+
+
+def test_buckets():
+    buckets = Buckets(bits=8)
+    key = packed.pack("10.1.2.0/24")
+    assert buckets.network(buckets.of(key)) == "10.0.0.0/8"
+    assert buckets.tag_of("2001:db8::/32") == "vroute:2001::/16"
+    ours = buckets.summarize(map(packed.pack, ["10.1.2.0/24", "10.1.3.0/24", "11.0.0.0/8"]))
+    # same counts, different networks
+    theirs = buckets.summarize(map(packed.pack, ["10.1.2.0/24", "10.1.4.0/24", "11.0.0.0/8"]))
+    assert compare(ours, theirs) == [buckets.of(key)]
+    # devices without hashes are compared by counts
+    assert compare(ours, {x: (count, None) for x, (count, _) in theirs.items()}) == []
+
+
+def test_aggregate(caplog):
+    networks = packed.Networks.fromkeys(
+        packed.pack(x)
+        for x in [
+            "10.0.0.0/25", "10.0.0.128/25", "10.0.1.0/24", "10.0.3.0/24", "10.0.3.7",
+            "10.2.0.0/24", "192.168.0.0/24", "2001:db8::/48", "2001:db8:1::/48",
+        ]
+    )
+    # siblings and covered networks are merged without loss
+    result = Aggregator(100)(networks)
+    assert [packed.unpack(x) for x in result.networks] == [
+        "10.0.0.0/23", "10.0.3.0/24", "10.2.0.0/24", "192.168.0.0/24", "2001:db8::/47"
+    ]
+    assert result.swept == result.swept6 == 0
+    # the cheapest merge is taken, the supernet of 10.2.0.0/24 would cover the excluded one
+    result = Aggregator(4, exclude=["10.1.0.0/16"])(networks)
+    assert [packed.unpack(x) for x in result.networks] == [
+        "10.0.0.0/22", "10.2.0.0/24", "192.168.0.0/24", "2001:db8::/47"
+    ]
+    assert result.swept == 256 and result.before == 9
+    # the limit is of the device, not of every family
+    result = Aggregator(2)(networks)
+    assert [packed.unpack(x) for x in result.networks] == ["0.0.0.0/0", "2001:db8::/47"]
+    with caplog.at_level(logging.WARNING, logger="vroute.aggregate"):
+        assert len(Aggregator(3, exclude=["10.1.0.0/16"])(networks).networks) == 4
+    assert "above max_entries 3" in caplog.text
+
+
+class RosList:
+    """ Address list of the RouterOS resource. """
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def call_async(self, command, arguments, queries=None):
+        matched = [
+            x for x in self.entries if all(x.get(k) == v for k, v in (queries or {}).items())
+        ]
+        if command == "set":
+            entry = next(x for x in self.entries if x["id"] == arguments["id"])
+            entry["comment"] = arguments["comment"]
+        if "count-only" in arguments:
+            response = types.SimpleNamespace(done_message={"ret": str(len(matched))})
+            return types.SimpleNamespace(get=lambda: response)
+        return matched
+
+
+def test_ros_buckets():
+    entries = [
+        {"id": "*1", "address": "10.1.2.0/24", "list": "vpn", "comment": "vroute:10.0.0.0/8"},
+        {"id": "*2", "address": "11.1.2.0/24", "list": "vpn", "comment": "vroute:12.0.0.0/8"},
+        # added by earlier versions without tags
+        {"id": "*6", "address": "10.1.3.0/24", "list": "vpn"},
+        # entries of others
+        {"id": "*3", "address": "11.1.3.0/24", "list": "vpn"},
+        {"id": "*4", "address": "11.1.4.0/24", "list": "vpn", "comment": "office"},
+        {"id": "*5", "address": "example.com", "list": "vpn", "comment": "vroute:1.0.0.0/8"},
+    ]
+    mgr = object.__new__(RouterosManager)
+    mgr.cmd, mgr.ipv6, mgr.list_name, mgr._ids = RosList(entries), False, "vpn", {}
+    mgr._send = lambda method, arg, network: method(arg)
+    mgr.flush = lambda: None
+    buckets = mgr.buckets
+    expected = [buckets.of(packed.pack(x)) for x in ["10.0.0.0/8", "11.0.0.0/8"]]
+    # untagged entries make it dump the list
+    assert mgr.summarize(expected)[expected[1]][1] is not None
+    assert mgr.untagged == 5
+    # only networks vroute added are tagged, ones without comments if they are desired
+    desired = packed.Networks.fromkeys(
+        map(packed.pack, ["10.1.2.0/24", "10.1.3.0/24", "11.1.2.0/24"])
+    )
+    assert mgr.tag_buckets(desired) == 2
+    assert [x.get("comment") for x in entries] == [
+        "vroute:10.0.0.0/8", "vroute:11.0.0.0/8", "vroute:10.0.0.0/8",
+        None, "office", "vroute:1.0.0.0/8",
+    ]
+    assert mgr.untagged == 3
+    del entries[3:]
+    assert mgr.summarize(expected) == {expected[0]: (2, None), expected[1]: (1, None)}
+    assert mgr.untagged == 0
+    assert list(mgr.bucket_networks(expected[1:])) == [packed.pack("11.1.2.0/24")]
+    assert mgr._ids[packed.pack("11.1.2.0/24")] == "*2"
+
+
+class FakeBird(socketserver.ThreadingUnixStreamServer):
+    """ BIRD control socket, replies to configure with `reply`. """
+
+    def __init__(self, path):
+        self.commands = []
+        self.reply = "0002-Reading configuration\n0003 Reconfigured\n"
+        super().__init__(path, FakeBirdHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class FakeBirdHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(b"0001 BIRD 2.0.12 ready.\n")
+        self.server.commands.append(self.rfile.readline().decode().strip())
+        self.wfile.write(self.server.reply.encode())
+
+
+def test_bird(tmp_path):
+    server = FakeBird(str(tmp_path / "bird.ctl"))
+    file = str(tmp_path / "vroute.conf")
+    mgr = BirdManager(file, BirdControl(server.socket.getsockname()), communities=["65000:10"])
+    # the empty file is there before the first sync
+    assert list(mgr.current()) == []
+    adds = packed.Networks.fromkeys(map(packed.pack, ["10.0.0.0/8", "1.2.3.0/24"]))
+    assert asyncio.run(as_batch(mgr).apply(adds, packed.Networks())) == (2, 0)
+    assert server.commands == ["configure"]
+    with open(file) as fd:
+        rendered = fd.read()
+    assert "import filter { bgp_community.add((65000, 10)); accept; };" in rendered
+    assert "    route 1.2.3.0/24 blackhole;\n" in rendered
+    mgr.remove("10.0.0.0/8")
+    mgr.add("1.2.4.0/24")
+    mgr.flush()
+    assert [x.with_netmask() for x in mgr.current()] == ["1.2.3.0/24", "1.2.4.0/24"]
+    # rejected configuration is rolled back
+    server.reply = "8002 vroute.conf:3:1 syntax error\n"
+    mgr.add("1.2.5.0/24")
+    with pytest.raises(BirdError, match="syntax error"):
+        mgr.flush()
+    assert [x.with_netmask() for x in mgr.current()] == ["1.2.3.0/24", "1.2.4.0/24"]
+    server.shutdown()
+
+
+class SlowDevice(BatchManager):
+    def __init__(self, events, fail=False):
+        self.events = events
+        self.fail = fail
+
+    async def networks(self):
+        return packed.Networks()
+
+    async def apply(self, adds, removes):
+        self.events.append(("apply", len(adds), len(removes)))
+        if self.fail:
+            raise OSError("device is gone")
+        await asyncio.sleep(0.01)
+        return len(adds), len(removes)
+
+
+async def test_pipeline():
+    events = []
+
+    async def chunks():
+        for i in range(6):
+            events.append(("chunk", i))
+            yield packed.Networks.fromkeys([i << 8 | 32]), packed.Networks.fromkeys([i << 8])
+
+    assert await pipeline(SlowDevice(events), chunks(), prune=True, depth=2) == (6, 6)
+    # the device is written while the diff goes on, queued chunks are applied at once
+    assert events.index(("apply", 1, 1)) < events.index(("chunk", 1))
+    assert len([x for x in events if x[0] == "apply"]) < 6
+    events.clear()
+    device = SlowDevice(events)
+    device.atomic_swap = True
+    assert await pipeline(device, chunks(), prune=False) == (6, 0)
+    assert [x for x in events if x[0] == "apply"] == [("apply", 6, 0)]
+    # failed device stops the diff
+    events.clear()
+    with pytest.raises(OSError):
+        await pipeline(SlowDevice(events, fail=True), chunks(), prune=True, depth=1)
+    assert ("chunk", 5) not in events
+
+
+
+def dns_message(id_, name, flags=0x0100, answers=()):
+    """ Query or response with A records of (address, TTL). """
+    qname = b"".join(bytes([len(x)]) + x.encode() for x in name.split(".")) + b"\0"
+    data = struct.pack(">HHHHHH", id_, flags, 1, len(answers), 0, 0) + qname + b"\0\1\0\1"
+    for address, ttl in answers:
+        data += b"\xc0\x0c" + struct.pack(">HHIH", 1, 1, ttl, 4) + socket.inet_aton(address)
+    return data
+
+
+class FakeResolver(asyncio.DatagramProtocol):
+    def __init__(self, answers):
+        self.answers = answers
+        self.queries = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.queries += 1
+        id_, _, _, _, _, _ = struct.unpack_from(">HHHHHH", data)
+        name, _ = dnsproxy.read_name(data, 12)
+        answers = self.answers.get(name.decode(), ())
+        self.transport.sendto(dns_message(id_, name.decode(), 0x8180, answers), addr)
+
+
+class DNSClient(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.responses = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.responses.put_nowait(data)
+
+
+async def test_dns_proxy():
+    loop = asyncio.get_event_loop()
+    resolver = FakeResolver(
+        {"www.example.com": [("1.2.3.4", 60), ("10.1.1.1", 30)], "other.org": [("5.6.7.8", 60)]}
+    )
+    upstream, _ = await loop.create_datagram_endpoint(
+        lambda: resolver, local_addr=("127.0.0.1", 0)
+    )
+    events = []
+    installed = packed.Networks.fromkeys([packed.pack("10.0.0.0/8")])
+    device = dnsproxy.Device(SlowDevice(events), installed)
+    router = dnsproxy.Router([device], packed.Networks())
+    proxy = dnsproxy.DNSProxy(router, ["Example.com"], dnsproxy.Cache(100, 3600))
+    server, _ = await loop.create_datagram_endpoint(lambda: proxy, local_addr=("127.0.0.1", 0))
+    proxy.upstream, _ = await loop.create_datagram_endpoint(
+        lambda: dnsproxy.Upstream(proxy), remote_addr=upstream.get_extra_info("sockname")
+    )
+    client = DNSClient()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: client, remote_addr=server.get_extra_info("sockname")
+    )
+    try:
+        for i, name in enumerate(["www.example.com", "www.example.com", "other.org"]):
+            transport.sendto(dns_message(100 + i, name))
+            response = await asyncio.wait_for(client.responses.get(), 1)
+            assert struct.unpack_from(">H", response) == (100 + i,)
+            answer = dnsproxy.parse_answer(response)
+            # addresses are routed before the response is sent, ones the device covers are not
+            if name == "www.example.com":
+                assert answer.addresses == list(map(packed.pack, ["1.2.3.4", "10.1.1.1"]))
+                assert events == [("apply", 1, 0)]
+        # the second query is answered from the cache
+        assert resolver.queries == 2
+        assert router.routed == {packed.pack("1.2.3.4"), packed.pack("10.1.1.1")}
+    finally:
+        for x in (transport, server, proxy.upstream, upstream):
+            x.close()
+
+
+def test_dns_cache():
+    query = dns_message(1, "example.com")
+    response = dns_message(1, "example.com", 0x8180, [("1.2.3.4", 60)])
+    _, key = dnsproxy.question(query)
+    cache = dnsproxy.Cache(1, 30)
+    cache.put(key, response, dnsproxy.parse_answer(response))
+    assert cache.get(key, b"\0\2")[:2] == b"\0\2"
+
+    def age(seconds):
+        response, stored, ttl, offsets = cache._entries[key]
+        cache._entries[key] = (response, stored - seconds, ttl, offsets)
+
+    # TTLs are aged, the entry expires by max_ttl
+    age(10)
+    assert dnsproxy.parse_answer(cache.get(key, b"\0\1")).ttl == 50
+    age(20)
+    assert cache.get(key, b"\0\1") is None
+
+
+
+def mrt_record(subtype, body):
+    return struct.pack(">IHHI", 0, 13, subtype, len(body)) + body
+
+
+def rib_record(network, *paths, addpath=False):
+    """ RIB record with an entry per AS path, a tuple in the path is AS_SET. """
+    key = packed.pack(network)
+    plen = key & 0xFF
+    bits = 128 if packed.is_v6(key) else 32
+    addr = ((key ^ packed.V6 if bits == 128 else key) >> 8).to_bytes(bits // 8, "big")
+    body = struct.pack(">IB", 0, plen) + addr[: (plen + 7) // 8] + struct.pack(">H", len(paths))
+    for path in paths:
+        segments = b""
+        for segment in path:
+            asns = segment if isinstance(segment, tuple) else (segment,)
+            type_ = 1 if isinstance(segment, tuple) else 2
+            segments += struct.pack(f">BB{len(asns)}I", type_, len(asns), *asns)
+        # ORIGIN and AS_PATH of the extended length
+        attrs = b"\x40\x01\x01\x00" + struct.pack(">BBH", 0x50, 2, len(segments)) + segments
+        entry = struct.pack(">HI", 0, 0) + (b"\0\0\0\1" if addpath else b"")
+        body += entry + struct.pack(">H", len(attrs)) + attrs
+    subtype = (4 if bits == 128 else 2) + (6 if addpath else 0)
+    return mrt_record(subtype, body)
+
+
+def test_mrt(tmp_path):
+    dump = b"".join([
+        # peer index table
+        mrt_record(1, b"\0" * 10),
+        rib_record("104.16.0.0/13", [64500, 13335], [64501, 64500, 13335]),
+        rib_record("104.24.0.0/14", [64500, 13335]),
+        rib_record("104.28.0.0/14", [64500, 13335], addpath=True),
+        # transit
+        rib_record("8.8.8.0/24", [13335, 15169]),
+        rib_record("9.9.9.0/24", [64500, 19281]),
+        # multiple origins
+        rib_record("1.1.1.0/24", [64500, (64502, 13335)]),
+        rib_record("2606:4700::/32", [64500, 13335]),
+    ])
+    path = tmp_path / "rib.bz2"
+    path.write_bytes(bz2.compress(dump))
+    assert [x[:2] for x in mrt.records(io.BytesIO(dump), chunk_size=7)][:2] == [(13, 1), (13, 2)]
+    with mrt.open_dump(str(path)) as fd:
+        networks = packed.Networks.fromkeys(mrt.originated(fd, [mrt.parse_asn("AS13335")]))
+    assert [packed.unpack(x) for x in networks] == [
+        "1.1.1.0/24", "104.16.0.0/13", "104.24.0.0/14", "104.28.0.0/14", "2606:4700::/32"
+    ]
+    # only merges adding nothing without the limit
+    aggregated = Aggregator(None)(networks)
+    assert [packed.unpack(x) for x in aggregated.networks] == [
+        "1.1.1.0/24", "104.16.0.0/12", "2606:4700::/32"
+    ]
+    assert aggregated.swept == 0
+    with pytest.raises(mrt.MRTError):
+        list(mrt.records(io.BytesIO(dump[:-1])))
+
+
+async def test_local_storage(tmp_path):
+    service = LocalNetworkingService(str(tmp_path / "db.sqlite3"))
+    assert await service.load_networks(["10.0.0.0/8\n", "2001:db8::/32", "1.1.1.1"]) == (3, 0)
+    assert await service.load_networks(["1.1.1.1", "1.2.3.0/24"], "feed") == (1, 1)
+    assert await service.replace_networks(["1.2.4.0/24"], "feed") == (1, 1)
+    # networks other sources have are kept
+    assert await service.delete_networks(["1.1.1.1"], "feed") == 0
+    assert await service.delete_networks(["1.1.1.1"]) == 1
+    networks = [x async for x in service.iter_networks(page_size=1)]
+    assert networks == ["1.2.4.0/24", "10.0.0.0/8", "2001:db8::/32"]
+    assert [x async for x in service.iter_networks(after="1.2.4.0/24")] == networks[1:]
+    device = packed.Networks.fromkeys(map(packed.pack, ["10.0.0.0/8", "8.8.8.8"]))
+    assert [x async for x in service.missing(device)] == ["8.8.8.8/32"]
+    assert list(await service.fetch_packed()) == list(map(packed.pack, networks))
+
+
+@pytest.mark.parametrize("strategy", DIFF_STRATEGIES)
+async def test_export(pg_service, strategy):
+    await pg_service.load_networks(["10.0.0.0/8", "1.1.1.1", "2001:db8::/32"])
+    mgr = MemoryManager("gateway")
+    mgr.networks.update({"10.0.0.0/8", "8.8.8.8/32"})
+    # outdated networks are kept without prune, IPv6 ones aren't exported
+    assert await pg_service.export(mgr, strategy) == (1, 0)
+    assert mgr.networks == {"1.1.1.1/32", "10.0.0.0/8", "8.8.8.8/32"}
+    assert await pg_service.export(mgr, strategy, prune=True) == (0, 1)
+    assert mgr.networks == {"1.1.1.1/32", "10.0.0.0/8"}
+
+
+def test_manager_remove():
+    class AddOnly(Manager):
+        fromconf = current = None
+
+        def add(self, network):
+            pass
+
+    # prune must not fail halfway through a sync on a device that can't remove
+    with pytest.raises(TypeError):
+        AddOnly()
+
+
+async def check_concurrent_calls(service):
+    # every call has its own connection and transaction
+    loads = (service.load_networks([f"10.0.0.{i}"], f"feed{i}") for i in range(4))
+    assert await asyncio.gather(*loads) == [(1, 0)] * 4
+    assert len([x async for x in service.iter_networks(page_size=1)]) == 4
+
+
+async def test_concurrent_calls(tmp_path):
+    await check_concurrent_calls(LocalNetworkingService(str(tmp_path / "db.sqlite3")))
+
+
+async def test_pg_concurrent_calls(pg_service):
+    await check_concurrent_calls(pg_service)
+
+
+async def test_replace_generations(pg_service):
+    await pg_service.load_networks(["1.1.1.1"])
+    # counts are of networks added to and removed from the union of sources
+    assert await pg_service.replace_networks(["1.1.1.1", "1.2.3.0/24"], "feed") == (1, 0)
+    assert await pg_service.replace_networks(["1.2.3.0/24", "1.2.4.0/24"], "feed") == (1, 0)
+    async with pg_service.connection() as conn:
+        generation = await conn.fetchval("SELECT generation FROM sources WHERE name = 'feed'")
+        rows = await conn.fetch(
+            "SELECT net, generation FROM source_networks WHERE source = 'feed' ORDER BY net"
+        )
+    # networks keep the generation they first appeared in
+    assert generation == 2
+    assert [(with_netmask(x["net"]), x["generation"]) for x in rows] == [
+        ("1.2.3.0/24", 1), ("1.2.4.0/24", 2)
+    ]
+    # the network the default source has is kept
+    assert await pg_service.replace_networks([], "feed") == (0, 2)
+    assert [x async for x in pg_service.iter_networks()] == ["1.1.1.1/32"]
+
+
+async def test_remove_networks(tmp_path):
+    service = LocalNetworkingService(str(tmp_path / "db.sqlite3"))
+    loaded = ["10.0.0.0/8", "10.1.0.0/16", "10.1.2.0/24", "11.0.0.0/8", "2001:db8:1::/48"]
+    await service.load_networks(loaded)
+    await service.load_networks(["10.1.2.0/24", "12.0.0.0/8"], "feed")
+    # removed from every source, prefixes covering nothing are not found
+    removed = await service.remove_networks(
+        ["11.0.0.0/8", "12.0.0.0/8", "13.0.0.0/8"],
+        covered_by=["10.1.0.0/16", "2001:db8::/32", "192.168.0.0/16"],
+    )
+    assert removed == (5, 2)
+    assert [x async for x in service.iter_networks()] == ["10.0.0.0/8"]
+    assert await service.load_networks(["10.1.2.0/24"], "feed") == (1, 0)
+
+
+async def test_route_sets(tmp_path):
+    service = LocalNetworkingService(str(tmp_path / "db.sqlite3"))
+    await service.load_networks(["10.0.0.0/8", "1.1.1.1", "2001:db8::/32"])
+    assert await service.route_sets() == ["default"]
+    assert list(await service.fetch_sets()) == ["default"]
+    await service.load_networks(["1.1.1.1", "8.8.8.8"], "dns", route_set="wg")
+    await service.replace_networks(["9.9.9.9"], "feed", route_set="wg")
+    await service.load_networks(["2001:db8::/32"], "office", route_set="lan")
+    assert await service.route_sets() == ["default", "lan", "wg"]
+    # networks of other sets aren't in the default one
+    sets = {k: [packed.unpack(x) for x in v] for k, v in (await service.fetch_sets()).items()}
+    assert sets == {
+        "default": ["10.0.0.0/8"],
+        "lan": ["2001:db8::/32"],
+        "wg": ["1.1.1.1/32", "8.8.8.8/32", "9.9.9.9/32"],
+    }
+    # the source keeps its set unless another is given
+    await service.replace_networks(["9.9.9.10"], "feed")
+    assert [packed.unpack(x) for x in (await service.fetch_sets())["wg"]][-1] == "9.9.9.10/32"
+
+
+def test_device_sets():
+    cfg = Configuration()
+    cfg.file = {
+        "devices": [
+            {
+                "name": "router",
+                "type": "routeros",
+                "list_name": "vpn",
+                "sets": {"wg": {"list_name": "wg"}, "lan": None},
+            }
+        ]
+    }
+    devices = {x["name"]: x for x in cfg.devices}
+    assert list(devices) == ["router", "router:wg", "router:lan"]
+    assert "set" not in devices["router"] and "sets" not in devices["router"]
+    assert devices["router:wg"]["list_name"] == "wg"
+    assert devices["router:wg"]["set"] == "wg"
+    assert devices["router:lan"]["list_name"] == "vpn"
+
+
 def test_version():
+    toml = pytest.importorskip("toml")
     with open("pyproject.toml") as fp:
         toml_version = toml.load(fp)["tool"]["poetry"]["version"]
     assert __version__ == toml_version
@@ -52,91 +856,120 @@ def test_config():
     assert cfg.get("key.key2.key3") == "value"
 
 
-def test_db(vrouteobj):
-    """ Checks that database schema properly initialized. """
-    session = vrouteobj.new_session()
-    assert not list(session.query(Host))
-
-
-def test_address():
-    assert Address(value="192.168.0.1/32") == "192.168.0.1"
-    addr = Address(value="192.168.0.1")
-    assert addr == "192.168.0.1/32"
-    assert addr == "192.168.0.1"
-    assert addr == Address(value="192.168.0.1")
-    assert addr == Address(value="192.168.0.1/32")
-
-
 def test_v4parser():
     assert with_netmask("192.168.0.1") == "192.168.0.1/32"
     assert with_netmask("192.168.0.1/32") == "192.168.0.1/32"
 
 
-def test_addresses():
-    addresses = models.Addresses()
-    addresses.add(Address(value="192.168.0.1/32"))
-    assert "192.168.0.1/32" in addresses
-    assert "192.168.0.1" in addresses
-
-
-# # # # # # # # # # # # # # #
-# 'add' and 'del' commands  #
-# # # # # # # # # # # # # # #
-
-
-async def test_add_host(helpers, query):
-    """ Checks adding and resolving new host """
-    helpers.mock_rule(exists=True)
-    helpers.mock_resolve("1.2.3.4")
-    await helpers.post("/", host="example.com")
-    assert not RouteManager.get_rules.called # pylint:disable=no-member
-    assert not RouteManager.rule.called # pylint:disable=no-member
-    assert len(list(query(Host))) == 1
-    record = query(Host).filter(Host.name == "example.com").first()
-    assert record
-    assert record.name == "example.com"
-    assert datetime.now() < record.expires < datetime.now() + timedelta(seconds=300)
-    assert not record.comment
-    assert query(Address).first()
-
-
-async def test_add_route(helpers, query):
-    resp = await helpers.post("/routes", routes=["46.101.128.0/17"])
-    json = await resp.json()
-    assert json == {"count": 1, "exists": 0}
-    assert query(Address).one() == Address(value="46.101.128.0/17")
-
-
-@pytest.mark.skip("not implemented")
-async def test_add_comments(helpers, query):
-    helpers.mock_resolve("1.2.3.4")
-    await helpers.post("/", host="example.com", comment="test")
-    assert query(Host).first().comment == "test"
-
-
-async def test_del_host(helpers, query):
-    """ Check that /rm removes only host and doesn't touch Address """
-    helpers.add_host("example.com", "1.2.3.4")
-    assert query(Address).first()
-    await helpers.post("/rm", host="example.com")
-    assert not query(Host).first()
-    assert not query(Address).first()
-
-
-# # # # # # # # # #
-# 'show' command  #
-# # # # # # # # # #
+def test_v6parser():
+    assert with_netmask("2001:db8::1") == "2001:db8::1/128"
+    assert with_netmask("2001:db8::/32") == "2001:db8::/32"
+
+
+# # # # # # # # # # #
+# 'networks' route  #
+# # # # # # # # # # #
+
+
+async def test_add_route(client, service):
+    resp = await client.post("/networks", data="46.101.128.0/17\n")
+    assert await resp.json() == {"count": 1, "exists": 0}
+    assert [x async for x in service.iter_networks()] == ["46.101.128.0/17"]
+
+
+async def ndjson(resp) -> list:
+    assert resp.status == 200
+    return [json.loads(x) for x in (await resp.text()).splitlines()]
+
+
+async def test_show_networks(client, service):
+    await service.load_networks(["10.0.0.0/8", "1.1.1.1", "1.2.3.0/24"])
+    networks = ["1.1.1.1/32", "1.2.3.0/24", "10.0.0.0/8"]
+    assert await ndjson(await client.get("/networks")) == networks
+    page = await ndjson(await client.get("/networks", params={"limit": 2}))
+    assert page == networks[:2] + [{"next": "1.2.3.0/24"}]
+    page = await ndjson(await client.get("/networks", params={"after": "1.2.3.0/24"}))
+    assert page == networks[2:]
+    for limit in ("0", "x", "1000001"):
+        assert (await client.get("/networks", params={"limit": limit})).status == 400
+
+
+async def test_add_networks(client, service):
+    body = '"1.1.1.1"\n\n{"net": "10.0.0.0/8"}\n'
+    headers = {"Content-Type": "application/x-ndjson"}
+    resp = await client.post("/networks", data=body, headers=headers)
+    assert await resp.json() == {"count": 2, "exists": 0}
+    for body in ("[\n", '{"network": "1.1.1.1"}\n'):
+        assert (await client.post("/networks", data=body, headers=headers)).status == 400
+    resp = await client.post("/networks", data="1.1.1.1\n1.2.3.4/33\n")
+    assert resp.status == 400
+    assert "1.2.3.4/33" in resp.reason
+    for params in ({"replace": "true"}, {"set": "wg"}):
+        assert (await client.post("/networks", data="", params=params)).status == 400
+    params = {"source": "feed", "replace": "true", "set": "wg"}
+    resp = await client.post("/networks", data="1.2.3.0/24\n", params=params)
+    assert await resp.json() == {"added": 1, "removed": 0}
+    assert await service.route_sets() == ["default", "wg"]
+    assert [x async for x in service.iter_networks()] == [
+        "1.1.1.1/32", "1.2.3.0/24", "10.0.0.0/8"
+    ]
 
 
-async def test_show_empty(helpers, query):
-    response = await helpers.get("/")
-    assert response.status == 204
+async def test_show_devices(client):
+    resp = await client.get("/devices")
+    assert await resp.json() == [
+        {"name": "gateway", "type": "memory"}, {"name": "router", "type": "memory"}
+    ]
 
 
-async def test_show(helpers, query):
-    helpers.add_host("example.com", "1.2.3.4")
-    response = await helpers.get("/")
-    assert response.status == 200
-    assert await response.json() == {
-        "example.com": {"addrs": ["1.2.3.4"], "comment": None}
-    }
+async def test_show_diff(client, service, devices):
+    await service.load_networks(["1.1.1.1", "1.2.3.0/24", "10.0.0.0/8"])
+    devices["gateway"] = {"1.2.3.0/24", "8.8.8.8/32"}
+    diff = await ndjson(await client.get("/devices/gateway/diff"))
+    assert diff == [
+        {"op": "add", "net": "1.1.1.1/32"},
+        {"op": "add", "net": "10.0.0.0/8"},
+        {"op": "remove", "net": "8.8.8.8/32"},
+    ]
+    params = {"op": "add", "limit": 1}
+    page = await ndjson(await client.get("/devices/gateway/diff", params=params))
+    assert page == diff[:1] + [{"next": "1.1.1.1/32"}]
+    params = {"op": "add", "after": "1.1.1.1/32"}
+    assert await ndjson(await client.get("/devices/gateway/diff", params=params)) == diff[1:2]
+    params = {"op": "remove"}
+    assert await ndjson(await client.get("/devices/gateway/diff", params=params)) == diff[2:]
+    assert (await client.get("/devices/gateway/diff", params={"op": "x"})).status == 400
+    resp = await client.get("/devices/gateway/diff", params={"after": "1.1.1.1/32"})
+    assert resp.status == 400
+    assert (await client.get("/devices/nothing/diff")).status == 404
+
+
+async def test_show_set_diff(client, config, service, devices):
+    config.file["devices"][0]["sets"] = {"wg": None}
+    await service.load_networks(["1.1.1.1", "10.0.0.0/8"])
+    await service.load_networks(["1.2.3.0/24", "10.0.0.0/8"], "feed", route_set="wg")
+    devices["gateway:wg"] = {"8.8.8.8/32"}
+    # networks of the set are only in its device
+    diff = await ndjson(await client.get("/devices/gateway/diff", params={"op": "add"}))
+    assert diff == [{"op": "add", "net": "1.1.1.1/32"}]
+    diff = await ndjson(await client.get("/devices/gateway:wg/diff"))
+    assert diff == [
+        {"op": "add", "net": "1.2.3.0/24"},
+        {"op": "add", "net": "10.0.0.0/8"},
+        {"op": "remove", "net": "8.8.8.8/32"},
+    ]
+    params = {"op": "add", "after": "1.2.3.0/24"}
+    assert await ndjson(await client.get("/devices/gateway:wg/diff", params=params)) == diff[1:2]
+    params = {"op": "add", "after": "1.2.3.4/33"}
+    assert (await client.get("/devices/gateway:wg/diff", params=params)).status == 400
+
+
+async def test_sync_coalesced(client, service, devices):
+    await service.load_networks(["1.2.3.4"])
+    responses = await asyncio.gather(*(client.post("/sync") for _ in range(3)))
+    # requests arriving during the sync wait for the next one
+    for resp in responses:
+        stats = await resp.json()
+        assert sorted(stats) == ["gateway", "router"]
+        assert all(x["error"] is None for x in stats.values())
+    assert devices == {"gateway": {"1.2.3.4/32"}, "router": {"1.2.3.4/32"}}
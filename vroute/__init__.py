@@ -5,37 +5,44 @@ from pathlib import Path
 
 import requests
 
+from .lock import FileLock
 from .routing import Manager
-from .services import NetworkingService
+from .services import BaseNetworkingService, NetworkingService
 
-__version__ = "0.5.2"
+__version__ = "3.0.0"
 
 log = logging.getLogger(__name__)
 
 
 class VRoute:
-    network_service: NetworkingService
+    network_service: BaseNetworkingService
+    lock: FileLock
 
     def __init__(self):
         self.cfg = None
         self.db = None
         self.lock = None
         self.psql_config = None
-        self.netlink = None
-        self.ros = None
+        self._managers: ty.Optional[ty.List[Manager]] = None
         self.network_service = None
 
     def connect(self):
-        from .routing import LinuxRouteManager, RouterosManager
+        self.network_service = self.create_service()
 
-        self.netlink = LinuxRouteManager.fromconf(self.cfg)
-        ros = self.cfg.get("routeros")
-        self.ros = RouterosManager.fromconf(ros)
-        self.network_service = NetworkingService(self.psql_config)
+    def create_service(self) -> BaseNetworkingService:
+        """ Creates storage service of the configured backend. """
+        if self.cfg.db_backend == "local":
+            from .local import LocalNetworkingService
+
+            return LocalNetworkingService(self.cfg.db_file)
+        if self.psql_config is None:
+            raise KeyError("Configuration for 'postgresql' not found")
+        return NetworkingService(self.psql_config)
 
     def disconnect(self):
-        self.netlink.close()
-        self.ros.disconnect()
+        for mgr in self._managers or ():
+            mgr.disconnect()
+        self._managers = None
 
     def read_config(self, file=None):
         from . import cfg
@@ -44,7 +51,9 @@ class VRoute:
         file = file or os.getenv("VROUTE_CONFIG")
         file = Path(file) if file else Path.home() / ".config/vroute.yml"
         self.cfg = cfg.Configuration(from_file=file)
-        self.psql_config = self.cfg["postgresql"]
+        self.psql_config = self.cfg.get("postgresql")
+        # synchronization lock shared by all vroute processes
+        self.lock = FileLock(self.cfg.lock_file)
 
     def request(self, method, url, params=None, data=None, json=None, check_resp=True):
         response = requests.request(
@@ -61,4 +70,9 @@ class VRoute:
 
     @property
     def managers(self) -> ty.Collection[Manager]:
-        return (self.netlink, self.ros)
+        """ Managers for all configured devices, connected on first access. """
+        from .routing import get_manager
+
+        if self._managers is None:
+            self._managers = [get_manager(x) for x in self.cfg.devices]
+        return self._managers
@@ -0,0 +1,200 @@
+"""
+Lossy aggregation of networks, to fit devices with limited capacity.
+
+Neighbours in the address order are merged into their common supernet,
+the one adding the least address space first, until the device limit is met.
+Merges adding nothing (siblings, covered networks) are always done.
+Candidate merges are kept in a heap and revalidated lazily, so it's O(n log n).
+Supernets never overlap excluded ranges.
+"""
+import bisect
+import heapq
+import logging
+import typing as ty
+
+from .packed import V6, Networks, pack
+
+log = logging.getLogger(__name__)
+
+# address, prefix length
+Span = ty.Tuple[int, int]
+
+
+class Aggregated:
+    """ Outcome of the aggregation. """
+
+    __slots__ = ("networks", "before", "swept", "swept6")
+
+    def __init__(self, networks: Networks, before: int, swept: int = 0, swept6: int = 0):
+        self.networks = networks
+        self.before = before
+        # addresses covered by supernets that aren't in the original networks
+        self.swept = swept
+        self.swept6 = swept6
+
+    def __repr__(self):
+        return f"<Aggregated({self.before} -> {len(self.networks)}, +{self.swept})>"
+
+
+class Aggregator:
+    """
+    Aggregates networks to at most `max_entries` entries of the device,
+    without the limit only merges adding nothing are done.
+    After these, the limit is shared by families in proportion to their entries.
+    """
+
+    def __init__(self, max_entries: ty.Optional[int], exclude: ty.Iterable[str] = ()):
+        if max_entries is not None and max_entries < 1:
+            raise ValueError(f"Invalid max_entries {max_entries}")
+        self.max_entries = max_entries
+        self.exclude = Networks.fromkeys(pack(x) for x in exclude)
+
+    @classmethod
+    def fromconf(cls, cfg: dict) -> "Aggregator":
+        if not cfg.get("max_entries"):
+            raise ValueError("Please specify max_entries of the aggregation.")
+        return cls(int(cfg["max_entries"]), cfg.get("exclude") or ())
+
+    def __call__(self, networks: Networks) -> Aggregated:
+        networks.sort()
+        v4 = [(x >> 8, x & 0xFF) for x in networks.v4]
+        v6 = [((x ^ V6) >> 8, x & 0xFF) for x in networks.v6]
+        exclude4 = ranges([(x >> 8, x & 0xFF) for x in self.exclude.v4], 32)
+        exclude6 = ranges([((x ^ V6) >> 8, x & 0xFF) for x in self.exclude.v6], 128)
+        # merges adding nothing go first, so the limit is shared by what's left
+        v4, _ = merge(v4, 32, len(v4), exclude4)
+        v6, _ = merge(v6, 128, len(v6), exclude6)
+        ceiling4, ceiling6 = len(v4), len(v6)
+        if self.max_entries is not None:
+            ceiling4, ceiling6 = share(self.max_entries, len(v4), len(v6))
+        v4, swept = merge(v4, 32, ceiling4, exclude4)
+        v6, swept6 = merge(v6, 128, ceiling6, exclude6)
+        result = Networks(sorted_=False)
+        for addr, plen in v4:
+            result.append(addr << 8 | plen)
+        for addr, plen in v6:
+            result.append(V6 | addr << 8 | plen)
+        result.sort()
+        if self.max_entries is not None and len(result) > self.max_entries:
+            log.warning(
+                "%s entries left after aggregation, above max_entries %s:"
+                " excluded ranges keep them apart.",
+                len(result), self.max_entries,
+            )
+        return Aggregated(result, len(networks), swept, swept6)
+
+
+def share(total: int, first: int, second: int) -> ty.Tuple[int, int]:
+    """
+    Splits `total` entries between families of `first` and `second` entries
+    in proportion to them.
+
+    >>> share(100, 300, 100), share(100, 1000, 1), share(100, 30, 20)
+    ((75, 25), (99, 1), (30, 20))
+    """
+    if first + second <= total:
+        return first, second
+    ceiling2 = max(total * second // (first + second), 1 if second else 0)
+    return total - ceiling2, ceiling2
+
+
+def ranges(spans: ty.Iterable[Span], bits: int) -> ty.List[Span]:
+    """ Returns sorted disjoint (first, last) address ranges of networks. """
+    result: ty.List[Span] = []
+    for addr, plen in sorted(spans):
+        last = addr + (1 << bits - plen) - 1
+        if result and addr <= result[-1][1] + 1:
+            result[-1] = (result[-1][0], max(result[-1][1], last))
+        else:
+            result.append((addr, last))
+    return result
+
+
+def merge(
+    spans: ty.Sequence[Span], bits: int, ceiling: int, exclude: ty.Sequence[Span] = ()
+) -> ty.Tuple[ty.List[Span], int]:
+    """
+    Merges sorted networks of the `bits` long addresses into at most `ceiling`
+    if `exclude` ranges allow, returns merged networks and how many addresses they added.
+    """
+    # nodes of the linked list in the address order, merged nodes are replaced by new ones
+    start: ty.List[int] = []
+    plen: ty.List[int] = []
+    covered: ty.List[int] = []
+    last = -1
+    for addr, length in spans:
+        # covered by the previous network
+        if addr <= last:
+            continue
+        start.append(addr)
+        plen.append(length)
+        covered.append(1 << bits - length)
+        last = addr + covered[-1] - 1
+    count = len(start)
+    prev = list(range(-1, count - 1))
+    next_ = list(range(1, count + 1))
+    if count:
+        next_[-1] = -1
+    alive = [True] * count
+    excluded = [x for x, _ in exclude]
+    # cost, supernet address and length, left and right nodes;
+    # cost is an upper bound, the supernet may cover more nodes by the time it's popped
+    heap: ty.List[ty.Tuple[int, int, int, int, int]] = []
+
+    def candidate(left: int, right: int) -> ty.Optional[ty.Tuple[int, int, int, int, int]]:
+        right_last = start[right] + (1 << bits - plen[right]) - 1
+        length = bits - (start[left] ^ right_last).bit_length()
+        addr = start[left] >> bits - length << bits - length
+        size = 1 << bits - length
+        i = bisect.bisect_right(excluded, addr + size - 1) - 1
+        if i >= 0 and exclude[i][1] >= addr:
+            return None
+        return size - covered[left] - covered[right], addr, length, left, right
+
+    for i in range(count - 1):
+        merge_ = candidate(i, i + 1)
+        if merge_ is not None:
+            heap.append(merge_)
+    heapq.heapify(heap)
+    swept = 0
+    while heap and (count > ceiling or heap[0][0] == 0):
+        cost, addr, length, left, right = heapq.heappop(heap)
+        if not (alive[left] and alive[right]):
+            continue
+        size = 1 << bits - length
+        total = covered[left] + covered[right]
+        while prev[left] != -1 and start[prev[left]] >= addr:
+            left = prev[left]
+            total += covered[left]
+        while next_[right] != -1 and start[next_[right]] < addr + size:
+            right = next_[right]
+            total += covered[right]
+        if size - total < cost:
+            heapq.heappush(heap, (size - total, addr, length, left, right))
+            continue
+        node = left
+        while True:
+            alive[node] = False
+            count -= 1
+            if node == right:
+                break
+            node = next_[node]
+        new = len(start)
+        start.append(addr)
+        plen.append(length)
+        covered.append(total)
+        alive.append(True)
+        prev.append(prev[left])
+        next_.append(next_[right])
+        if prev[new] != -1:
+            next_[prev[new]] = new
+        if next_[new] != -1:
+            prev[next_[new]] = new
+        count += 1
+        swept += size - total
+        for pair in ((prev[new], new), (new, next_[new])):
+            merge_ = candidate(*pair) if -1 not in pair else None
+            if merge_ is not None:
+                heapq.heappush(heap, merge_)
+    merged = sorted((start[x], plen[x]) for x in range(len(start)) if alive[x])
+    return merged, swept
@@ -0,0 +1,141 @@
+"""
+Export of networks through the BIRD routing daemon.
+
+Networks are rendered as static protocols into the file the BIRD
+configuration includes, then BIRD is reconfigured over its control socket
+(the one birdc talks to) and announces them to the router over BGP,
+so the router gets the whole set over one session, at once.
+Communities are added to the routes, the router matches them
+to mark the routes for the VPN.
+"""
+import logging
+import os
+import re
+import socket
+import typing as ty
+
+from .packed import Networks, unpack
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = "/run/bird/bird.ctl"
+HEADER = "# Generated by vroute, changes are overwritten.\n"
+# "0003 Reconfigured", "0002-Reading configuration from ..." or " continuation"
+REPLY = re.compile(r"(\d{4})([ -])(.*)")
+ROUTE = re.compile(r"\s*route\s+(\S+)\s")
+# codes of BIRD replies starting from this one are errors
+FIRST_ERROR = 8000
+
+
+class BirdError(RuntimeError):
+    """ BIRD rejected the command. """
+
+
+class BirdControl:
+    """ Client of the BIRD control socket, a connection per command. """
+
+    def __init__(self, path: str = DEFAULT_SOCKET, timeout: float = 60.0):
+        self.path = path
+        self.timeout = timeout
+
+    def request(self, command: str) -> ty.List[str]:
+        """ Sends the command, returns lines of the reply or raises BirdError. """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            with sock.makefile("rw", encoding="utf-8", newline="\n") as fd:
+                # greeting: "0001 BIRD 2.0.12 ready."
+                self._read(fd)
+                fd.write(command + "\n")
+                fd.flush()
+                return self._read(fd)
+
+    def _read(self, fd: ty.TextIO) -> ty.List[str]:
+        lines = []
+        for line in fd:
+            line = line.rstrip("\n")
+            match = REPLY.fullmatch(line)
+            if match is None:
+                # continuation of the previous line
+                lines.append(line[1:])
+                continue
+            code, more, text = match.groups()
+            lines.append(text)
+            if more == " ":
+                if int(code) >= FIRST_ERROR:
+                    raise BirdError("\n".join(lines))
+                return lines
+        raise BirdError("Connection closed by BIRD")
+
+    def configure(self) -> str:
+        """ Reloads configuration, BIRD keeps the old one if the new one is invalid. """
+        return self.request("configure")[-1]
+
+
+def communities(values: ty.Iterable[str]) -> ty.List[str]:
+    """ Returns filter statements adding "asn:value" or "asn:value:value" communities. """
+    result = []
+    for value in values:
+        parts = [int(x) for x in str(value).split(":")]
+        if len(parts) == 2:
+            result.append(f"bgp_community.add(({parts[0]}, {parts[1]}));")
+        elif len(parts) == 3:
+            result.append(f"bgp_large_community.add(({parts[0]}, {parts[1]}, {parts[2]}));")
+        else:
+            raise ValueError(f"Invalid BGP community {value!r}")
+    return result
+
+
+def render(
+    fd: ty.TextIO,
+    networks: Networks,
+    protocol: str,
+    route_to: str = "blackhole",
+    statements: ty.Sequence[str] = (),
+    table: ty.Optional[str] = None,
+    ipv6: bool = False,
+):
+    """ Writes networks as static protocols `<protocol>4` and `<protocol>6`. """
+    fd.write(HEADER)
+    families = [("4", networks.only_v4())]
+    if ipv6:
+        families.append(("6", networks.v6))
+    for family, keys in families:
+        fd.write(f"protocol static {protocol}{family} {{\n    ipv{family} {{\n")
+        if table:
+            fd.write(f"        table {table}{family};\n")
+        if statements:
+            fd.write(f"        import filter {{ {' '.join(statements)} accept; }};\n")
+        fd.write("    };\n")
+        for key in keys:
+            fd.write(f"    route {unpack(key)} {route_to};\n")
+        fd.write("}\n")
+
+
+def parse(fd: ty.TextIO) -> ty.Iterator[str]:
+    """ Yields networks of the rendered file. """
+    for line in fd:
+        match = ROUTE.match(line)
+        if match is not None:
+            yield match.group(1)
+
+
+def replace(path: str, write: ty.Callable[[ty.TextIO], None]) -> ty.Optional[str]:
+    """
+    Atomically replaces the file with the new content,
+    returns path of the previous one to restore, if it existed.
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as fd:
+        write(fd)
+        fd.flush()
+        os.fsync(fd.fileno())
+    previous = None
+    if os.path.exists(path):
+        # a link, so BIRD never sees the file missing
+        previous = f"{path}.old"
+        if os.path.exists(previous):
+            os.unlink(previous)
+        os.link(path, previous)
+    os.replace(tmp, path)
+    return previous
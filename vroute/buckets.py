@@ -0,0 +1,80 @@
+"""
+Buckets of the address space, for cheap comparison of network sets.
+
+Networks are grouped by the first `bits` bits of their address,
+every bucket is summarized by the count of networks and
+an order-independent hash, so two sets are compared bucket by bucket
+without transferring networks, and only differing buckets are fetched.
+"""
+import typing as ty
+
+from .packed import MASK64, V6, Networks, pack, unpack
+
+# is IPv6, prefix of the address
+Bucket = ty.Tuple[bool, int]
+# bucket -> count and hash of its networks, hash is None if the device can't compute it
+Summary = ty.Dict[Bucket, ty.Tuple[int, ty.Optional[int]]]
+
+TAG_PREFIX = "vroute:"
+
+
+def _mix(key: int) -> int:
+    """ splitmix64 finalizer of the key folded into 64 bits. """
+    x = (key ^ key >> 64 ^ key >> 128) & MASK64
+    x = (x ^ x >> 30) * 0xBF58476D1CE4E5B9 & MASK64
+    x = (x ^ x >> 27) * 0x94D049BB133111EB & MASK64
+    return x ^ x >> 31
+
+
+class Buckets:
+    """ Splits IPv4 space by the first `bits` bits, IPv6 space by the first `bits6`. """
+
+    def __init__(self, bits: int = 8, bits6: int = 16):
+        if not 0 <= bits <= 32 or not 0 <= bits6 <= 128:
+            raise ValueError(f"Invalid bucket bits {bits}, {bits6}")
+        self.bits = bits
+        self.bits6 = bits6
+
+    def of(self, key: int) -> Bucket:
+        """ Returns bucket of the network, wider networks belong to the bucket of their start. """
+        if key & V6:
+            return True, (key ^ V6) >> (8 + 128 - self.bits6)
+        return False, key >> (8 + 32 - self.bits)
+
+    def network(self, bucket: Bucket) -> str:
+        v6, prefix = bucket
+        if v6:
+            return unpack(V6 | prefix << (8 + 128 - self.bits6) | self.bits6)
+        return unpack(prefix << (8 + 32 - self.bits) | self.bits)
+
+    def tag(self, bucket: Bucket) -> str:
+        """ Marks device entries of the bucket, so they are counted without dumping. """
+        return TAG_PREFIX + self.network(bucket)
+
+    def tag_of(self, network: str) -> str:
+        return self.tag(self.of(pack(network)))
+
+    def summarize(self, networks: ty.Iterable[int]) -> Summary:
+        counts: ty.Dict[Bucket, int] = {}
+        hashes: ty.Dict[Bucket, int] = {}
+        for key in networks:
+            bucket = self.of(key)
+            counts[bucket] = counts.get(bucket, 0) + 1
+            hashes[bucket] = (hashes.get(bucket, 0) + _mix(key)) & MASK64
+        return {x: (count, hashes[x]) for x, count in counts.items()}
+
+    def select(self, networks: Networks, buckets: ty.Collection[Bucket]) -> Networks:
+        """ Returns networks of the buckets. """
+        buckets = set(buckets)
+        return Networks.fromkeys(x for x in networks if self.of(x) in buckets)
+
+
+def compare(expected: Summary, actual: Summary) -> ty.List[Bucket]:
+    """ Returns buckets with different counts, or different hashes if both are known. """
+    result = []
+    for bucket in sorted(expected.keys() | actual.keys()):
+        count, hash_ = expected.get(bucket, (0, 0))
+        their_count, their_hash = actual.get(bucket, (0, 0))
+        if count != their_count or (None not in (hash_, their_hash) and hash_ != their_hash):
+            result.append(bucket)
+    return result
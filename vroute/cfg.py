@@ -3,6 +3,7 @@ Configuration code: config file loading, environment variables, etc
 """
 
 from pathlib import Path
+import typing as ty
 
 from yaml import load
 
@@ -11,6 +12,8 @@ try:
 except ImportError:
     from yaml import Loader  # type: ignore
 
+from .util import dig
+
 
 class Configuration:
     def __init__(self, from_file=None):
@@ -41,7 +44,15 @@ class Configuration:
         if not url:
             folder = self.get_appdir()
             url = str(folder.joinpath("db.sqlite3").absolute())
-        return url
+        return str(Path(url).expanduser())
+
+    @property
+    def db_backend(self) -> str:
+        """ "postgresql" or "local" (SQLite in `db_file`), by default the first configured. """
+        backend = self.get("db.backend") or ("postgresql" if self.get("postgresql") else "local")
+        if backend not in ("postgresql", "local"):
+            raise ValueError(f"Unknown database backend {backend!r}.")
+        return backend
 
     @property
     def db_debug(self) -> bool:
@@ -51,6 +62,80 @@ class Configuration:
     def v6_enabled(self) -> bool:
         return bool(self.get("ipv6"))
 
+    @property
+    def diff_strategy(self) -> str:
+        return self.get("sync.diff") or "client"
+
+    @property
+    def prune(self) -> bool:
+        return bool(self.get("sync.prune"))
+
+    @property
+    def sync_workers(self) -> int:
+        return int(self.get("sync.workers") or 4)
+
+    @property
+    def sync_timeout(self) -> ty.Optional[float]:
+        timeout = self.get("sync.timeout")
+        return float(timeout) if timeout else None
+
+    @property
+    def sync_interval(self) -> ty.Optional[float]:
+        """ Interval of the daemon background sync in seconds, 0 disables it. """
+        interval = self.get("sync.interval")
+        return 600.0 if interval is None else float(interval)
+
+    @property
+    def sync_batch_size(self) -> int:
+        return int(self.get("sync.batch_size") or 1000)
+
+    @property
+    def sort_buffer(self) -> int:
+        """ How many device entries the merge diff sorts in memory before spilling to disk. """
+        return int(self.get("sync.sort_buffer") or 100000)
+
+    @property
+    def journal_dir(self) -> Path:
+        folder = self.get("sync.journal_dir")
+        return Path(folder) if folder else self.get_appdir().joinpath("journal")
+
+    @property
+    def devices(self) -> ty.List[dict]:
+        """
+        Returns list of device definitions.
+        Without `devices` section falls back to the `vpn` and `routeros` sections.
+        Every route set of the device `sets` is a device of its own named
+        `<device>:<set>`, with the settings of the set overriding device ones.
+        """
+        defined = [dict(x) for x in self.get("devices") or ()]
+        if not defined:
+            if self.get("vpn"):
+                defined.append({"type": "linux", **self.get("vpn")})
+            if self.get("routeros"):
+                defined.append({"type": "routeros", **self.get("routeros")})
+        devices = []
+        for device in defined:
+            if "type" not in device:
+                raise ValueError(f"Specify type of the device {device.get('name')!r}.")
+            device.setdefault("name", device["type"])
+            sets = device.pop("sets", None) or {}
+            devices.append(device)
+            for name, overrides in sets.items():
+                name_ = f"{device['name']}:{name}"
+                devices.append({**device, **(overrides or {}), "name": name_, "set": name})
+        for device in devices:
+            device.setdefault("ipv6", self.v6_enabled)
+            if device.get("aggregate"):
+                # supernets never cover globally excluded networks either
+                aggregate = device["aggregate"] = dict(device["aggregate"])
+                aggregate["exclude"] = [
+                    *(self.get("exclude") or ()), *(aggregate.get("exclude") or ())
+                ]
+        names = [x["name"] for x in devices]
+        if len(set(names)) != len(names):
+            raise ValueError("Device names must be unique.")
+        return devices
+
     @property
     def listen_port(self):
         return self.get("listen_port") or "1015"
@@ -70,15 +155,7 @@ class Configuration:
         >>> config.get("test.not.exist")
         None
         """
-        keys = pth.split(".")
-        if not keys:
-            return None
-        val = self.file.get(keys.pop(0))
-        for key in keys:
-            if not hasattr(val, "get"):
-                return None
-            val = val.get(key)
-        return val
+        return dig(self.file, pth)
 
     def __getitem__(self, key):
         val = self.get(key)
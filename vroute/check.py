@@ -0,0 +1,99 @@
+"""
+Drift detection: devices are compared with the database by buckets
+of the address space (see buckets.py), and only differing buckets
+are fetched and repaired.
+"""
+import asyncio
+import logging
+import time
+import typing as ty
+
+from . import packed
+from .buckets import compare
+from .routing import Manager, as_batch
+from .services import BaseNetworkingService
+
+log = logging.getLogger(__name__)
+
+
+class CheckResult:
+    """ Outcome of the device check. """
+
+    __slots__ = ("device", "buckets", "differing", "added", "removed", "elapsed", "error")
+
+    def __init__(self, device: str):
+        self.device = device
+        self.buckets = 0
+        # networks of differing buckets
+        self.differing: ty.List[str] = []
+        self.added = 0
+        self.removed = 0
+        self.elapsed = 0.0
+        self.error: ty.Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def asdict(self) -> dict:
+        return {x: getattr(self, x) for x in self.__slots__}
+
+    def __repr__(self):
+        return f"<CheckResult({self.device!r}, {len(self.differing)} of {self.buckets} differ)>"
+
+
+async def check(
+    service: BaseNetworkingService,
+    managers: ty.Iterable[Manager],
+    repair: bool = False,
+    prune: bool = False,
+) -> ty.List[CheckResult]:
+    """
+    Checks all devices against networks of their route sets, fetched once.
+    If `repair` is set, differing buckets are synchronized,
+    outdated networks are removed only if `prune` is set.
+    """
+    sets = await service.fetch_sets()
+    results = []
+    for mgr in managers:
+        result = CheckResult(mgr.name)
+        start = time.monotonic()
+        try:
+            desired = sets.get(mgr.route_set, packed.Networks())
+            await check_device(mgr, desired, result, repair, prune)
+        except Exception as exc:  # pylint:disable=broad-except
+            log.exception("Failed to check %s:", result.device)
+            result.error = str(exc) or type(exc).__name__
+        result.elapsed = time.monotonic() - start
+        results.append(result)
+    return results
+
+
+async def check_device(
+    mgr: Manager, desired: packed.Networks, result: CheckResult, repair: bool, prune: bool
+):
+    loop = asyncio.get_event_loop()
+    if not getattr(mgr, "ipv6", False):
+        desired = desired.only_v4()
+    desired = mgr.fit(desired).networks
+    buckets = mgr.buckets
+    expected = buckets.summarize(desired)
+    actual = await loop.run_in_executor(None, mgr.summarize, expected.keys())
+    differing = compare(expected, actual)
+    result.buckets = len(expected.keys() | actual.keys())
+    result.differing = [buckets.network(x) for x in differing]
+    log.info("%s buckets of %s differ: %s", len(differing), mgr.name, result.differing)
+    if not repair:
+        return
+    if mgr.untagged:
+        tagged = await loop.run_in_executor(None, mgr.tag_buckets, desired)
+        log.info("Tagged %s entries of %s by buckets.", tagged, mgr.name)
+        if mgr.untagged:
+            log.info("%s entries of %s aren't vroute's, left untagged.", mgr.untagged, mgr.name)
+    if not differing:
+        return
+    theirs = await loop.run_in_executor(None, mgr.bucket_networks, differing)
+    adds, removes = buckets.select(desired, differing).diff(theirs)
+    if not prune:
+        removes = packed.Networks()
+    result.added, result.removed = await as_batch(mgr).apply(adds, removes)
@@ -5,7 +5,13 @@ import time
 
 import click
 
-from . import VRoute, __version__
+from . import VRoute, __version__, mrt
+from .aggregate import Aggregator
+from .check import check as check_devices
+from .lock import LockedError
+from .packed import Networks, unpack
+from .services import DEFAULT_SOURCE, DIFF_STRATEGIES
+from .sync import Syncer
 
 
 levels = [logging.WARNING, logging.INFO, logging.DEBUG]
@@ -30,26 +36,111 @@ def cli(ctx, config, verbose):
     logging.basicConfig(level=level)
     try:
         ctx.obj = get_vroute(cfg_file=config)
+        ctx.obj.connect()
     except KeyError as exc:
         click.echo(f"Failed to configure: \n{exc}")
         ctx.exit(1)
-    ctx.obj.connect()
 
 
 @cli.command("load-networks")
 @click.argument("file", type=click.File("r"))
+@click.option("--source", default=DEFAULT_SOURCE, help="Name of the feed networks come from.")
+@click.option(
+    "--replace",
+    is_flag=True,
+    help="Replace networks of the source, removing ones missing in the file.",
+)
+@click.option("--set", "route_set", help="Route set of the source, see `sets` of devices.")
 @pass_app
-def load_networks(app, file):
-    exclude = set(app.cfg.get("exclude"))
-    count, exists = asyncio.run(
-        app.network_service.load_networks(
-            filter(lambda x: x.strip() not in exclude, file)
-        )
-    )
+def load_networks(app, file, source, replace, route_set):
+    if source == DEFAULT_SOURCE and (replace or route_set):
+        click.echo(f"Specify --source to {'replace' if replace else 'assign the set'}.")
+        click.get_current_context().exit(1)
+    lines = without_excluded(app, file)
+    service = app.network_service
+    if replace:
+        added, removed = run_async(app, service.replace_networks(lines, source, route_set))
+        click.echo(f"Added {added} and removed {removed} routes of {source} in database.")
+        return
+    count, exists = run_async(app, service.load_networks(lines, source, route_set))
     click.echo(f"Added {count} routes in database.")
     click.echo(f"{exists} routes skipped.")
 
 
+@cli.command("load-asn")
+@click.argument("asns", nargs=-1, required=True)
+@click.option(
+    "--rib",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="MRT TABLE_DUMP_V2 routing table dump, may be compressed with bzip2 or gzip.",
+)
+@click.option("--source", help="Name of the source, the AS numbers by default.")
+@click.option("--set", "route_set", help="Route set of the source, see `sets` of devices.")
+@pass_app
+def load_asn(app, asns, rib, source, route_set):
+    """ Replaces networks of the source with aggregated prefixes the ASes originate. """
+    try:
+        numbers = sorted({mrt.parse_asn(x) for x in asns})
+    except ValueError as exc:
+        raise click.BadParameter(str(exc), param_hint="ASNS")
+    source = source or ",".join(f"AS{x}" for x in numbers)
+    start = time.time()
+    with mrt.open_dump(rib) as fd:
+        networks = Networks.fromkeys(mrt.originated(fd, numbers))
+    aggregator = Aggregator(None, app.cfg.get("exclude") or ())
+    networks, _ = networks.diff(aggregator.exclude)
+    aggregated = aggregator(networks)
+    click.echo(
+        f"Found {aggregated.before} prefixes of {source} in {time.time() - start:.2f} seconds,"
+        f" {len(aggregated.networks)} after aggregation."
+    )
+    lines = map(unpack, aggregated.networks)
+    added, removed = run_async(
+        app, app.network_service.replace_networks(lines, source, route_set)
+    )
+    click.echo(f"Added {added} and removed {removed} routes of {source} in database.")
+
+
+@cli.command("remove-networks")
+@click.argument("file", type=click.File("r"), required=False)
+@click.option(
+    "--covered-by",
+    multiple=True,
+    metavar="PREFIX",
+    help="Remove networks within the prefix as well, may be repeated.",
+)
+@pass_app
+def remove_networks(app, file, covered_by):
+    if file is None and not covered_by:
+        click.echo("Specify FILE or --covered-by.")
+        click.get_current_context().exit(1)
+    lines = without_excluded(app, file or ())
+    removed, missing = run_async(
+        app, app.network_service.remove_networks(lines, covered_by)
+    )
+    click.echo(f"Removed {removed} routes from database.")
+    click.echo(f"{missing} routes not found.")
+
+
+def run_async(app: VRoute, coro):
+    """ Runs the coroutine, closing connections of the service before its loop ends. """
+
+    async def main():
+        try:
+            return await coro
+        finally:
+            await app.network_service.close()
+
+    return asyncio.run(main())
+
+
+def without_excluded(app, lines):
+    """ Skips lines of networks excluded in the configuration. """
+    exclude = set(app.cfg.get("exclude") or ())
+    return filter(lambda x: x.strip() not in exclude, lines)
+
+
 # @cli.command()
 # @pass_app
 # def show(app):
@@ -72,14 +163,114 @@ def load_networks(app, file):
 
 
 @cli.command()
+@click.option(
+    "--diff",
+    type=click.Choice(DIFF_STRATEGIES),
+    help="Where to compute the difference: in Python, in PostgreSQL"
+    " or by merging sorted streams in constant memory.",
+)
+@click.option("--prune/--no-prune", default=None, help="Remove outdated networks.")
+@click.option(
+    "--wait/--no-wait",
+    default=True,
+    help="Wait for running synchronization to finish or exit immediately.",
+)
+@pass_app
+def sync(app: VRoute, diff, prune, wait):
+    try:
+        app.lock.acquire(blocking=wait)
+    except LockedError as exc:
+        click.echo(f"Synchronization is already running: {exc}")
+        click.get_current_context().exit(1)
+    try:
+        _sync(app, diff, prune)
+    finally:
+        app.lock.release()
+
+
+def _sync(app: VRoute, diff, prune):
+    syncer = Syncer.fromconf(app.cfg, app.network_service, prune=prune, strategy=diff)
+    failed = False
+    for result in run_async(app, syncer.run()):
+        if not result.ok:
+            failed = True
+            click.echo(f"Failed to synchronize {result.device}: {result.error}")
+            continue
+        resumed = " (resumed)" if result.resumed else ""
+        click.echo(
+            f"Added {result.added} and removed {result.removed} {result.device}"
+            f" routes in {result.elapsed:.2f} seconds{resumed}."
+        )
+        if result.swept or result.swept6:
+            click.echo(
+                f"Aggregation swept in {result.swept} IPv4"
+                f" and {result.swept6} IPv6 addresses."
+            )
+    if failed:
+        click.get_current_context().exit(1)
+
+
+@cli.command()
+@click.option("--repair", is_flag=True, help="Synchronize buckets that differ.")
+@click.option("--prune/--no-prune", default=None, help="Remove outdated networks on repair.")
+@pass_app
+def check(app: VRoute, repair, prune):
+    """
+    Compares devices with the database by counts and hashes of address space buckets,
+    without dumping devices. Exits with 1 if any of them has drifted.
+    """
+    prune = app.cfg.prune if prune is None else prune
+    if repair:
+        # repair must not race with synchronization
+        app.lock.acquire()
+    try:
+        results = run_async(
+            app, check_devices(app.network_service, app.managers, repair=repair, prune=prune)
+        )
+    finally:
+        if repair:
+            app.lock.release()
+        app.disconnect()
+    drifted = False
+    for result in results:
+        if not result.ok:
+            drifted = True
+            click.echo(f"Failed to check {result.device}: {result.error}")
+            continue
+        if not result.differing:
+            click.echo(f"{result.device}: {result.buckets} buckets match.")
+            continue
+        click.echo(
+            f"{result.device}: {len(result.differing)} of {result.buckets} buckets differ:"
+            f" {', '.join(result.differing)}"
+        )
+        if repair:
+            click.echo(f"Added {result.added} and removed {result.removed} routes.")
+        else:
+            drifted = True
+    if drifted:
+        click.get_current_context().exit(1)
+
+
+@cli.command()
+@pass_app
+def serve(app: VRoute):
+    """ Runs HTTP API with periodic background synchronization. """
+    from . import web
+
+    web.run(app)
+
+
+@cli.command("dns-proxy")
 @pass_app
-def sync(app: VRoute):
-    for mgr in app.managers:
-        start = time.time()
-        asyncio.run(app.network_service.export(mgr))
-        elapsed = time.time() - start
-        click.echo(f"Added {mgr.name} routes in {elapsed:.2f} seconds.")
-        mgr.disconnect()
+def dns_proxy(app: VRoute):
+    """ Forwards DNS queries, routing addresses of configured domains before answering. """
+    from . import dnsproxy
+
+    try:
+        dnsproxy.run(app)
+    finally:
+        app.disconnect()
 
 
 def main():
@@ -0,0 +1,472 @@
+"""
+DNS forwarder routing resolved addresses on the fly.
+
+Queries are forwarded to the upstream resolver over UDP. Answers to names
+within the configured domains are routed on every device before they are
+returned, so clients never reach an address that isn't routed yet.
+Addresses of concurrent answers are sent to devices by batches, one batch
+at a time; the next one gathers while the previous is applied.
+Answers are cached for their TTL, cache hits aren't forwarded or routed again.
+Routed addresses are recorded in the database under their own source,
+so synchronization with pruning keeps them.
+"""
+import asyncio
+import logging
+import struct
+import time
+import typing as ty
+
+from . import VRoute
+from .packed import V6, Networks, is_v6, pack, unpack
+from .routing import DEFAULT_SET, Manager, as_batch
+from .services import BaseNetworkingService
+
+log = logging.getLogger(__name__)
+
+HEADER = struct.Struct(">HHHHHH")
+# type, class, TTL, data length of the resource record
+RECORD = struct.Struct(">HHIH")
+TTL = struct.Struct(">I")
+TYPE_A = 1
+TYPE_AAAA = 28
+TYPE_OPT = 41
+FLAG_TRUNCATED = 0x0200
+RCODE = 0x000F
+MAX_POINTERS = 32
+# queries waiting for the upstream, by 16-bit IDs
+MAX_QUERIES = 0xFFFF
+
+
+class Answer:
+    """ Addresses of the response and offsets of TTLs to age its cached copy. """
+
+    __slots__ = ("addresses", "ttl", "offsets")
+
+    def __init__(self, addresses: ty.List[int], ttl: ty.Optional[int], offsets: ty.List[int]):
+        self.addresses = addresses
+        # the lowest TTL of the records, None without records
+        self.ttl = ttl
+        self.offsets = offsets
+
+
+def question(data: bytes) -> ty.Tuple[bytes, bytes]:
+    """ Returns the name of the only question in lowercase and the cache key of the query. """
+    _, _, qdcount, _, _, _ = HEADER.unpack_from(data)
+    if qdcount != 1:
+        raise ValueError(f"{qdcount} questions")
+    name, pos = read_name(data, HEADER.size)
+    return name, data[pos : pos + 4] + name
+
+
+def read_name(data: bytes, pos: int) -> ty.Tuple[bytes, int]:
+    """ Returns the dotted name at `pos` in lowercase and the position after it. """
+    labels = []
+    end = None
+    for _ in range(MAX_POINTERS):
+        while True:
+            length = data[pos]
+            if length >= 0xC0:
+                break
+            if not length:
+                return b".".join(labels).lower(), end if end is not None else pos + 1
+            labels.append(data[pos + 1 : pos + 1 + length])
+            pos += 1 + length
+        # compression pointer
+        if end is None:
+            end = pos + 2
+        pos = (length & 0x3F) << 8 | data[pos + 1]
+    raise ValueError("Too many compression pointers")
+
+
+def skip_name(data: bytes, pos: int) -> int:
+    while True:
+        length = data[pos]
+        if length >= 0xC0:
+            return pos + 2
+        if not length:
+            return pos + 1
+        pos += 1 + length
+
+
+def parse_answer(data: bytes) -> Answer:
+    """ Parses addresses of A and AAAA records and TTLs of all records. """
+    _, _, qdcount, ancount, nscount, arcount = HEADER.unpack_from(data)
+    pos = HEADER.size
+    for _ in range(qdcount):
+        pos = skip_name(data, pos) + 4
+    addresses = []
+    offsets = []
+    ttl = None
+    for i in range(ancount + nscount + arcount):
+        pos = skip_name(data, pos)
+        type_, _, record_ttl, length = RECORD.unpack_from(data, pos)
+        rdata = pos + RECORD.size
+        if rdata + length > len(data):
+            raise ValueError("Truncated record")
+        # TTL of OPT pseudo-record holds flags
+        if type_ != TYPE_OPT:
+            offsets.append(pos + 4)
+            ttl = record_ttl if ttl is None else min(ttl, record_ttl)
+        if i < ancount:
+            if type_ == TYPE_A and length == 4:
+                addresses.append(int.from_bytes(data[rdata : rdata + 4], "big") << 8 | 32)
+            elif type_ == TYPE_AAAA and length == 16:
+                addresses.append(V6 | int.from_bytes(data[rdata : rdata + 16], "big") << 8 | 128)
+        pos = rdata + length
+    return Answer(addresses, ttl, offsets)
+
+
+class Cache:
+    """ Responses by their questions, expiring with the lowest TTL of records. """
+
+    def __init__(self, size: int, max_ttl: int):
+        self.size = size
+        self.max_ttl = max_ttl
+        # key -> response, time it's stored, TTL, offsets of TTLs
+        self._entries: ty.Dict[bytes, ty.Tuple[bytes, float, int, ty.List[int]]] = {}
+
+    def get(self, key: bytes, query_id: bytes) -> ty.Optional[bytes]:
+        """ Returns the cached response with TTLs reduced by its age. """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        response, stored, ttl, offsets = entry
+        age = int(time.monotonic() - stored)
+        if age >= ttl:
+            del self._entries[key]
+            return None
+        buf = bytearray(response)
+        buf[:2] = query_id
+        if age:
+            for offset in offsets:
+                (value,) = TTL.unpack_from(buf, offset)
+                TTL.pack_into(buf, offset, max(value - age, 0))
+        return bytes(buf)
+
+    def put(self, key: bytes, response: bytes, answer: Answer):
+        if not answer.ttl or not self.size:
+            return
+        if len(self._entries) >= self.size and key not in self._entries:
+            # the oldest one
+            del self._entries[next(iter(self._entries))]
+        ttl = min(answer.ttl, self.max_ttl)
+        self._entries[key] = (response, time.monotonic(), ttl, answer.offsets)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Coverage:
+    """ Packed networks, telling whether the address is within any of them. """
+
+    def __init__(self, networks: Networks):
+        self.networks = networks
+        self.lengths4 = sorted({x & 0xFF for x in networks.v4})
+        self.lengths6 = sorted({x & 0xFF for x in networks.v6})
+        # host routes added since
+        self.added: ty.Set[int] = set()
+
+    def __contains__(self, key: int) -> bool:
+        if key in self.added:
+            return True
+        v6 = key & V6
+        bits = 128 if v6 else 32
+        addr = (key ^ v6) >> 8
+        for plen in self.lengths6 if v6 else self.lengths4:
+            if v6 | (addr >> bits - plen << bits - plen) << 8 | plen in self.networks:
+                return True
+        return False
+
+
+class Device:
+    """ Routes addresses on the device unless it has them already. """
+
+    def __init__(self, manager: Manager, installed: Networks):
+        self.batch = as_batch(manager)
+        self.name = manager.name
+        self.ipv6 = getattr(manager, "ipv6", False)
+        self.installed = Coverage(installed)
+
+    async def route(self, keys: ty.Iterable[int]) -> int:
+        adds = [x for x in keys if (self.ipv6 or not is_v6(x)) and x not in self.installed]
+        if adds:
+            await self.batch.apply(Networks.fromkeys(adds), Networks())
+            self.installed.added.update(adds)
+        return len(adds)
+
+
+class Router:
+    """
+    Routes addresses on all devices by batches. The batch is sent after `delay`
+    or when it has `max_batch` addresses, callers of the same batch share its future.
+    """
+
+    def __init__(
+        self,
+        devices: ty.List[Device],
+        exclude: Networks,
+        delay: float = 0.001,
+        max_batch: int = 500,
+        service: ty.Optional[BaseNetworkingService] = None,
+        source: str = "dns",
+        route_set: ty.Optional[str] = None,
+    ):
+        self.devices = devices
+        self.exclude = Coverage(exclude)
+        self.delay = delay
+        self.max_batch = max_batch
+        self.service = service
+        self.source = source
+        self.route_set = route_set
+        # addresses all devices have
+        self.routed: ty.Set[int] = set()
+        self._pending: ty.List[int] = []
+        self._future: ty.Optional[asyncio.Future] = None
+        self._inflight: ty.Dict[int, asyncio.Future] = {}
+        self._timer: ty.Optional[asyncio.TimerHandle] = None
+        self._task: ty.Optional[asyncio.Future] = None
+        self._unrecorded: ty.List[int] = []
+        self._recorder: ty.Optional[asyncio.Future] = None
+
+    def route(self, keys: ty.Iterable[int]) -> ty.Set[asyncio.Future]:
+        """ Returns futures of batches with the addresses, each is True if routed everywhere. """
+        futures = set()
+        for key in keys:
+            if key in self.routed or key in self.exclude:
+                continue
+            future = self._inflight.get(key)
+            if future is None:
+                if self._future is None:
+                    self._future = asyncio.get_event_loop().create_future()
+                    self._timer = asyncio.get_event_loop().call_later(self.delay, self._start)
+                future = self._inflight[key] = self._future
+                self._pending.append(key)
+            futures.add(future)
+        if len(self._pending) >= self.max_batch:
+            self._start()
+        return futures
+
+    def _start(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        # batches gathered while the previous one is applied are sent right after it
+        while self._pending:
+            keys, future = self._pending, self._future
+            self._pending, self._future = [], None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            ok = False
+            try:
+                ok = await self._apply(keys)
+            finally:
+                for key in keys:
+                    del self._inflight[key]
+                future.set_result(ok)
+        self._task = None
+
+    async def _apply(self, keys: ty.List[int]) -> bool:
+        start = time.monotonic()
+        results = await asyncio.gather(
+            *(x.route(keys) for x in self.devices), return_exceptions=True
+        )
+        ok = True
+        for device, result in zip(self.devices, results):
+            if isinstance(result, BaseException):
+                log.error("Failed to route %s addresses on %s: %s", len(keys), device.name, result)
+                ok = False
+            elif result:
+                log.debug("Routed %s addresses on %s", result, device.name)
+        log.debug("Batch of %s in %.1f ms", len(keys), (time.monotonic() - start) * 1000)
+        if ok:
+            self.routed.update(keys)
+            self._record(keys)
+        return ok
+
+    def _record(self, keys: ty.List[int]):
+        """ Loads routed addresses into the database in the background, by batches. """
+        if self.service is None:
+            return
+        self._unrecorded.extend(keys)
+        if self._recorder is None:
+            self._recorder = asyncio.ensure_future(self._load())
+
+    async def _load(self):
+        while self._unrecorded:
+            keys, self._unrecorded = self._unrecorded, []
+            try:
+                await self.service.load_networks(map(unpack, keys), self.source, self.route_set)
+            except Exception:
+                log.exception("Failed to record %s addresses in database", len(keys))
+        self._recorder = None
+
+    async def close(self):
+        if self._task is not None:
+            await self._task
+        if self._recorder is not None:
+            await self._recorder
+        if self.service is not None:
+            await self.service.close()
+
+
+class DNSProxy(asyncio.DatagramProtocol):
+    """ Forwarder of client queries, answers of `domains` are routed before they're sent. """
+
+    def __init__(
+        self,
+        router: Router,
+        domains: ty.Iterable[str],
+        cache: Cache,
+        timeout: float = 5.0,
+        route_timeout: float = 1.0,
+    ):
+        self.router = router
+        self.domains = {x.strip(".").lower().encode("idna") for x in domains}
+        self.cache = cache
+        self.timeout = timeout
+        self.route_timeout = route_timeout
+        self.transport: ty.Optional[asyncio.DatagramTransport] = None
+        self.upstream: ty.Optional[asyncio.DatagramTransport] = None
+        # upstream ID -> client address, client ID, cache key, whether to route, timeout
+        self._queries: ty.Dict[int, tuple] = {}
+        self._next_id = 0
+
+    def matches(self, name: bytes) -> bool:
+        """ Whether name is one of the domains or their subdomain. """
+        while True:
+            if name in self.domains:
+                return True
+            dot = name.find(b".")
+            if dot < 0:
+                return False
+            name = name[dot + 1 :]
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        """ Query of the client. """
+        try:
+            name, key = question(data)
+        except (ValueError, IndexError, struct.error) as exc:
+            log.debug("Dropped malformed query from %s: %s", addr, exc)
+            return
+        response = self.cache.get(key, data[:2])
+        if response is not None:
+            self.transport.sendto(response, addr)
+            return
+        if len(self._queries) >= MAX_QUERIES:
+            log.warning("Too many queries in flight, dropped one from %s", addr)
+            return
+        while self._next_id in self._queries:
+            self._next_id = (self._next_id + 1) & 0xFFFF
+        id_ = self._next_id
+        self._next_id = (id_ + 1) & 0xFFFF
+        expire = asyncio.get_event_loop().call_later(self.timeout, self._queries.pop, id_, None)
+        self._queries[id_] = (addr, data[:2], key, self.matches(name), expire)
+        self.upstream.sendto(struct.pack(">H", id_) + data[2:])
+
+    def response_received(self, data: bytes):
+        """ Response of the upstream. """
+        if len(data) < HEADER.size:
+            return
+        (id_,) = struct.unpack_from(">H", data)
+        query = self._queries.pop(id_, None)
+        if query is None:
+            log.debug("Response %s came too late or wasn't asked for", id_)
+            return
+        addr, client_id, key, route, expire = query
+        expire.cancel()
+        response = client_id + data[2:]
+        _, flags, _, _, _, _ = HEADER.unpack_from(data)
+        try:
+            answer = parse_answer(data)
+        except (ValueError, IndexError, struct.error) as exc:
+            log.debug("Malformed response to %s: %s", key, exc)
+            self.transport.sendto(response, addr)
+            return
+        cacheable = not flags & (RCODE | FLAG_TRUNCATED)
+        futures = self.router.route(answer.addresses) if route else None
+        if not futures:
+            if cacheable:
+                self.cache.put(key, data, answer)
+            self.transport.sendto(response, addr)
+            return
+        asyncio.ensure_future(self._respond(futures, response, addr, key, data, answer, cacheable))
+
+    async def _respond(self, futures, response, addr, key, data, answer, cacheable):
+        """ Sends the response once its addresses are routed, or on timeout anyway. """
+        done, pending = await asyncio.wait(futures, timeout=self.route_timeout)
+        if pending:
+            log.warning("Addresses of %s aren't routed in %s s", key, self.route_timeout)
+        elif cacheable and all(x.result() for x in done):
+            self.cache.put(key, data, answer)
+        self.transport.sendto(response, addr)
+
+
+class Upstream(asyncio.DatagramProtocol):
+    def __init__(self, proxy: DNSProxy):
+        self.proxy = proxy
+
+    def datagram_received(self, data: bytes, addr):
+        self.proxy.response_received(data)
+
+    def error_received(self, exc):
+        log.warning("Upstream error: %s", exc)
+
+
+async def serve(app: VRoute, cfg: dict):
+    """ Runs the proxy until cancelled, routing on devices of the `set` route set. """
+    exclude = Networks.fromkeys(pack(x) for x in app.cfg.get("exclude") or ())
+    route_set = cfg.get("set", DEFAULT_SET)
+    devices = []
+    for mgr in app.managers:
+        if mgr.route_set != route_set:
+            continue
+        devices.append(Device(mgr, await as_batch(mgr).networks()))
+        log.info("%s: %s networks routed", mgr.name, len(devices[-1].installed.networks))
+    router = Router(
+        devices,
+        exclude,
+        delay=float(cfg.get("batch_delay", 0.001)),
+        max_batch=int(cfg.get("max_batch", 500)),
+        service=app.create_service(),
+        source=cfg.get("source", "dns"),
+        route_set=cfg.get("set"),
+    )
+    proxy = DNSProxy(
+        router,
+        cfg["domains"],
+        Cache(int(cfg.get("cache_size", 10000)), int(cfg.get("max_ttl", 3600))),
+        timeout=float(cfg.get("timeout", 5)),
+        route_timeout=float(cfg.get("route_timeout", 1)),
+    )
+    loop = asyncio.get_event_loop()
+    listen = (cfg.get("listen", "127.0.0.1"), int(cfg.get("port", 5353)))
+    upstream = (cfg["upstream"], int(cfg.get("upstream_port", 53)))
+    transport, _ = await loop.create_datagram_endpoint(lambda: proxy, local_addr=listen)
+    proxy.upstream, _ = await loop.create_datagram_endpoint(
+        lambda: Upstream(proxy), remote_addr=upstream
+    )
+    log.info("Forwarding DNS queries from %s:%s to %s:%s", *listen, *upstream)
+    try:
+        await loop.create_future()
+    finally:
+        transport.close()
+        proxy.upstream.close()
+        await router.close()
+
+
+def run(app: VRoute):
+    cfg = app.cfg.get("dns_proxy")
+    if not cfg or not cfg.get("domains") or not cfg.get("upstream"):
+        raise ValueError("Please specify dns_proxy.upstream and dns_proxy.domains.")
+    try:
+        asyncio.run(serve(app, cfg))
+    except KeyboardInterrupt:
+        pass
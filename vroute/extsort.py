@@ -0,0 +1,57 @@
+"""
+External sort of packed networks, for devices dumping them in any order.
+
+Up to `buffer_size` entries are sorted in memory; if there are more,
+sorted runs are spilled into temporary files and merged,
+so memory use doesn't depend on the number of entries.
+Every entry may carry a tag (e.g. ID of the entry on the device).
+Run file is lines of zero-padded hexadecimal key and tag separated by a tab,
+lexicographic order of keys is the same as numeric one.
+"""
+import heapq
+import logging
+import tempfile
+import typing as ty
+
+log = logging.getLogger(__name__)
+
+Entry = ty.Tuple[int, str]
+# 137 bits of the IPv6 packed network
+KEY_DIGITS = 35
+
+
+def sort_entries(
+    entries: ty.Iterable[Entry], buffer_size: int = 100000, tmpdir: ty.Optional[str] = None
+) -> ty.Iterator[Entry]:
+    """ Yields entries sorted by key. """
+    buffer: ty.List[Entry] = []
+    runs: ty.List[ty.IO[str]] = []
+    try:
+        for entry in entries:
+            buffer.append(entry)
+            if len(buffer) >= buffer_size:
+                runs.append(_spill(buffer, tmpdir))
+                buffer = []
+        buffer.sort()
+        if not runs:
+            yield from buffer
+            return
+        log.debug("Merging %s sorted runs", len(runs) + bool(buffer))
+        yield from heapq.merge(buffer, *map(_read_run, runs))
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _spill(buffer: ty.List[Entry], tmpdir: ty.Optional[str]) -> ty.IO[str]:
+    buffer.sort()
+    run = tempfile.TemporaryFile("w+", dir=tmpdir)
+    run.writelines(f"{key:0{KEY_DIGITS}x}\t{tag}\n" for key, tag in buffer)
+    run.seek(0)
+    return run
+
+
+def _read_run(run: ty.IO[str]) -> ty.Iterator[Entry]:
+    for line in run:
+        key, _, tag = line.rstrip("\n").partition("\t")
+        yield int(key, 16), tag
@@ -0,0 +1,184 @@
+"""
+Progress journal of the device synchronization.
+
+Before changing the device, planned operations are written into the journal,
+then every confirmed batch is appended to it. If synchronization dies,
+the next one continues from the last confirmed batch.
+The journal is removed when synchronization finishes.
+
+File layout: magic, then records of
+type (1 byte), payload length (uint32), payload, CRC32 of the payload.
+Plan record payload is two encoded network collections, adds and removes:
+counts of IPv4 and IPv6 networks (2 x uint32), IPv4 packed networks,
+high and low halves of IPv6 addresses (little-endian uint64)
+and IPv6 prefix lengths (uint8).
+Batch record is operation kind (1 byte) and number of operations done (uint64).
+"""
+from array import array
+import logging
+import os
+from pathlib import Path
+import struct
+import sys
+import typing as ty
+import zlib
+
+from .packed import Networks
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"VRJ1"
+RECORD = struct.Struct("<cI")
+CRC = struct.Struct("<I")
+COUNTS = struct.Struct("<II")
+BATCH = struct.Struct("<cQ")
+
+PLAN = b"P"
+BATCH_DONE = b"B"
+ADD = b"a"
+REMOVE = b"r"
+
+
+class Plan:
+    """ Planned operations and how many of them are confirmed. """
+
+    __slots__ = ("to_add", "to_remove", "added", "removed")
+
+    def __init__(
+        self, to_add: Networks, to_remove: Networks, added: int = 0, removed: int = 0
+    ):
+        self.to_add = to_add
+        self.to_remove = to_remove
+        self.added = added
+        self.removed = removed
+
+    @property
+    def pending_adds(self) -> Networks:
+        return self.to_add[self.added :]
+
+    @property
+    def pending_removes(self) -> Networks:
+        return self.to_remove[self.removed :]
+
+    def __repr__(self):
+        return (
+            f"<Plan(added {self.added}/{len(self.to_add)},"
+            f" removed {self.removed}/{len(self.to_remove)})>"
+        )
+
+
+class Journal:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._fd: ty.Optional[ty.BinaryIO] = None
+
+    def load(self) -> ty.Optional[Plan]:
+        """ Returns plan of the unfinished synchronization, if there is any. """
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
+            return None
+        if not data.startswith(MAGIC):
+            log.warning("%s is not a journal, ignoring it.", self.path)
+            return None
+        plan = None
+        for kind, payload in _records(data, len(MAGIC)):
+            if kind == PLAN:
+                plan = _decode_plan(payload)
+            elif kind == BATCH_DONE and plan is not None:
+                op, done = BATCH.unpack(payload)
+                if op == ADD:
+                    plan.added = done
+                elif op == REMOVE:
+                    plan.removed = done
+        return plan
+
+    def begin(self, to_add: Networks, to_remove: Networks) -> Plan:
+        """ Starts the new journal with the planned operations. """
+        plan = Plan(to_add, to_remove)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.close()
+        self._fd = self.path.open("wb")
+        self._fd.write(MAGIC)
+        self._append(PLAN, _encode_plan(plan))
+        return plan
+
+    def resume(self):
+        """ Opens the existing journal for appending. """
+        self.close()
+        self._fd = self.path.open("ab")
+
+    def confirm(self, op: bytes, done: int):
+        """ Records that first `done` operations of the kind `op` are applied. """
+        self._append(BATCH_DONE, BATCH.pack(op, done))
+
+    def finish(self):
+        self.close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+    def _append(self, kind: bytes, payload: bytes):
+        self._fd.write(RECORD.pack(kind, len(payload)) + payload + CRC.pack(zlib.crc32(payload)))
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+
+
+def _records(data: bytes, pos: int) -> ty.Iterator[ty.Tuple[bytes, bytes]]:
+    """ Yields valid records, stops at the first torn or corrupted one. """
+    while pos + RECORD.size <= len(data):
+        kind, length = RECORD.unpack_from(data, pos)
+        start = pos + RECORD.size
+        end = start + length
+        if end + CRC.size > len(data):
+            log.warning("Journal is truncated, ignoring the last record.")
+            return
+        payload = data[start:end]
+        (crc,) = CRC.unpack_from(data, end)
+        if crc != zlib.crc32(payload):
+            log.warning("Journal record is corrupted, ignoring the rest.")
+            return
+        yield kind, payload
+        pos = end + CRC.size
+
+
+def _encode_plan(plan: Plan) -> bytes:
+    return _encode_networks(plan.to_add) + _encode_networks(plan.to_remove)
+
+
+def _decode_plan(payload: bytes) -> Plan:
+    to_add, pos = _decode_networks(payload, 0)
+    to_remove, _ = _decode_networks(payload, pos)
+    return Plan(to_add, to_remove)
+
+
+def _encode_networks(networks: Networks) -> bytes:
+    networks.sort()
+    result = [COUNTS.pack(len(networks.v4), len(networks.v6_len))]
+    for arr in (networks.v4, networks.v6_hi, networks.v6_lo, networks.v6_len):
+        if sys.byteorder == "big":
+            arr = array(arr.typecode, arr)
+            arr.byteswap()
+        result.append(arr.tobytes())
+    return b"".join(result)
+
+
+def _decode_networks(payload: bytes, pos: int) -> ty.Tuple[Networks, int]:
+    v4_count, v6_count = COUNTS.unpack_from(payload, pos)
+    pos += COUNTS.size
+    arrays = []
+    for typecode, count in (("Q", v4_count), ("Q", v6_count), ("Q", v6_count), ("B", v6_count)):
+        arr = array(typecode)
+        end = pos + count * arr.itemsize
+        arr.frombytes(payload[pos:end])
+        if sys.byteorder == "big":
+            arr.byteswap()
+        arrays.append(arr)
+        pos = end
+    return Networks(*arrays), pos
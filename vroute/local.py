@@ -0,0 +1,364 @@
+"""
+Local storage of networks in SQLite, for standalone installs without PostgreSQL.
+
+Networks are stored as packed keys (see packed.py) in fixed-size
+big-endian blobs, so the byte order of blobs is the order of networks
+and the primary key index is a sorted array of integers.
+The database file is memory-mapped, the schema mirrors the PostgreSQL one.
+Blocking SQLite calls run in a thread, by batches.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+import itertools
+import logging
+from operator import itemgetter
+import sqlite3
+import typing as ty
+
+from .packed import Networks, covered, pack, unpack
+from .routing import DEFAULT_SET, BatchManager
+from .services import COPY_BATCH, DEFAULT_SOURCE, BaseNetworkingService, _batches
+
+log = logging.getLogger(__name__)
+
+# 137 bits of the IPv6 packed network
+KEY_BYTES = 18
+MMAP_SIZE = 256 * 1024 * 1024
+# SQLite limits the number of parameters of the statement
+LOOKUP_BATCH = 500
+
+CREATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS networks (net BLOB PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sources (
+    name TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL DEFAULT 0,
+    loaded_at TEXT,
+    route_set TEXT NOT NULL DEFAULT 'default'
+);
+CREATE TABLE IF NOT EXISTS source_networks (
+    source TEXT NOT NULL REFERENCES sources ON DELETE CASCADE,
+    net BLOB NOT NULL,
+    generation INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (source, net)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS source_networks_net ON source_networks (net);
+"""
+# databases created before route sets
+ADD_ROUTE_SET = "ALTER TABLE sources ADD COLUMN route_set TEXT NOT NULL DEFAULT 'default';"
+CREATE_STAGED_TABLE = """
+CREATE TEMP TABLE IF NOT EXISTS staged_networks (net BLOB PRIMARY KEY) WITHOUT ROWID;
+"""
+CLEAR_STAGED_TABLE = "DELETE FROM staged_networks;"
+STAGE = "INSERT OR IGNORE INTO staged_networks VALUES (?);"
+CREATE_SOURCE = "INSERT OR IGNORE INTO sources (name) VALUES (?);"
+ASSIGN_SET = "UPDATE sources SET route_set = ? WHERE name = ?;"
+NEXT_GENERATION = """
+UPDATE sources SET generation = generation + 1, loaded_at = datetime('now') WHERE name = ?;
+"""
+GENERATION = "SELECT generation FROM sources WHERE name = ?;"
+INSERT_STAGED = """
+INSERT OR IGNORE INTO source_networks (source, net, generation)
+SELECT ?, net, ? FROM staged_networks;
+"""
+# networks which first appeared in the generation
+INSERT_GENERATION = """
+INSERT OR IGNORE INTO networks (net)
+SELECT net FROM source_networks WHERE source = ? AND generation = ?;
+"""
+# networks of the source no other source has, matching the condition on staged ones
+DELETE_ORPHANS = """
+DELETE FROM networks WHERE net IN (
+    SELECT s.net FROM source_networks s
+    WHERE s.source = ? AND {condition}
+    AND NOT EXISTS (
+        SELECT 1 FROM source_networks o WHERE o.net = s.net AND o.source <> s.source
+    )
+);
+"""
+STAGED = "EXISTS (SELECT 1 FROM staged_networks t WHERE t.net = s.net)"
+UNSTAGED = "NOT " + STAGED
+DELETE_SOURCE_NETWORKS = """
+DELETE FROM source_networks AS s WHERE s.source = ? AND {condition};
+"""
+# staged networks are removed from every source, covered ones are staged by key ranges
+UNMATCHED = """
+SELECT count(*) FROM staged_networks t
+WHERE NOT EXISTS (SELECT 1 FROM networks n WHERE n.net = t.net);
+"""
+ANY_BETWEEN = "SELECT 1 FROM networks WHERE net BETWEEN ? AND ? LIMIT 1;"
+STAGE_BETWEEN = """
+INSERT OR IGNORE INTO staged_networks SELECT net FROM networks WHERE net BETWEEN ? AND ?;
+"""
+REMOVE_STAGED = """
+DELETE FROM {table} WHERE net IN (SELECT net FROM staged_networks);
+"""
+FIRST_PAGE = "SELECT net FROM networks ORDER BY net LIMIT ?;"
+NEXT_PAGE = "SELECT net FROM networks WHERE net > ? ORDER BY net LIMIT ?;"
+ALL = "SELECT net FROM networks ORDER BY net;"
+# the default route set has networks no other set has
+ROUTE_SETS = "SELECT route_set FROM sources UNION SELECT 'default' ORDER BY 1;"
+SET_NETWORKS = """
+SELECT s.route_set, n.net FROM source_networks n JOIN sources s ON s.name = n.source
+WHERE s.route_set <> 'default'
+UNION
+SELECT 'default', n.net FROM networks n
+WHERE NOT EXISTS (
+    SELECT 1 FROM source_networks o JOIN sources s ON s.name = o.source
+    WHERE o.net = n.net AND s.route_set <> 'default'
+)
+ORDER BY 1, 2;
+"""
+EXISTING = "SELECT net FROM networks WHERE net IN ({});"
+
+
+def encode(key: int) -> bytes:
+    return key.to_bytes(KEY_BYTES, "big")
+
+
+def decode(blob: bytes) -> int:
+    return int.from_bytes(blob, "big")
+
+
+class LocalNetworkingService(BaseNetworkingService):
+    """ SQLite storage in the file `path`. """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @asynccontextmanager
+    async def connection(self) -> ty.AsyncIterator[sqlite3.Connection]:
+        """ Connection of the single call, so concurrent calls don't share transactions. """
+        conn = await self._run(self._connect)
+        try:
+            yield conn
+        finally:
+            await self._run(conn.close)
+
+    def _connect(self) -> sqlite3.Connection:
+        # transactions are explicit, the connection is used by executor threads one by one
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("PRAGMA foreign_keys = ON;")
+        conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE};")
+        conn.execute("PRAGMA busy_timeout = 30000;")
+        conn.executescript(CREATE_SCHEMA)
+        if "route_set" not in {x[1] for x in conn.execute("PRAGMA table_info(sources);")}:
+            conn.execute(ADD_ROUTE_SET)
+        return conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    def transaction(self, conn: sqlite3.Connection) -> "Transaction":
+        return Transaction(self, conn)
+
+    async def load_networks(
+        self,
+        file: ty.Union[ty.Iterable[str], ty.AsyncIterable[str]],
+        source: str = DEFAULT_SOURCE,
+        route_set: ty.Optional[str] = None,
+    ) -> ty.Tuple[int, int]:
+        """
+        Loads networks from file (or any iterable of lines) into the database,
+        returns how many added and how many already exists.
+        """
+        async with self.connection() as conn:
+            async with self.transaction(conn):
+                staged = await self._stage(conn, file)
+                count = await self._run(self._insert_staged, conn, source, route_set)
+        return count, staged - count
+
+    async def replace_networks(
+        self,
+        file: ty.Union[ty.Iterable[str], ty.AsyncIterable[str]],
+        source: str,
+        route_set: ty.Optional[str] = None,
+    ) -> ty.Tuple[int, int]:
+        """
+        Replaces networks of the source with the new generation from file,
+        returns how many networks added to and removed from the database.
+        """
+        async with self.connection() as conn:
+            async with self.transaction(conn):
+                staged = await self._stage(conn, file)
+                removed = await self._run(self._delete, conn, source, UNSTAGED)
+                added = await self._run(self._insert_staged, conn, source, route_set)
+        log.info(
+            "Source %s: %s networks, %s added, %s removed", source, staged, added, removed
+        )
+        return added, removed
+
+    async def delete_networks(
+        self,
+        file: ty.Union[ty.Iterable[str], ty.AsyncIterable[str]],
+        source: str = DEFAULT_SOURCE,
+    ) -> int:
+        async with self.connection() as conn:
+            async with self.transaction(conn):
+                await self._stage(conn, file)
+                removed = await self._run(self._delete, conn, source, STAGED)
+        log.info("Removed %s networks of source %s", removed, source)
+        return removed
+
+    async def remove_networks(
+        self,
+        file: ty.Union[ty.Iterable[str], ty.AsyncIterable[str]],
+        covered_by: ty.Iterable[str] = (),
+    ) -> ty.Tuple[int, int]:
+        """
+        Removes networks of the file and ones within `covered_by` prefixes
+        from every source, returns how many removed and how many not found.
+        """
+        ranges = [tuple(map(encode, covered(pack(x)))) for x in covered_by]
+        async with self.connection() as conn:
+            async with self.transaction(conn):
+                await self._stage(conn, file)
+                removed, missing = await self._run(self._remove, conn, ranges)
+        log.info("Removed %s networks, %s not found", removed, missing)
+        return removed, missing
+
+    async def _stage(self, conn: sqlite3.Connection, file) -> int:
+        """ Inserts lines into the temporary table by batches, returns their count. """
+        await self._run(conn.execute, CREATE_STAGED_TABLE)
+        await self._run(conn.execute, CLEAR_STAGED_TABLE)
+        staged = 0
+        async for batch in _batches(file, COPY_BATCH):
+            records = [(encode(x),) for x in batch]
+            await self._run(conn.executemany, STAGE, records)
+            staged += len(batch)
+        return staged
+
+    def _insert_staged(
+        self, conn: sqlite3.Connection, source: str, route_set: ty.Optional[str] = None
+    ) -> int:
+        """ Adds staged networks to the source as the new generation, returns how many added. """
+        conn.execute(CREATE_SOURCE, (source,))
+        if route_set is not None:
+            conn.execute(ASSIGN_SET, (route_set, source))
+        conn.execute(NEXT_GENERATION, (source,))
+        (generation,) = conn.execute(GENERATION, (source,)).fetchone()
+        conn.execute(INSERT_STAGED, (source, generation))
+        return conn.execute(INSERT_GENERATION, (source, generation)).rowcount
+
+    def _delete(self, conn: sqlite3.Connection, source: str, condition: str) -> int:
+        """ Removes networks of the source matching the condition, returns how many removed. """
+        removed = conn.execute(DELETE_ORPHANS.format(condition=condition), (source,))
+        conn.execute(DELETE_SOURCE_NETWORKS.format(condition=condition), (source,))
+        return removed.rowcount
+
+    def _remove(
+        self, conn: sqlite3.Connection, ranges: ty.List[ty.Tuple[bytes, bytes]]
+    ) -> ty.Tuple[int, int]:
+        """ Removes staged networks and ones in the key ranges, returns counts. """
+        (missing,) = conn.execute(UNMATCHED).fetchone()
+        for span in ranges:
+            if conn.execute(ANY_BETWEEN, span).fetchone() is None:
+                missing += 1
+            else:
+                conn.execute(STAGE_BETWEEN, span)
+        conn.execute(REMOVE_STAGED.format(table="source_networks"))
+        return conn.execute(REMOVE_STAGED.format(table="networks")).rowcount, missing
+
+    async def iter_networks(
+        self, after: ty.Optional[str] = None, page_size: int = 10000
+    ) -> ty.AsyncIterator[str]:
+        """ Streams networks in order, starting after `after`, by pages. """
+        start = encode(pack(after)) if after is not None else None
+        async with self.connection() as conn:
+            while True:
+                if start is None:
+                    rows = await self._run(self._fetch, conn, FIRST_PAGE, (page_size,))
+                else:
+                    rows = await self._run(self._fetch, conn, NEXT_PAGE, (start, page_size))
+                for (net,) in rows:
+                    yield unpack(decode(net))
+                if len(rows) < page_size:
+                    break
+                start = rows[-1][0]
+
+    def _fetch(self, conn: sqlite3.Connection, query: str, args: tuple) -> ty.List[tuple]:
+        return conn.execute(query, args).fetchall()
+
+    async def missing(
+        self, networks: Networks, after: ty.Optional[str] = None, batch: int = LOOKUP_BATCH
+    ) -> ty.AsyncIterator[str]:
+        """ Streams networks (after `after`) that aren't in the database. """
+        start = pack(after) if after else -1
+        async with self.connection() as conn:
+            chunk: ty.List[int] = []
+            for key in networks:
+                if key <= start:
+                    continue
+                chunk.append(key)
+                if len(chunk) < batch:
+                    continue
+                for network in await self._run(self._missing, conn, chunk):
+                    yield network
+                chunk = []
+            if chunk:
+                for network in await self._run(self._missing, conn, chunk):
+                    yield network
+
+    def _missing(self, conn: sqlite3.Connection, keys: ty.List[int]) -> ty.List[str]:
+        query = EXISTING.format(",".join("?" * len(keys)))
+        existing = {decode(x) for x, in conn.execute(query, [encode(x) for x in keys])}
+        return [unpack(x) for x in keys if x not in existing]
+
+    async def iter_packed(self, max_chunks: int = 4) -> ty.AsyncIterator[Networks]:
+        """ Streams networks from the database as chunks of packed integers. """
+        async with self.connection() as conn:
+            cursor = await self._run(conn.execute, ALL)
+            while True:
+                rows = await self._run(cursor.fetchmany, COPY_BATCH)
+                if not rows:
+                    break
+                chunk = Networks()
+                for (net,) in rows:
+                    chunk.append(decode(net))
+                yield chunk
+
+    async def route_sets(self) -> ty.List[str]:
+        async with self.connection() as conn:
+            return [x for x, in await self._run(self._fetch, conn, ROUTE_SETS, ())]
+
+    async def iter_sets(self, max_chunks: int = 4) -> ty.AsyncIterator[ty.Tuple[str, Networks]]:
+        """
+        Streams networks of route sets with one query ordered by set.
+        Without other sets the default one is the `networks` table.
+        """
+        if await self.route_sets() == [DEFAULT_SET]:
+            async for chunk in self.iter_packed(max_chunks):
+                yield DEFAULT_SET, chunk
+            return
+        async with self.connection() as conn:
+            cursor = await self._run(conn.execute, SET_NETWORKS)
+            while True:
+                rows = await self._run(cursor.fetchmany, COPY_BATCH)
+                if not rows:
+                    break
+                for name, group in itertools.groupby(rows, key=itemgetter(0)):
+                    chunk = Networks()
+                    for _, net in group:
+                        chunk.append(decode(net))
+                    yield name, chunk
+
+    async def _export_diff(self, batch: BatchManager, strategy: str, skip=None):
+        # the database is here, so "server" diff is computed here too
+        device = await batch.networks()
+        async for chunk in self._merge_join(iter(device), ipv6=skip is None):
+            yield chunk
+
+
+class Transaction:
+    """ Write transaction of the service connection, rolled back on errors. """
+
+    def __init__(self, service: LocalNetworkingService, conn: sqlite3.Connection):
+        self.service = service
+        self.conn = conn
+
+    async def __aenter__(self):
+        # the write lock is taken at once, so concurrent loads wait instead of failing
+        await self.service._run(self.conn.execute, "BEGIN IMMEDIATE;")
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.service._run(self.conn.execute, "ROLLBACK;" if exc_type else "COMMIT;")
@@ -0,0 +1,139 @@
+"""
+Locking of synchronization between processes and inside the daemon.
+"""
+import asyncio
+import fcntl
+import logging
+import os
+from pathlib import Path
+import typing as ty
+
+log = logging.getLogger(__name__)
+
+
+class LockedError(RuntimeError):
+    """ Lock is held by another process. """
+
+
+class FileLock:
+    """ Exclusive lock of the file, released by the OS if process dies. """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._fd: ty.Optional[int] = None
+
+    @property
+    def locked(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self, blocking: bool = True):
+        """ Acquires the lock, raises LockedError if not blocking and it's held. """
+        if self.locked:
+            raise RuntimeError("Lock is already acquired")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if not blocking:
+                    raise LockedError(f"{self.path} is locked by process {self.owner()}")
+                log.info("Waiting for process %s holding %s...", self.owner(), self.path)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+
+    async def acquire_async(self, interval: float = 0.5):
+        """ Acquires the lock without blocking the event loop. """
+        while True:
+            try:
+                return self.acquire(blocking=False)
+            except LockedError:
+                await asyncio.sleep(interval)
+
+    def release(self):
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def owner(self) -> str:
+        try:
+            return self.path.read_text().strip() or "?"
+        except OSError:
+            return "?"
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, value, tb):
+        self.release()
+
+
+class Coalescer:
+    """
+    Single-flight runner of the coroutine function.
+    Calls arriving while it runs are merged into exactly one follow-up run,
+    all of them get its result. If runs are cancelled by close(),
+    waiting calls raise CancelledError.
+    """
+
+    def __init__(self, func: ty.Callable[[], ty.Awaitable]):
+        self.func = func
+        self._current: ty.Optional[asyncio.Future] = None
+        self._pending: ty.Optional[asyncio.Future] = None
+        self._task: ty.Optional[asyncio.Future] = None
+        self.runs = 0
+
+    @property
+    def running(self) -> bool:
+        return self._current is not None
+
+    async def __call__(self):
+        loop = asyncio.get_event_loop()
+        if self._current is None:
+            self._current = loop.create_future()
+            future = self._current
+            self._task = asyncio.ensure_future(self._drive())
+        else:
+            if self._pending is None:
+                self._pending = loop.create_future()
+            future = self._pending
+        # cancelled caller must not cancel the run shared with others
+        return await asyncio.shield(future)
+
+    async def close(self):
+        """ Cancels the current run and the follow-up one. """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _drive(self):
+        try:
+            while self._current is not None:
+                future = self._current
+                self.runs += 1
+                try:
+                    result = await self.func()
+                except Exception as exc:  # pylint:disable=broad-except
+                    future.set_exception(exc)
+                    # don't complain if nobody waits for it anymore
+                    future.exception()
+                else:
+                    future.set_result(result)
+                self._current, self._pending = self._pending, None
+        finally:
+            # cancelled runs must not leave waiters hanging
+            for future in (self._current, self._pending):
+                if future is not None and not future.done():
+                    future.cancel()
+            self._current = self._pending = self._task = None
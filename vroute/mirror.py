@@ -0,0 +1,192 @@
+"""
+In-memory mirror of the kernel routing table, maintained from netlink events.
+
+The mirror subscribes to route and link multicast groups first, then dumps
+the table. Events are applied in order on top of the dump, and applying
+an event is idempotent, so ones that arrived while dumping don't break it.
+If the socket overruns (ENOBUFS), events are lost and the table is dumped again.
+"""
+import errno
+import logging
+import socket
+import threading
+import typing as ty
+
+import pyroute2
+from pyroute2.netlink.rtnl import RTMGRP_IPV4_ROUTE, RTMGRP_IPV6_ROUTE, RTMGRP_LINK
+
+from .models import Interface, Route
+
+log = logging.getLogger(__name__)
+
+# big receive buffer makes overruns during route storms less likely
+RCVBUF = 32 * 1024 * 1024
+
+
+class RouteMirror:
+    """
+    Keeps routes of the table and state of the interface up to date
+    in the background thread.
+    Route changes made by others than `own_ports` sockets are counted as drift.
+    `on_up` is called when the interface comes up again or is recreated.
+    `nexthops` returns IDs of nexthop objects pointing at the interface.
+    """
+
+    def __init__(
+        self,
+        table: int,
+        interface: str,
+        ipv6: bool = False,
+        own_ports: ty.Optional[ty.Callable[[], ty.Collection[int]]] = None,
+        on_up: ty.Optional[ty.Callable[[Interface], None]] = None,
+        nexthops: ty.Optional[ty.Callable[[], ty.Collection[int]]] = None,
+    ):
+        self.table = table
+        self.interface_name = interface
+        self.ipv6 = ipv6
+        self.own_ports = own_ports
+        self.on_up = on_up
+        self.nexthops = nexthops
+        self.interface: ty.Optional[Interface] = None
+        # network with netmask -> route
+        self.routes: ty.Dict[str, Route] = {}
+        self.synced = threading.Event()
+        self.resyncs = 0
+        self.drift = 0
+        self._lock = threading.Lock()
+        self._sock: ty.Optional[pyroute2.IPRoute] = None
+        self._thread: ty.Optional[threading.Thread] = None
+        self._stopped = False
+
+    @property
+    def families(self) -> ty.Tuple[int, ...]:
+        return (socket.AF_INET, socket.AF_INET6) if self.ipv6 else (socket.AF_INET,)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        groups = RTMGRP_IPV4_ROUTE | RTMGRP_LINK
+        if self.ipv6:
+            groups |= RTMGRP_IPV6_ROUTE
+        self._stopped = False
+        self._sock = pyroute2.IPRoute(rcvbuf=RCVBUF)
+        self._sock.bind(groups=groups)
+        self._thread = threading.Thread(target=self._run, name=f"mirror-{self.table}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self.synced.clear()
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def snapshot(self) -> ty.Optional[ty.List[Route]]:
+        """ Returns routes of the table, or None if the mirror isn't synced. """
+        with self._lock:
+            if not self.synced.is_set():
+                return None
+            return list(self.routes.values())
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                if not self.synced.is_set():
+                    self.resync()
+                for msg in self._sock.get():
+                    self.apply(msg)
+            except OSError as exc:
+                if self._stopped:
+                    return
+                if exc.errno != errno.ENOBUFS:
+                    log.exception("Route mirror of table %s stopped:", self.table)
+                    self.stop()
+                    return
+                log.warning("Netlink socket overrun, dumping table %s again.", self.table)
+                self.synced.clear()
+            except Exception:  # pylint:disable=broad-except
+                if self._stopped:
+                    return
+                log.exception("Route mirror of table %s stopped:", self.table)
+                self.stop()
+                return
+
+    def resync(self):
+        """ Replaces the mirror with the dump of the table. """
+        family = 255 if self.ipv6 else socket.AF_INET
+        with pyroute2.IPRoute() as ipr:
+            routes = map(Route.fromdict, ipr.get_routes(family=family, table=self.table))
+            routes = {x.with_netmask(): x for x in routes}
+            interfaces = [
+                x for x in map(Interface, ipr.get_links()) if x.name == self.interface_name
+            ]
+        with self._lock:
+            self.routes = routes
+            previous, self.interface = self.interface, interfaces[0] if interfaces else None
+            self.synced.set()
+        self.resyncs += 1
+        log.info("Route mirror of table %s has %s routes.", self.table, len(routes))
+        # events of the interface may be lost with the overrun
+        if self.resyncs > 1:
+            self._check_up(previous, self.interface)
+
+    def apply(self, msg):
+        """ Applies netlink event to the mirror. """
+        event = msg.get("event")
+        if event in ("RTM_NEWROUTE", "RTM_DELROUTE"):
+            route = Route.fromdict(msg)
+            if route.table != self.table or msg.get("family") not in self.families:
+                return
+            key = route.with_netmask()
+            with self._lock:
+                if event == "RTM_NEWROUTE":
+                    self.routes[key] = route
+                else:
+                    self.routes.pop(key, None)
+            if not self._is_own(msg):
+                self.drift += 1
+                log.info(
+                    "Route %s %s in table %s outside of vroute.",
+                    key, "added" if event == "RTM_NEWROUTE" else "removed", self.table,
+                )
+        elif event in ("RTM_NEWLINK", "RTM_DELLINK"):
+            if msg.get_attr("IFLA_IFNAME") != self.interface_name:
+                return
+            interface = Interface(msg)
+            with self._lock:
+                previous = self.interface
+                if event == "RTM_NEWLINK" and interface.state == "up":
+                    self.interface = interface
+                else:
+                    self.interface = None if event == "RTM_DELLINK" else interface
+                    # kernel drops routes of the device and of its nexthops
+                    # without notifications
+                    nexthops = self.nexthops() if self.nexthops is not None else ()
+                    self.routes = {
+                        k: v
+                        for k, v in self.routes.items()
+                        if v.via != interface.num and v.nh_id not in nexthops
+                    }
+            if event == "RTM_DELLINK":
+                log.info("Interface %s is removed.", self.interface_name)
+            elif previous is None or (previous.num, previous.state) != (
+                interface.num, interface.state
+            ):
+                log.info("Interface %s is %s.", self.interface_name, interface.state)
+            self._check_up(previous, self.interface)
+
+    def _check_up(self, previous: ty.Optional[Interface], current: ty.Optional[Interface]):
+        if current is None or current.state != "up" or self.on_up is None:
+            return
+        if previous is None or previous.state != "up" or previous.num != current.num:
+            self.on_up(current)
+
+    def _is_own(self, msg) -> bool:
+        if self.own_ports is None:
+            return False
+        try:
+            return msg["header"]["pid"] in self.own_ports()
+        except OSError:
+            return False
@@ -2,6 +2,7 @@ import asyncio
 from datetime import timedelta, datetime
 import typing as ty
 import logging
+import socket
 
 import aiodns
 
@@ -11,15 +12,20 @@ log = logging.getLogger(__name__)
     
 
 class Rule:
-    def __init__(self, table, priority):
+    def __init__(self, table, priority, family=socket.AF_INET):
         self.table = table
         self.priority = priority
+        self.family = family
 
     @classmethod
     def fromdict(cls, raw: dict):
         attrs = dict(raw["attrs"])
         log.debug("Rule attrs: %s", attrs)
-        return cls(table=raw["table"], priority=attrs.get("FRA_PRIORITY"))
+        return cls(
+            table=raw["table"],
+            priority=attrs.get("FRA_PRIORITY"),
+            family=raw.get("family", socket.AF_INET),
+        )
 
     def __repr__(self):
         return f"<Rule({self.table!r})>"
@@ -27,21 +33,35 @@ class Rule:
 
 class Route:
     """ Linux (netlink) route. """
-    __slots__ = ("dst", "via", "table", "netmask")
-
-    def __init__(self, dst: str, via: int, table: int, netmask: ty.Optional[int] = 32):
+    __slots__ = ("dst", "via", "table", "netmask", "nh_id")
+
+    def __init__(
+        self,
+        dst: str,
+        via: int,
+        table: int,
+        netmask: ty.Optional[int] = 32,
+        nh_id: ty.Optional[int] = None,
+    ):
         self.dst = dst
         self.via = via
         self.table = table
         self.netmask = netmask
+        # nexthop object the route points at, instead of the interface
+        self.nh_id = nh_id
 
     @classmethod
     def fromdict(cls, raw: dict):
         attrs = dict(raw["attrs"])
         log.debug("Route attrs: %s", attrs)
         netmask = raw["dst_len"]
-        via = attrs["RTA_OIF"]
-        return cls(dst=attrs["RTA_DST"], via=via, table=raw["table"], netmask=netmask)
+        via = attrs.get("RTA_OIF")
+        # default route has no destination
+        default = "::" if raw.get("family") == socket.AF_INET6 else "0.0.0.0"
+        dst = attrs.get("RTA_DST", default)
+        # header field is 8-bit, bigger table IDs are only in the attribute
+        table = attrs.get("RTA_TABLE", raw["table"])
+        return cls(dst=dst, via=via, table=table, netmask=netmask, nh_id=attrs.get("RTA_NH_ID"))
 
     def with_netmask(self):
         return f"{self.dst}/{self.netmask}"
@@ -52,14 +72,15 @@ class Route:
 
 class RosRoute:
     """ RouterOS route. """
-    __slots__ = ("dst")
+    __slots__ = ("dst", "id")
 
-    def __init__(self, dst):
+    def __init__(self, dst, id_=None):
         self.dst = dst
+        self.id = id_
 
     @classmethod
     def fromdict(cls, raw: dict):
-        return cls(dst=raw["address"])
+        return cls(dst=raw["address"], id_=raw.get("id"))
 
     def with_netmask(self):
         return with_netmask(self.dst)
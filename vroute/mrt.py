@@ -0,0 +1,167 @@
+"""
+Prefixes originated by autonomous systems, from MRT routing table dumps
+(TABLE_DUMP_V2 of RFC 6396, as published by RouteViews and RIPE RIS).
+
+Dumps are streamed by big chunks, possibly compressed with bzip2 or gzip.
+Most records are skipped without parsing: ones whose bytes don't contain
+any of the wanted 4-byte AS numbers can't have them in AS paths.
+"""
+import bz2
+import gzip
+import logging
+import re
+import struct
+import typing as ty
+
+from .packed import V6
+
+log = logging.getLogger(__name__)
+
+# timestamp, type, subtype, length
+HEADER = struct.Struct(">IHHI")
+TABLE_DUMP_V2 = 13
+# subtype -> address bits, whether entries have path identifiers (RFC 8050)
+RIB_SUBTYPES = {
+    2: (32, False),  # RIB_IPV4_UNICAST
+    3: (32, False),  # RIB_IPV4_MULTICAST
+    4: (128, False),  # RIB_IPV6_UNICAST
+    5: (128, False),  # RIB_IPV6_MULTICAST
+    8: (32, True),  # RIB_IPV4_UNICAST_ADDPATH
+    9: (32, True),  # RIB_IPV4_MULTICAST_ADDPATH
+    10: (128, True),  # RIB_IPV6_UNICAST_ADDPATH
+    11: (128, True),  # RIB_IPV6_MULTICAST_ADDPATH
+}
+ATTR_AS_PATH = 2
+ATTR_EXTENDED_LENGTH = 0x10
+AS_SET = 1
+AS_SEQUENCE = 2
+CHUNK_SIZE = 1 << 20
+
+
+class MRTError(ValueError):
+    pass
+
+
+def parse_asn(value: str) -> int:
+    """
+    Parses AS number with or without the AS prefix.
+
+    >>> parse_asn("AS13335"), parse_asn("as15169"), parse_asn("64512")
+    (13335, 15169, 64512)
+    """
+    digits = value[2:] if value[:2].upper() == "AS" else value
+    if not digits.isdigit() or not 0 <= int(digits) < 1 << 32:
+        raise ValueError(f"Invalid AS number {value!r}")
+    return int(digits)
+
+
+def open_dump(path: str) -> ty.BinaryIO:
+    """ Opens the dump, decompressing bzip2 and gzip ones by their magic numbers. """
+    with open(path, "rb") as fd:
+        magic = fd.read(3)
+    if magic == b"BZh":
+        return bz2.open(path, "rb")
+    if magic[:2] == b"\x1f\x8b":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def records(
+    fd: ty.BinaryIO, chunk_size: int = CHUNK_SIZE
+) -> ty.Iterator[ty.Tuple[int, int, bytes]]:
+    """ Yields type, subtype and body of MRT records, reading the file by chunks. """
+    buf = b""
+    pos = 0
+    while True:
+        if len(buf) - pos < HEADER.size:
+            chunk = fd.read(chunk_size)
+            if not chunk:
+                break
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        _, type_, subtype, length = HEADER.unpack_from(buf, pos)
+        end = pos + HEADER.size + length
+        while end > len(buf):
+            chunk = fd.read(max(chunk_size, end - len(buf)))
+            if not chunk:
+                raise MRTError(f"Truncated record of {length} bytes")
+            buf = buf[pos:] + chunk
+            end -= pos
+            pos = 0
+        yield type_, subtype, buf[pos + HEADER.size : end]
+        pos = end
+    if pos < len(buf):
+        raise MRTError(f"{len(buf) - pos} trailing bytes")
+
+
+def originated(fd: ty.BinaryIO, asns: ty.Collection[int]) -> ty.Iterator[int]:
+    """ Yields packed prefixes any of `asns` originate, by any of the RIB entries. """
+    wanted = set(asns)
+    needle = re.compile(b"|".join(re.escape(x.to_bytes(4, "big")) for x in wanted))
+    count = 0
+    for type_, subtype, body in records(fd):
+        if type_ != TABLE_DUMP_V2 or subtype not in RIB_SUBTYPES:
+            continue
+        count += 1
+        if needle.search(body) is None:
+            continue
+        bits, addpath = RIB_SUBTYPES[subtype]
+        try:
+            key = _prefix(body, bits)
+            if not wanted.isdisjoint(_origins(body, addpath)):
+                yield key
+        except (IndexError, struct.error):
+            raise MRTError(f"Malformed RIB record #{count}") from None
+    log.info("Parsed %s RIB records", count)
+
+
+def _prefix(body: bytes, bits: int) -> int:
+    plen = body[4]
+    if plen > bits:
+        raise MRTError(f"Invalid prefix length {plen}")
+    addr = int.from_bytes(body[5 : 5 + (plen + 7) // 8].ljust(bits // 8, b"\0"), "big")
+    # host bits are masked, like the ones of strictly parsed networks
+    addr = addr >> bits - plen << bits - plen
+    return (V6 if bits == 128 else 0) | addr << 8 | plen
+
+
+def _origins(body: bytes, addpath: bool) -> ty.Set[int]:
+    """ Returns origin ASes of all entries of the RIB record. """
+    pos = 5 + (body[4] + 7) // 8
+    (count,) = struct.unpack_from(">H", body, pos)
+    pos += 2
+    result = set()
+    for _ in range(count):
+        # peer index, originated time and path identifier
+        pos += 10 if addpath else 6
+        (length,) = struct.unpack_from(">H", body, pos)
+        pos += 2
+        end = pos + length
+        while pos < end:
+            flags, type_ = body[pos], body[pos + 1]
+            if flags & ATTR_EXTENDED_LENGTH:
+                (size,) = struct.unpack_from(">H", body, pos + 2)
+                pos += 4
+            else:
+                size = body[pos + 2]
+                pos += 3
+            if type_ == ATTR_AS_PATH:
+                result.update(_path_origins(body, pos, pos + size))
+            pos += size
+    return result
+
+
+def _path_origins(body: bytes, pos: int, end: int) -> ty.Collection[int]:
+    """ Origin of AS_PATH with 4-byte numbers, members of the trailing AS_SET if any. """
+    origins: ty.Collection[int] = ()
+    while pos < end:
+        type_, count = body[pos], body[pos + 1]
+        pos += 2
+        if type_ == AS_SEQUENCE and count:
+            (origin,) = struct.unpack_from(">I", body, pos + 4 * (count - 1))
+            origins = (origin,)
+        elif type_ == AS_SET:
+            origins = struct.unpack_from(f">{count}I", body, pos)
+        pos += 4 * count
+    return origins
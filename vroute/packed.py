@@ -0,0 +1,486 @@
+"""
+Packed integer representation of networks.
+
+Network is packed into one integer: address shifted by 8 bits
+with prefix length in the lowest byte, so packed networks sort
+by address first. IPv6 networks are marked with the bit 136
+and sort after all IPv4 ones.
+In `Networks` IPv4 ones are stored in `array("Q")`, IPv6 ones
+in three parallel arrays (high and low address halves, prefix length),
+without a Python object per network.
+"""
+from array import array
+from bisect import bisect_left
+import itertools
+import re
+import socket
+import struct
+import sys
+import typing as ty
+
+PGCOPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+# signature, flags and header extension length
+PGCOPY_HEADER = struct.Struct(">11sii")
+# field count, field length, inet family, bits, is_cidr, address length
+ROW_HEADER = struct.Struct(">hiBBBB")
+# family in the PostgreSQL inet wire format, isn't equal to socket.AF_INET
+PGSQL_AF_INET = 2
+PGSQL_AF_INET6 = 3
+# marker of IPv6 packed networks
+V6 = 1 << 136
+MASK64 = (1 << 64) - 1
+# fixed size of the row with single IPv4 inet field
+IPV4_ROW = ROW_HEADER.size + 4
+
+_row_pattern = {
+    # offset in row: expected byte
+    0: 0, 1: 1,  # one field
+    2: 0, 3: 0, 4: 0, 5: 8,  # 8 bytes long
+    6: PGSQL_AF_INET,
+    9: 4,  # 4 bytes of address
+}
+
+
+class NetworkError(ValueError):
+    """ Invalid network, `lineno` is its line in the file, if known. """
+
+    def __init__(self, network: str, reason: str, lineno: ty.Optional[int] = None):
+        super().__init__(network, reason, lineno)
+        self.network = network
+        self.reason = reason
+        self.lineno = lineno
+
+    def __str__(self):
+        where = f" on line {self.lineno}" if self.lineno is not None else ""
+        return f"Invalid network {self.network!r}{where}: {self.reason}"
+
+
+# prefix length as written -> prefix length, only canonical forms are valid
+_PREFIXES = {str(x): x for x in range(129)}
+_PREFIXES4 = {str(x): x for x in range(33)}
+# prefix length as written -> network mask, for the vectorized IPv4 parser
+_MASKS4 = {x: ((1 << 32) - (1 << 32 - n)).to_bytes(4, "big") for x, n in _PREFIXES4.items()}
+_AF_INET, _AF_INET6 = socket.AF_INET, socket.AF_INET6
+# a line with more than one slash, the vectorized parser splits by them
+_SLASHES = re.compile(r"/[^/\n]*/")
+
+
+def pack(network: str) -> int:
+    """
+    Packs network into integer, validating it and masking host bits,
+    so "1.2.3.4/24" is the same network as "1.2.3.0/24".
+
+    >>> pack("1.2.3.0/24")
+    4328718360
+    """
+    addr, slash, prefixlen = network.partition("/")
+    v6 = ":" in addr
+    try:
+        raw = socket.inet_pton(_AF_INET6 if v6 else _AF_INET, addr)
+    except OSError:
+        raise NetworkError(network, "invalid address") from None
+    bits = 128 if v6 else 32
+    if not slash:
+        length = bits
+    else:
+        length = (_PREFIXES if v6 else _PREFIXES4).get(prefixlen, -1)
+        if length < 0:
+            raise NetworkError(network, "invalid prefix length")
+    host = bits - length
+    key = int.from_bytes(raw, "big") >> host << host + 8 | length
+    return V6 | key if v6 else key
+
+
+def pack_many(networks: ty.Sequence[str]) -> ty.List[int]:
+    """
+    Packs networks like pack(), keeping the order.
+    IPv4 batches are parsed without Python code per network: addresses
+    are masked all at once as one big integer, and packed keys are assembled
+    by slice assignments. Raises NetworkError with `lineno` of the first
+    invalid network in the batch, starting from 1.
+    """
+    count = len(networks)
+    if not count:
+        return []
+    text = "\n".join(networks)
+    try:
+        if ":" in text:
+            return [pack(x) for x in networks]
+        return _pack_many_v4(networks, text, count).tolist()
+    except (NetworkError, OSError, KeyError):
+        for lineno, network in enumerate(networks, 1):
+            try:
+                pack(network)
+            except NetworkError as exc:
+                exc.lineno = lineno
+                raise
+        raise
+
+
+def _pack_many_v4(networks: ty.Sequence[str], text: str, count: int) -> array:
+    if _SLASHES.search(text):
+        raise NetworkError(text, "more than one slash")
+    slashes = text.count("/")
+    if slashes == count:
+        tokens = text.replace("\n", "/").split("/")
+        if len(tokens) != 2 * count:
+            raise NetworkError(text, "line break in the network")
+        addrs, prefixes = tokens[0::2], tokens[1::2]
+    elif not slashes:
+        addrs, prefixes = networks, ["32"] * count
+    else:
+        parts = list(map(str.partition, networks, itertools.repeat("/")))
+        addrs = [x for x, _, _ in parts]
+        prefixes = [x if slash else "32" for _, slash, x in parts]
+    raw = b"".join(map(socket.inet_pton, itertools.repeat(_AF_INET), addrs))
+    masks = b"".join(map(_MASKS4.__getitem__, prefixes))
+    size = 4 * count
+    masked = (int.from_bytes(raw, "big") & int.from_bytes(masks, "big")).to_bytes(size, "big")
+    # big-endian 8 byte keys: 3 zero bytes, address, prefix length
+    buf = bytearray(8 * count)
+    for i in range(4):
+        buf[3 + i :: 8] = masked[i::4]
+    buf[7::8] = bytes(map(_PREFIXES4.__getitem__, prefixes))
+    keys = array("Q")
+    keys.frombytes(buf)
+    if sys.byteorder == "little":
+        keys.byteswap()
+    return keys
+
+
+def unpack(key: int) -> str:
+    """
+    Unpacks integer into network in `address/prefixlen` form.
+
+    >>> unpack(4328718360)
+    '1.2.3.0/24'
+    """
+    if key & V6:
+        addr = ((key ^ V6) >> 8).to_bytes(16, "big")
+        return f"{socket.inet_ntop(socket.AF_INET6, addr)}/{key & 0xFF}"
+    return f"{socket.inet_ntoa((key >> 8).to_bytes(4, 'big'))}/{key & 0xFF}"
+
+
+def pack_inet(value) -> int:
+    """
+    Packs `inet` value as asyncpg decodes it: an interface of the ipaddress module,
+    or an address if the prefix is full. Host bits are masked, no text is parsed.
+    """
+    network = getattr(value, "network", None)
+    if network is None:
+        key = int(value) << 8 | value.max_prefixlen
+    else:
+        key = int(network.network_address) << 8 | network.prefixlen
+    return V6 | key if value.version == 6 else key
+
+
+def is_v6(key: int) -> bool:
+    return bool(key & V6)
+
+
+def covered(key: int) -> ty.Tuple[int, int]:
+    """
+    Returns the first and the last packed networks within the network,
+    so the ones it covers are exactly the keys in this range.
+
+    >>> [unpack(x) for x in covered(pack("10.0.0.0/8"))]
+    ['10.0.0.0/8', '10.255.255.255/255']
+    """
+    plen = key & 0xFF
+    bits = 128 if key & V6 else 32
+    return key, key | ((1 << bits - plen) - 1) << 8 | 0xFF
+
+
+def diff(
+    desired: ty.Iterable[int], current: ty.Iterable[int]
+) -> ty.Tuple["Networks", "Networks"]:
+    """ Returns packed networks to add and to remove, both sorted. """
+    if not isinstance(desired, Networks):
+        desired = Networks.fromkeys(desired)
+    if not isinstance(current, Networks):
+        current = Networks.fromkeys(current)
+    return desired.diff(current)
+
+
+class Networks:
+    """
+    Compact collection of packed networks of both families.
+    Kept sorted and unique, unless built from unordered chunks,
+    then it's sorted on the first lookup.
+    """
+
+    __slots__ = ("v4", "v6_hi", "v6_lo", "v6_len", "_sorted")
+
+    def __init__(self, v4=None, v6_hi=None, v6_lo=None, v6_len=None, sorted_=True):
+        self.v4: array = v4 if v4 is not None else array("Q")
+        self.v6_hi: array = v6_hi if v6_hi is not None else array("Q")
+        self.v6_lo: array = v6_lo if v6_lo is not None else array("Q")
+        self.v6_len: array = v6_len if v6_len is not None else array("B")
+        self._sorted = sorted_
+
+    @classmethod
+    def fromkeys(cls, keys: ty.Iterable[int]) -> "Networks":
+        result = cls(sorted_=False)
+        for key in keys:
+            result.append(key)
+        result.sort()
+        return result
+
+    def append(self, key: int):
+        if key & V6:
+            addr = (key ^ V6) >> 8
+            self.v6_hi.append(addr >> 64)
+            self.v6_lo.append(addr & MASK64)
+            self.v6_len.append(key & 0xFF)
+        else:
+            self.v4.append(key)
+        self._sorted = False
+
+    def extend(self, other: "Networks"):
+        self.v4.extend(other.v4)
+        self.v6_hi.extend(other.v6_hi)
+        self.v6_lo.extend(other.v6_lo)
+        self.v6_len.extend(other.v6_len)
+        self._sorted = False
+
+    def sort(self):
+        """ Sorts networks and drops duplicates. """
+        if self._sorted:
+            return
+        if not _is_strictly_sorted(self.v4):
+            self.v4 = array("Q", sorted(set(self.v4)))
+        v6 = list(self._v6_keys())
+        if not _is_strictly_sorted(v6):
+            v6 = sorted(set(v6))
+            self.v6_hi, self.v6_lo, self.v6_len = array("Q"), array("Q"), array("B")
+            for key in v6:
+                self.append(key)
+        self._sorted = True
+
+    def only_v4(self) -> "Networks":
+        """ Returns IPv4 networks, sharing memory with this collection. """
+        self.sort()
+        return Networks(v4=self.v4)
+
+    def diff(self, other: "Networks") -> ty.Tuple["Networks", "Networks"]:
+        """
+        Returns networks missing in `other` and networks of `other` missing here,
+        by merging both sorted collections.
+        """
+        self.sort()
+        other.sort()
+        missing, extra = Networks(), Networks()
+        for mine, theirs, is_v6 in ((self.v4, other.v4, False), (self.v6, other.v6, True)):
+            a, b = iter(mine), iter(theirs)
+            x, y = next(a, None), next(b, None)
+            while x is not None and y is not None:
+                if x == y:
+                    x, y = next(a, None), next(b, None)
+                elif x < y:
+                    missing.append(x)
+                    x = next(a, None)
+                else:
+                    extra.append(y)
+                    y = next(b, None)
+            while x is not None:
+                missing.append(x)
+                x = next(a, None)
+            while y is not None:
+                extra.append(y)
+                y = next(b, None)
+        missing._sorted = extra._sorted = True
+        return missing, extra
+
+    @property
+    def v6(self) -> ty.Iterator[int]:
+        return self._v6_keys()
+
+    def _v6_keys(self, start: int = 0, stop: ty.Optional[int] = None) -> ty.Iterator[int]:
+        stop = len(self.v6_len) if stop is None else stop
+        hi, lo, length = self.v6_hi, self.v6_lo, self.v6_len
+        for i in range(start, stop):
+            yield V6 | (hi[i] << 64 | lo[i]) << 8 | length[i]
+
+    def __len__(self):
+        return len(self.v4) + len(self.v6_len)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self) -> ty.Iterator[int]:
+        self.sort()
+        yield from self.v4
+        yield from self._v6_keys()
+
+    def __getitem__(self, index):
+        self.sort()
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("Slice step isn't supported")
+            split = len(self.v4)
+            low, high = max(start - split, 0), max(stop - split, 0)
+            return Networks(
+                v4=self.v4[start:stop],
+                v6_hi=self.v6_hi[low:high],
+                v6_lo=self.v6_lo[low:high],
+                v6_len=self.v6_len[low:high],
+            )
+        if index < 0:
+            index += len(self)
+        if index < len(self.v4):
+            return self.v4[index]
+        return next(self._v6_keys(index - len(self.v4)))
+
+    def __contains__(self, key: int) -> bool:
+        self.sort()
+        if not key & V6:
+            i = bisect_left(self.v4, key)
+            return i < len(self.v4) and self.v4[i] == key
+        addr = (key ^ V6) >> 8
+        target = (addr >> 64, addr & MASK64, key & 0xFF)
+        low, high = 0, len(self.v6_len)
+        while low < high:
+            mid = (low + high) // 2
+            if (self.v6_hi[mid], self.v6_lo[mid], self.v6_len[mid]) < target:
+                low = mid + 1
+            else:
+                high = mid
+        return low < len(self.v6_len) and (
+            self.v6_hi[low], self.v6_lo[low], self.v6_len[low]
+        ) == target
+
+    def __eq__(self, other):
+        if not isinstance(other, Networks):
+            return NotImplemented
+        return list(self) == list(other)
+
+    @property
+    def nbytes(self) -> int:
+        """ Memory used by the networks. """
+        return sum(
+            len(x) * x.itemsize for x in (self.v4, self.v6_hi, self.v6_lo, self.v6_len)
+        )
+
+    def __repr__(self):
+        return f"<Networks({len(self.v4)} IPv4, {len(self.v6_len)} IPv6)>"
+
+
+def _is_strictly_sorted(seq) -> bool:
+    return all(a < b for a, b in zip(seq, seq[1:]))
+
+
+class InetCopyDecoder:
+    """
+    Incremental decoder of `COPY (SELECT <inet>) TO STDOUT (FORMAT binary)`.
+    Feed it with raw chunks, it returns chunks of packed networks.
+    Runs of IPv4 rows are decoded with slice assignments,
+    without making Python objects per row.
+    NULL rows separate groups of networks: decoding stops after one
+    with `group_ended` set, the rest is decoded by the next feed().
+    """
+
+    def __init__(self):
+        self._buf = b""
+        self._header_read = False
+        self.finished = False
+        self.group_ended = False
+        self.rows = 0
+
+    def feed(self, data: bytes) -> Networks:
+        buf = self._buf + data if self._buf else bytes(data)
+        pos = 0
+        self.group_ended = False
+        result = Networks(sorted_=False)
+        if not self._header_read:
+            if len(buf) < PGCOPY_HEADER.size:
+                self._buf = buf
+                return result
+            signature, _, ext_len = PGCOPY_HEADER.unpack_from(buf)
+            if signature != PGCOPY_SIGNATURE:
+                raise ValueError("Not a binary COPY stream")
+            if len(buf) < PGCOPY_HEADER.size + ext_len:
+                self._buf = buf
+                return result
+            pos = PGCOPY_HEADER.size + ext_len
+            self._header_read = True
+        while not self.finished:
+            count = self._ipv4_run(buf, pos)
+            if count:
+                result.v4.extend(decode_ipv4_rows(buf[pos : pos + count * IPV4_ROW]))
+                pos += count * IPV4_ROW
+                self.rows += count
+                continue
+            if len(buf) - pos < 2:
+                break
+            (fields,) = struct.unpack_from(">h", buf, pos)
+            if fields == -1:
+                self.finished = True
+                pos += 2
+                break
+            if len(buf) - pos < 6:
+                break
+            (length,) = struct.unpack_from(">i", buf, pos + 2)
+            if fields != 1:
+                raise ValueError("Expected single inet field")
+            if length == -1:
+                self.group_ended = True
+                pos += 6
+                break
+            if len(buf) - pos < ROW_HEADER.size:
+                break
+            _, length, family, bits, _, nb = ROW_HEADER.unpack_from(buf, pos)
+            end = pos + 6 + length
+            if len(buf) < end:
+                break
+            addr = int.from_bytes(buf[end - nb : end], "big")
+            if family == PGSQL_AF_INET:
+                result.v4.append(addr << 8 | bits)
+            elif family == PGSQL_AF_INET6:
+                result.v6_hi.append(addr >> 64)
+                result.v6_lo.append(addr & MASK64)
+                result.v6_len.append(bits)
+            else:
+                raise ValueError(f"Unknown inet family {family}")
+            self.rows += 1
+            pos = end
+        self._buf = buf[pos:]
+        return result
+
+    @staticmethod
+    def _ipv4_run(buf: bytes, pos: int) -> int:
+        """ Returns number of consecutive IPv4 rows starting at `pos`. """
+        count = (len(buf) - pos) // IPV4_ROW
+        if count and _is_ipv4_run(buf, pos, count):
+            return count
+        # binary search of the longest run
+        low, high = 0, count
+        while low < high:
+            mid = (low + high + 1) // 2
+            if _is_ipv4_run(buf, pos, mid):
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+
+def _is_ipv4_run(buf: bytes, pos: int, count: int) -> bool:
+    end = pos + count * IPV4_ROW
+    for offset, byte in _row_pattern.items():
+        if buf[pos + offset : end : IPV4_ROW] != bytes((byte,)) * count:
+            return False
+    return True
+
+
+def decode_ipv4_rows(rows: bytes) -> array:
+    """ Decodes consecutive binary COPY rows of IPv4 inet into packed networks. """
+    count = len(rows) // IPV4_ROW
+    out = bytearray(count * 8)
+    # build little-endian uint64: prefix length, then address from the lowest byte
+    out[0::8] = rows[7::IPV4_ROW]
+    for i in range(4):
+        out[1 + i :: 8] = rows[13 - i :: IPV4_ROW]
+    result = array("Q", bytes(out))
+    if sys.byteorder == "big":
+        result.byteswap()
+    return result
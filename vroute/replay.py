@@ -0,0 +1,239 @@
+"""
+Pre-serialized netlink messages for installing many routes at once.
+
+Messages are built from packed networks with slice assignments, every message
+has the fixed size, so the output interface is patched into all of them
+the same way just before sending. Routes may point at nexthop objects
+instead (kernel 5.3+), then they don't depend on the interface at all.
+Messages are sent in big batches without NLM_F_ACK,
+the kernel answers only to the failed ones.
+Removal messages are built the same way, without the interface.
+"""
+from array import array
+import errno
+import logging
+import os
+import socket
+import struct
+import sys
+import typing as ty
+
+from .packed import Networks
+
+log = logging.getLogger(__name__)
+
+NETLINK_ROUTE = 0
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_NEWNEXTHOP = 104
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_REPLACE = 0x100
+NLM_F_CREATE = 0x400
+RTPROT_STATIC = 4
+RT_SCOPE_LINK = 253
+RTN_UNICAST = 1
+RT_TABLE_COMPAT = 252
+RTA_DST = 1
+RTA_OIF = 4
+RTA_TABLE = 15
+RTA_NH_ID = 30
+NHA_ID = 1
+NHA_OIF = 5
+
+# length, type, flags, sequence number, port ID
+NLMSGHDR = struct.Struct("=IHHII")
+# family, dst_len, src_len, tos, table, protocol, scope, type, flags
+RTMSG = struct.Struct("=BBBBBBBBI")
+# family, scope, protocol, reserved, flags
+NHMSG = struct.Struct("=BBBBI")
+RTATTR = struct.Struct("=HH")
+U32 = struct.Struct("=I")
+BUFSIZE = 4 * 1024 * 1024
+# kernel rejects messages bigger than the send buffer
+BATCH_BYTES = 64 * 1024
+
+
+def _template(
+    family: int, addr_len: int, table: int, nh_id: ty.Optional[int] = None, remove: bool = False
+) -> ty.Tuple[bytes, int, int, int]:
+    """
+    Returns message with zero destination and offsets of its fields.
+    Route goes via the nexthop `nh_id` if it's set, or via zero interface.
+    Removal matches the route by its destination only.
+    """
+    body = RTMSG.pack(
+        family, 0, 0, 0, RT_TABLE_COMPAT if table > 255 else table,
+        # zero protocol matches routes added by anyone
+        0 if remove else RTPROT_STATIC, RT_SCOPE_LINK, RTN_UNICAST, 0,
+    )
+    dst = RTATTR.pack(RTATTR.size + addr_len, RTA_DST) + bytes(addr_len)
+    via = RTA_OIF if nh_id is None else RTA_NH_ID
+    oif = b"" if remove else RTATTR.pack(RTATTR.size + U32.size, via) + U32.pack(nh_id or 0)
+    tbl = RTATTR.pack(RTATTR.size + U32.size, RTA_TABLE) + U32.pack(table)
+    size = NLMSGHDR.size + len(body) + len(dst) + len(oif) + len(tbl)
+    if remove:
+        header = NLMSGHDR.pack(size, RTM_DELROUTE, NLM_F_REQUEST, 0, 0)
+    else:
+        flags = NLM_F_REQUEST | NLM_F_CREATE | NLM_F_REPLACE
+        header = NLMSGHDR.pack(size, RTM_NEWROUTE, flags, 0, 0)
+    dst_len_offset = NLMSGHDR.size + 1
+    addr_offset = NLMSGHDR.size + len(body) + RTATTR.size
+    oif_offset = addr_offset + addr_len + RTATTR.size
+    return header + body + dst + oif + tbl, dst_len_offset, addr_offset, oif_offset
+
+
+def _le_bytes(arr: array) -> bytes:
+    if sys.byteorder == "big":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+class RouteCache:
+    """
+    RTM_NEWROUTE messages of the networks, one blob per family.
+    `nexthops` maps address family to the nexthop ID routes point at.
+    With `remove` set messages are RTM_DELROUTE, missing routes aren't errors.
+    """
+
+    def __init__(
+        self, table: int, nexthops: ty.Optional[ty.Dict[int, int]] = None, remove: bool = False
+    ):
+        self.table = table
+        self.nexthops = nexthops
+        self.remove = remove
+        # blob, message size, offset of the interface or None if nexthop is used
+        self.blobs: ty.List[ty.Tuple[bytearray, int, ty.Optional[int]]] = []
+        self.count = 0
+
+    @classmethod
+    def fromnetworks(
+        cls,
+        networks: Networks,
+        table: int,
+        nexthops: ty.Optional[ty.Dict[int, int]] = None,
+        remove: bool = False,
+    ) -> "RouteCache":
+        cache = cls(table, nexthops, remove)
+        networks.sort()
+        if networks.v4:
+            cache._add_v4(networks.v4)
+        if networks.v6_len:
+            cache._add_v6(networks.v6_hi, networks.v6_lo, networks.v6_len)
+        return cache
+
+    def _template(self, family: int, addr_len: int):
+        if self.remove:
+            msg, dst_len, addr, _ = _template(family, addr_len, self.table, remove=True)
+            return msg, dst_len, addr, None
+        if self.nexthops is None:
+            return _template(family, addr_len, self.table)
+        msg, dst_len, addr, _ = _template(family, addr_len, self.table, self.nexthops[family])
+        return msg, dst_len, addr, None
+
+    def _add_v4(self, keys: array):
+        msg, dst_len, addr, oif = self._template(socket.AF_INET, 4)
+        size, count = len(msg), len(keys)
+        blob = bytearray(msg * count)
+        raw = _le_bytes(keys)
+        # packed network is prefix length in the lowest byte, then address
+        blob[dst_len::size] = raw[0::8]
+        for i in range(4):
+            blob[addr + i :: size] = raw[4 - i :: 8]
+        self.blobs.append((blob, size, oif))
+        self.count += count
+
+    def _add_v6(self, high: array, low: array, lengths: array):
+        msg, dst_len, addr, oif = self._template(socket.AF_INET6, 16)
+        size, count = len(msg), len(lengths)
+        blob = bytearray(msg * count)
+        blob[dst_len::size] = lengths.tobytes()
+        for offset, half in ((0, _le_bytes(high)), (8, _le_bytes(low))):
+            for i in range(8):
+                blob[addr + offset + i :: size] = half[7 - i :: 8]
+        self.blobs.append((blob, size, oif))
+        self.count += count
+
+    def send(self, sock: socket.socket, oif: ty.Optional[int] = None) -> ty.Tuple[int, int]:
+        """
+        Sends all routes via the interface `oif`, unless they use nexthops.
+        Returns counts of sent and failed.
+        """
+        sent = errors = 0
+        for blob, size, offset in self.blobs:
+            if offset is not None:
+                patch = U32.pack(oif)
+                for i in range(4):
+                    blob[offset + i :: size] = patch[i : i + 1] * (len(blob) // size)
+            step = max(BATCH_BYTES // size, 1) * size
+            view = memoryview(blob)
+            for start in range(0, len(blob), step):
+                chunk = view[start : start + step]
+                sock.send(chunk)
+                sent += len(chunk) // size
+                errors += _drain_errors(sock, (errno.ESRCH,) if self.remove else ())
+        return sent, errors
+
+
+def replace_nexthop(sock: socket.socket, nh_id: int, family: int, oif: int):
+    """ Creates or replaces the nexthop via the interface, raises OSError on failure. """
+    body = (
+        NHMSG.pack(family, 0, RTPROT_STATIC, 0, 0)
+        + RTATTR.pack(RTATTR.size + U32.size, NHA_ID) + U32.pack(nh_id)
+        + RTATTR.pack(RTATTR.size + U32.size, NHA_OIF) + U32.pack(oif)
+    )
+    flags = NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_REPLACE
+    sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(body), RTM_NEWNEXTHOP, flags, 1, 0) + body)
+    while True:
+        data = sock.recv(BUFSIZE)
+        for kind, seq, code in _answers(data):
+            if kind == NLMSG_ERROR and seq == 1:
+                if code:
+                    raise OSError(-code, os.strerror(-code))
+                return
+
+
+def open_socket() -> socket.socket:
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, BUFSIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BUFSIZE)
+    sock.bind((0, 0))
+    return sock
+
+
+def _drain_errors(sock: socket.socket, ignore: ty.Collection[int] = ()) -> int:
+    """
+    Reads error answers received so far, returns how many of them are failures.
+    Error codes in `ignore` aren't failures.
+    """
+    errors = 0
+    while True:
+        try:
+            data = sock.recv(BUFSIZE, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return errors
+        except OSError as exc:
+            # too many errors to keep, these are lost
+            if exc.errno == errno.ENOBUFS:
+                log.warning("Some route errors are lost, the receive buffer is overrun.")
+                continue
+            raise
+        for kind, _, code in _answers(data):
+            if kind == NLMSG_ERROR and code and -code not in ignore:
+                errors += 1
+                if errors == 1:
+                    log.warning("Failed to change route: %s", os.strerror(-code))
+
+
+def _answers(data: bytes) -> ty.Iterator[ty.Tuple[int, int, int]]:
+    """ Yields type, sequence number and error code of the messages. """
+    pos = 0
+    while pos + NLMSGHDR.size <= len(data):
+        length, kind, _, seq, _ = NLMSGHDR.unpack_from(data, pos)
+        code = 0
+        if kind == NLMSG_ERROR:
+            (code,) = struct.unpack_from("=i", data, pos + NLMSGHDR.size)
+        yield kind, seq, code
+        pos += (length + 3) & ~3
@@ -1,69 +1,352 @@
 from abc import ABC, abstractmethod
+import asyncio
+from collections import deque
+import errno
+import itertools
 import logging
+import os
+import socket
+import threading
+import time
 import typing as ty
 
 import pyroute2
 import routeros_api
+import routeros_api.exceptions
 import routeros_api.resource
 
+from . import bird
+from .aggregate import Aggregated, Aggregator
+from .buckets import TAG_PREFIX, Bucket, Buckets, Summary
+from .mirror import RouteMirror
 from .models import Rule, Route, RosRoute, Interface
-from .util import with_netmask
+from .packed import NetworkError, Networks, pack, pack_many, unpack
+from .replay import RouteCache, open_socket, replace_nexthop
+from .throttle import AIMDController
+from .util import dig, with_netmask
 
 log = logging.getLogger(__name__)
 
+# route set of sources and devices not assigned to any other
+DEFAULT_SET = "default"
+
 
 class Manager(ABC):
+    # manager type, used as a default name of the device
     name = "manager"
+    buckets = Buckets()
+    # entries summarize() couldn't count by buckets without dumping
+    untagged = 0
+    # set for devices with limited capacity
+    aggregator: ty.Optional[Aggregator] = None
+    # networks of this route set are synchronized to the device
+    route_set = DEFAULT_SET
 
     @classmethod
     @abstractmethod
-    def fromconf(cls, cfg: dict) -> "Manager": ...
+    def fromconf(cls, cfg: dict) -> "Manager":
+        """ Creates manager from the device definition. """
 
     @abstractmethod
     def add(self, network: str):
         """ Add new network. """
 
+    @abstractmethod
+    def remove(self, network: str):
+        """ Remove network. """
+
     def prepare(self):
         pass
 
+    def flush(self):
+        """ Waits until all changes are applied. """
+
+    def watch(self) -> bool:
+        """
+        Starts tracking the device state, so current() doesn't ask the device.
+        Returns False if the manager can't do it.
+        """
+        return False
+
+    def synced(self, desired: Networks):
+        """ Called after successful synchronization with networks the device must have. """
+
     def disconnect(self):
         pass
 
+    def fit(self, desired: Networks) -> Aggregated:
+        """ Aggregates networks to fit the device, if its capacity is limited. """
+        if self.aggregator is None:
+            return Aggregated(desired, len(desired))
+        result = self.aggregator(desired)
+        log.info(
+            "Aggregated %s networks of %s into %s, swept in %s IPv4 and %s IPv6 addresses.",
+            result.before, self.name, len(result.networks), result.swept, result.swept6,
+        )
+        return result
+
+    def summarize(self, expected: ty.Collection[Bucket]) -> Summary:
+        """
+        Returns counts and hashes of networks by buckets.
+        `expected` are buckets the device is expected to have.
+        """
+        return self.buckets.summarize(current_networks(self))
+
+    def bucket_networks(self, selected: ty.Collection[Bucket]) -> Networks:
+        """ Returns networks of the device in the selected buckets. """
+        return self.buckets.select(current_networks(self), selected)
+
+    def tag_buckets(self, desired: Networks) -> int:
+        """
+        Marks entries with their buckets, returns how many changed.
+        `desired` are networks the device must have.
+        """
+        return 0
+
     @abstractmethod
     def current(self) -> ty.List[Route]:
         """ List current networks. """
 
 
-class LinuxRouteManager(pyroute2.IPRoute, Manager):
-    """Manager of Linux routes"""
-    name = "linux"
+def current_networks(manager: Manager) -> Networks:
+    """ Returns networks of the device, packed. """
+    return Networks.fromkeys(pack_many([x.with_netmask() for x in manager.current()]))
+
 
-    def __init__(self, interface: str, table: int, priority: int):
+class BatchManager(ABC):
+    """
+    Asynchronous protocol of managers, changing the device by whole batches.
+    Capability flags tell what the device can do with a batch.
+    """
+    name = "manager"
+    # the batch is sent in a few big requests, not per network
+    bulk = False
+    # the batch is applied all at once, others never see it half-applied
+    atomic_swap = False
+
+    @abstractmethod
+    async def networks(self) -> Networks:
+        """ Returns networks of the device. """
+
+    @abstractmethod
+    async def apply(self, adds: Networks, removes: Networks) -> ty.Tuple[int, int]:
+        """ Adds and removes networks, returns how many of them were sent. """
+
+
+class ThreadedBatchManager(BatchManager):
+    """ Batch protocol of managers with blocking I/O, runs it in the thread. """
+
+    async def networks(self) -> Networks:
+        return await asyncio.get_event_loop().run_in_executor(None, current_networks, self)
+
+    async def apply(self, adds: Networks, removes: Networks) -> ty.Tuple[int, int]:
+        return await asyncio.get_event_loop().run_in_executor(
+            None, self.apply_batch, adds, removes
+        )
+
+    @abstractmethod
+    def apply_batch(self, adds: Networks, removes: Networks) -> ty.Tuple[int, int]:
+        """ Blocking apply(). """
+
+
+class SyncManagerAdapter(ThreadedBatchManager):
+    """ Runs synchronous manager in the thread, network by network. """
+
+    def __init__(self, manager: Manager):
+        self.manager = manager
+        self.name = manager.name
+
+    def current(self):
+        return self.manager.current()
+
+    def apply_batch(self, adds: Networks, removes: Networks) -> ty.Tuple[int, int]:
+        for key in removes:
+            self.manager.remove(unpack(key))
+        for key in adds:
+            self.manager.add(unpack(key))
+        self.manager.flush()
+        return len(adds), len(removes)
+
+
+def as_batch(manager: Manager) -> BatchManager:
+    """ Returns batch protocol of the manager, adapting synchronous ones. """
+    if isinstance(manager, BatchManager):
+        return manager
+    return SyncManagerAdapter(manager)
+
+
+# nexthop family must match the route one, IPv6 routes use nexthop with this offset
+NEXTHOP_V6_OFFSET = 1 << 31
+
+
+class LinuxRouteManager(pyroute2.IPRoute, Manager, ThreadedBatchManager):
+    """
+    Manager of Linux routes.
+    If `nexthop_id` is set and the kernel supports nexthop objects (5.3+),
+    all routes point at the nexthop, so moving them to another interface
+    is a single nexthop replace. Otherwise routes point at the interface.
+    """
+    name = "linux"
+    bulk = True
+
+    def __init__(
+        self,
+        interface: str,
+        table: int,
+        priority: int,
+        ipv6: bool = False,
+        nexthop_id: ty.Optional[int] = None,
+    ):
         super().__init__()
         self._interface = interface
         self.table = table
         self.priority = priority
+        self.ipv6 = ipv6
+        self.nexthop_id = nexthop_id
+        # address family -> nexthop ID, if nexthops are used
+        self.nexthops: ty.Optional[ty.Dict[int, int]] = None
+        # with nexthops routes are added by batches in flush()
+        self._pending = Networks()
+        self.mirror: ty.Optional[RouteMirror] = None
+        # routes to reinstall at once when the interface is recreated
+        self.cache: ty.Optional[RouteCache] = None
+        self._raw_sock: ty.Optional[socket.socket] = None
+        self._raw_lock = threading.Lock()
         self.interface: Interface = self.find_interface()
         self.prepare()
 
     @classmethod
     def fromconf(cls, cfg: dict):
-        priority = cfg.get("vpn.rule.priority")
+        priority = dig(cfg, "rule.priority")
         if priority is None:
             raise ValueError("Please specify rule priority in the configuration file.")
-        table = cfg.get("vpn.table_id")
+        table = cfg.get("table_id")
         if table is None:
             raise ValueError("Please specify table ID in the configuration file.")
-        interface = cfg.get("vpn.route_to.interface")
+        interface = dig(cfg, "route_to.interface")
         if not interface:
             raise ValueError("Please specify interface in the configuration file.")
-        return cls(interface=interface, table=table, priority=priority)
+        mgr = cls(
+            interface=interface,
+            table=table,
+            priority=priority,
+            ipv6=cfg.get("ipv6", False),
+            # 0 disables nexthops
+            nexthop_id=cfg.get("nexthop_id", table) or None,
+        )
+        mgr.name = cfg.get("name", cls.name)
+        return mgr
 
     def prepare(self):
         self.check_rule()
         self.interface = self.find_interface()
+        self.setup_nexthops()
+
+    def setup_nexthops(self):
+        """ Points nexthops at the interface, falls back to plain routes on old kernels. """
+        if self.nexthop_id is None:
+            return
+        nexthops = {socket.AF_INET: self.nexthop_id}
+        if self.ipv6:
+            nexthops[socket.AF_INET6] = self.nexthop_id + NEXTHOP_V6_OFFSET
+        try:
+            with self._raw_lock:
+                for family, nh_id in nexthops.items():
+                    replace_nexthop(self._raw(), nh_id, family, self.interface.num)
+        except OSError as exc:
+            if exc.errno != errno.EOPNOTSUPP:
+                raise
+            log.info(
+                "Kernel doesn't support nexthop objects, routes point at %s directly.",
+                self.interface.name,
+            )
+            self.nexthop_id = self.nexthops = None
+            return
+        self.nexthops = nexthops
+
+    def switch_interface(self, name: str):
+        """ Moves all routes to another interface. """
+        self._interface = name
+        self.interface = self.find_interface()
+        if self.mirror is not None:
+            self.mirror.interface_name = name
+        if self.nexthops is not None:
+            self.setup_nexthops()
+            return
+        routes = Networks.fromkeys(pack(x.with_netmask()) for x in self.current())
+        with self._raw_lock:
+            RouteCache.fromnetworks(routes, self.table).send(self._raw(), self.interface.num)
+        log.info("Moved %s routes to %s.", len(routes), name)
+
+    def _raw(self) -> socket.socket:
+        """ Raw netlink socket for messages pyroute2 can't make or can't make fast. """
+        if self._raw_sock is None:
+            self._raw_sock = open_socket()
+        return self._raw_sock
+
+    def watch(self) -> bool:
+        if self.mirror is None:
+            self.mirror = RouteMirror(
+                self.table,
+                self._interface,
+                ipv6=self.ipv6,
+                own_ports=self._ports,
+                on_up=self._interface_up,
+                nexthops=self._nexthop_ids,
+            )
+            self.mirror.start()
+        return True
+
+    def synced(self, desired: Networks):
+        if self.mirror is not None:
+            self.cache = RouteCache.fromnetworks(desired, self.table, self.nexthops)
+
+    def _nexthop_ids(self) -> ty.Set[int]:
+        nexthops = self.nexthops
+        return set(nexthops.values()) if nexthops is not None else set()
+
+    def _ports(self) -> ty.Set[int]:
+        """ Netlink port IDs of our sockets, the kernel marks our changes with them. """
+        ports = {self.getsockname()[0]}
+        if self._raw_sock is not None:
+            ports.add(self._raw_sock.getsockname()[0])
+        return ports
+
+    def _interface_up(self, interface: Interface):
+        """ Called by the mirror when the interface is back, maybe with the new index. """
+        self.interface = interface
+        # kernel removes nexthops of the interface going down
+        self.setup_nexthops()
+        if self.cache is None or not self.cache.count:
+            return
+        # don't block the mirror, it has to read notifications about these routes
+        threading.Thread(target=self.replay, name=f"replay-{self.table}", daemon=True).start()
+
+    def replay(self):
+        """ Reinstalls all routes of the cache via the current interface. """
+        with self._raw_lock:
+            cache, interface = self.cache, self.interface
+            start = time.monotonic()
+            sent, errors = cache.send(self._raw(), interface.num)
+        log.info(
+            "Reinstalled %s routes via %s in %.2fs, %s failed.",
+            sent, interface.name, time.monotonic() - start, errors,
+        )
+
+    def disconnect(self):
+        if self.mirror is not None:
+            self.mirror.stop()
+            self.mirror = None
+        if self._raw_sock is not None:
+            self._raw_sock.close()
+            self._raw_sock = None
+        self._pending = Networks()
+        self.close()
 
     def add(self, network: str):
+        if self.nexthops is not None:
+            self._pending.append(pack(network))
+            return
         try:
             self.route(
                 "add", dst=network, oif=self.interface.num, table=self.table, scope="link")
@@ -71,30 +354,81 @@ class LinuxRouteManager(pyroute2.IPRoute, Manager):
             if err.code != 17: # 17 = route exists
                 raise
 
+    def remove(self, network: str):
+        try:
+            family = socket.AF_INET6 if ":" in network else socket.AF_INET
+            # scope must match the one routes are added with
+            self.route("del", dst=network, table=self.table, scope="link", family=family)
+        except pyroute2.netlink.exceptions.NetlinkError as err:
+            if err.code != 3: # 3 = no such route
+                raise
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, Networks()
+        cache = RouteCache.fromnetworks(pending, self.table, self.nexthops)
+        with self._raw_lock:
+            sent, errors = cache.send(self._raw())
+        if errors == sent:
+            raise RuntimeError(f"Failed to add all {sent} routes to table {self.table}.")
+        if errors:
+            log.warning("Failed to add %s of %s routes to table %s.", errors, sent, self.table)
+
+    def apply_batch(self, adds: Networks, removes: Networks) -> ty.Tuple[int, int]:
+        """ Sends pre-serialized removals and additions in big batches. """
+        sent = {}
+        with self._raw_lock:
+            for name, cache in (
+                ("remove", RouteCache.fromnetworks(removes, self.table, remove=True)),
+                ("add", RouteCache.fromnetworks(adds, self.table, self.nexthops)),
+            ):
+                sent[name], errors = cache.send(self._raw(), self.interface.num)
+                if errors and errors == sent[name]:
+                    raise RuntimeError(
+                        f"Failed to {name} all {errors} routes of table {self.table}."
+                    )
+                if errors:
+                    log.warning(
+                        "Failed to %s %s of %s routes of table %s.",
+                        name, errors, sent[name], self.table,
+                    )
+        return sent["add"], sent["remove"]
+
+    @property
+    def families(self) -> ty.Tuple[int, ...]:
+        return (socket.AF_INET, socket.AF_INET6) if self.ipv6 else (socket.AF_INET,)
+
     def current(self):
-        return map(Route.fromdict, self.get_routes(table=self.table))
+        routes = self.mirror.snapshot() if self.mirror is not None else None
+        if routes is not None:
+            return routes
+        # 255 is pyroute2 hack to dump routes of all families
+        family = 255 if self.ipv6 else socket.AF_INET
+        return map(Route.fromdict, self.get_routes(family=family, table=self.table))
 
     ### rules ###
-    def show_rules(self) -> ty.Iterable:
-        return map(Rule.fromdict, self.get_rules(table=self.table))
+    def show_rules(self, family: int = socket.AF_INET) -> ty.Iterable:
+        return map(Rule.fromdict, self.get_rules(family=family, table=self.table))
 
     def check_rule(self, priority: int = None):
         priority = priority or self.priority
         if not priority:
             log.error("Failed to add rule - no priority provided")
-        try:
-            self.add_rule()
-        except (MultipleRulesExists, DifferentRuleExists) as e:
-            log.warning(e)
-        except RuleExistsError as e:
-            log.info(e)
-
-    def add_rule(self):
+        for family in self.families:
+            try:
+                self.add_rule(family)
+            except (MultipleRulesExists, DifferentRuleExists) as e:
+                log.warning(e)
+            except RuleExistsError as e:
+                log.info(e)
+
+    def add_rule(self, family: int = socket.AF_INET):
         """ Adds new rule for all addresses with lookup to a specified table. """
-        targets = [rule for rule in self.show_rules() if rule.table == self.table]
+        targets = [rule for rule in self.show_rules(family) if rule.table == self.table]
         if not targets:
             # create new rule if there is no any
-            self.rule("add", table=self.table, priority=self.priority)
+            self.rule("add", table=self.table, priority=self.priority, family=family)
         elif len(targets) == 1:
             if targets[0].priority == self.priority:
                 raise RuleExistsError(targets[0])
@@ -114,54 +448,277 @@ class LinuxRouteManager(pyroute2.IPRoute, Manager):
         return interfaces[0]
 
 
-class RouterosManager(routeros_api.RouterOsApiPool, Manager):
+# properties of address list entries to dump
+PROPLIST = ".id,address"
+# entries removed by a single command
+REMOVE_BATCH = 100
+
+
+class RouterosManager(routeros_api.RouterOsApiPool, Manager, ThreadedBatchManager):
     name = "routeros"
 
-    def __init__(self, addr, username, password, list_name, **kwargs):
+    def __init__(
+        self,
+        addr,
+        username,
+        password,
+        list_name,
+        throttle: ty.Optional[AIMDController] = None,
+        cpu_interval: float = 5.0,
+        ipv6: bool = False,
+        **kwargs,
+    ):
         super().__init__(addr, username, password, **kwargs)
         self.list_name = list_name
+        self.ipv6 = ipv6
+        # packed network -> entry ID, filled by current()
+        self._ids: ty.Dict[int, str] = {}
+        # writes are pipelined, throttle decides how many are in flight
+        self.throttle = throttle or AIMDController()
+        self.cpu_interval = cpu_interval
+        self._pending: ty.Deque[ty.Tuple[ty.Any, float, str]] = deque()
+        self._cpu_polled = 0.0
         self.api: ty.Optional[routeros_api.api.RouterOsApi] = None
         self.cmd: ty.Optional[routeros_api.resource.RouterOsResource] = None
+        self.cmd6: ty.Optional[routeros_api.resource.RouterOsResource] = None
         self.prepare()
 
     @classmethod
     def fromconf(cls, cfg: dict):
         if cfg is None:
             raise ValueError("Specify RouterOS connection and routing settings.")
-        return cls(
+        mgr = cls(
             cfg["addr"],
             username=cfg["username"],
             password=cfg["password"],
             list_name=cfg["list_name"],
+            throttle=AIMDController.fromconf(cfg.get("throttle")),
+            cpu_interval=cfg.get("cpu_interval", 5.0),
+            ipv6=cfg.get("ipv6", False),
         )
+        mgr.name = cfg.get("name", cls.name)
+        return mgr
 
     def disconnect(self):
+        self._pending.clear()
         routeros_api.RouterOsApiPool.disconnect(self)
 
     def add(self, network: str):
-        params = {"address": network, "list": self.list_name}
-        self._add_network(params)
-
-    def current(self) -> ty.List:
-        resp = self.get_raw_routes()
-        return map(RosRoute.fromdict, resp)
+        params = {
+            "address": network, "list": self.list_name, "comment": self.buckets.tag_of(network)
+        }
+        self._send(self._add_network, params, network)
+
+    def remove(self, network: str):
+        id_ = self._ids.pop(pack(network), None)
+        if id_ is None:
+            log.warning("No RouterOS entry ID known for %s, skipping.", network)
+            return
+        self._send(self._rm_route, (id_, ":" in network), network)
+
+    def apply_batch(self, adds: Networks, removes: Networks) -> ty.Tuple[int, int]:
+        """
+        Removes entries by lists of IDs, a command per `REMOVE_BATCH` of them,
+        additions are pipelined one by one, RouterOS can't add many at once.
+        IDs are the ones known from the last current().
+        """
+        removed = 0
+        for v6 in (False, True):
+            ids = []
+            for key in removes.v6 if v6 else removes.v4:
+                id_ = self._ids.pop(key, None)
+                if id_ is None:
+                    log.warning("No RouterOS entry ID known for %s, skipping.", unpack(key))
+                    continue
+                ids.append(id_)
+            for start in range(0, len(ids), REMOVE_BATCH):
+                batch = ids[start : start + REMOVE_BATCH]
+                self._send(self._rm_route, (",".join(batch), v6), f"{len(batch)} entries")
+                removed += len(batch)
+        for key in adds:
+            self.add(unpack(key))
+        self.flush()
+        return len(adds), removed
+
+    def flush(self):
+        while self._pending:
+            self._receive()
+        log.info("%s throttle state: %s", self.name, self.throttle)
+
+    def _send(self, method, arg, network: str):
+        self.throttle.wait()
+        self._poll_cpu()
+        self._pending.append((method(arg), time.monotonic(), network))
+        while len(self._pending) >= self.throttle.in_flight:
+            self._receive()
+
+    def _receive(self):
+        """ Waits for the response to the oldest command sent. """
+        promise, started, network = self._pending.popleft()
+        try:
+            promise.get()
+        except routeros_api.exceptions.RouterOsApiConnectionError:
+            self.throttle.observe(time.monotonic() - started, timeout=True)
+            raise
+        except routeros_api.exceptions.RouterOsApiCommunicationError as exc:
+            if b"already have such entry" in (exc.original_message or b""):
+                self.throttle.observe(time.monotonic() - started)
+                return
+            log.warning("Failed to change %s: %s", network, exc)
+            self.throttle.observe(time.monotonic() - started, error=True)
+            return
+        self.throttle.observe(time.monotonic() - started)
+
+    def _poll_cpu(self):
+        if not self.cpu_interval or time.monotonic() - self._cpu_polled < self.cpu_interval:
+            return
+        self._cpu_polled = time.monotonic()
+        resource = self.api.get_resource("/system/resource").get()
+        self.throttle.observe_cpu(int(resource[0]["cpu-load"]))
+
+    def current(self) -> ty.Iterator[RosRoute]:
+        """ Streams entries of the list, remembering their IDs for remove(). """
+        self._ids = {}
+        raws = self.get_raw_routes()
+        if self.ipv6:
+            raws = itertools.chain(raws, self.get_raw_routes(v6=True))
+        for _, route in self._routes(raws):
+            yield route
+
+    def _routes(self, raws: ty.Iterable[dict]) -> ty.Iterator[ty.Tuple[int, RosRoute]]:
+        """
+        Parses entries with their packed networks, remembering their IDs.
+        Lists may also have address ranges and DNS names others added,
+        such entries are skipped.
+        """
+        skipped = []
+        for raw in raws:
+            route = RosRoute.fromdict(raw)
+            try:
+                key = pack(route.dst)
+            except NetworkError:
+                skipped.append(route.dst)
+                continue
+            self._ids[key] = route.id
+            yield key, route
+        if skipped:
+            log.warning(
+                "Skipped %s entries of %s that aren't networks, like %r.",
+                len(skipped), self.name, skipped[0],
+            )
+
+    def summarize(self, expected: ty.Collection[Bucket]) -> Summary:
+        """
+        Counts entries of the expected buckets by their tags with count-only prints.
+        The device can't hash entries, so buckets are compared by counts.
+        If there are entries out of these buckets or without tags, the list is dumped.
+        """
+        summary: Summary = {}
+        total = 0
+        for v6 in (False, True) if self.ipv6 else (False,):
+            cmd = self.cmd6 if v6 else self.cmd
+            total += self._count(cmd, {"list": self.list_name})
+            for bucket in expected:
+                if bucket[0] != v6:
+                    continue
+                count = self._count(
+                    cmd, {"list": self.list_name, "comment": self.buckets.tag(bucket)}
+                )
+                if count:
+                    summary[bucket] = (count, None)
+        self.untagged = total - sum(x for x, _ in summary.values())
+        if self.untagged:
+            log.warning(
+                "%s entries of %s aren't tagged by expected buckets, dumping the list.",
+                self.untagged, self.name,
+            )
+            return super().summarize(expected)
+        return summary
+
+    def bucket_networks(self, selected: ty.Collection[Bucket]) -> Networks:
+        """ Fetches entries of the buckets by their tags, remembering their IDs. """
+        result = Networks()
+        for bucket in selected:
+            cmd = self.cmd6 if bucket[0] else self.cmd
+            queries = {"list": self.list_name, "comment": self.buckets.tag(bucket)}
+            for key, _ in self._routes(cmd.call_async("print", {"proplist": PROPLIST}, queries)):
+                result.append(key)
+        result.sort()
+        return result
+
+    def tag_buckets(self, desired: Networks) -> int:
+        """
+        Fixes bucket tags of entries vroute added (e.g. if `bucket_bits` changed),
+        returns how many changed. Entries without comments are vroute's if their
+        networks are `desired`, earlier versions added them so.
+        Other entries belong to others, their comments are kept
+        and they are counted as untagged.
+        """
+        changes = []
+        foreign = 0
+        for v6 in (False, True) if self.ipv6 else (False,):
+            cmd = self.cmd6 if v6 else self.cmd
+            args = {"proplist": ".id,address,comment"}
+            for raw in cmd.call_async("print", args, {"list": self.list_name}):
+                comment = raw.get("comment") or ""
+                if comment and not comment.startswith(TAG_PREFIX):
+                    foreign += 1
+                    continue
+                try:
+                    key = pack(raw["address"])
+                except NetworkError:
+                    # a range or a DNS name, maybe with the copied comment
+                    foreign += 1
+                    continue
+                if not comment and key not in desired:
+                    foreign += 1
+                    continue
+                tag = self.buckets.tag(self.buckets.of(key))
+                if comment != tag:
+                    changes.append((raw["id"], tag, v6))
+        # the dump is read to the end before changes are sent over the same connection
+        for change in changes:
+            self._send(self._set_comment, change, change[0])
+        self.flush()
+        self.untagged = foreign
+        return len(changes)
+
+    def _count(self, cmd: routeros_api.resource.RouterOsResource, queries: dict) -> int:
+        response = cmd.call_async("print", {"count-only": ""}, queries).get()
+        return int(response.done_message["ret"])
 
     def prepare(self):
         self.api = self.get_api()
         self.cmd = self.api.get_resource("/ip/firewall/address-list")
+        if self.ipv6:
+            self.cmd6 = self.api.get_resource("/ipv6/firewall/address-list")
 
     def do_sync(self, routes, to_skip):
         return self.add_all(routes, to_skip)
 
     # moved in method for mocking
-    def get_raw_routes(self):
-        return self.cmd.get(**{"list": self.list_name})
-
+    def get_raw_routes(self, v6: bool = False) -> ty.Iterator[dict]:
+        """
+        Streams entries of the list as their sentences arrive.
+        Only IDs and addresses are requested, the list is filtered by the device.
+        """
+        cmd = self.cmd6 if v6 else self.cmd
+        return iter(cmd.call_async("print", {"proplist": PROPLIST}, {"list": self.list_name}))
+
+    # both return promise of the response
     def _add_network(self, params: dict):
-        return self.cmd.add(**params)
+        cmd = self.cmd6 if ":" in params["address"] else self.cmd
+        return cmd.call_async("add", params)
 
-    def _rm_route(self, id_):
-        return self.cmd.remove(id=id_)
+    def _rm_route(self, entry: ty.Tuple[str, bool]):
+        id_, v6 = entry
+        cmd = self.cmd6 if v6 else self.cmd
+        return cmd.call_async("remove", {"id": id_})
+
+    def _set_comment(self, entry: ty.Tuple[str, str, bool]):
+        id_, comment, v6 = entry
+        cmd = self.cmd6 if v6 else self.cmd
+        return cmd.call_async("set", {"id": id_, "comment": comment})
 
     def add_all(self, addresses: ty.Iterable[str], to_skip: ty.Collection):
         added, skipped = 0, 0
@@ -170,20 +727,19 @@ class RouterosManager(routeros_api.RouterOsApiPool, Manager):
                 skipped += 1
                 continue
             added += 1
-            params = {"address": with_netmask(addr), "list": self.list_name}
-            log.debug("Add network arguments: %s", params)
-            resp = self._add_network(params)
-            log.debug("ROS response: %s", resp)
+            self.add(with_netmask(addr))
+        self.flush()
         return added, skipped
 
     def remove_outdated(self, keep: ty.Collection[str]) -> int:
         removed = 0
-        for route in self.current:
+        # the dump is read to the end before removals are sent over the same connection
+        stale = [x for x in self.current() if x.with_netmask() not in keep]
+        for route in stale:
             rstr = route.with_netmask()
-            if rstr in keep:
-                continue
-            self._rm_route(route.id)
+            self._send(self._rm_route, (route.id, ":" in rstr), rstr)
             removed += 1
+        self.flush()
         return removed
 
     def __enter__(self):
@@ -192,6 +748,131 @@ class RouterosManager(routeros_api.RouterOsApiPool, Manager):
     def __exit__(self, exc_type, value, tb):
         self.disconnect()
 
+
+class BirdManager(Manager, ThreadedBatchManager):
+    """
+    Manager of static routes BIRD announces over BGP (see bird.py).
+    The rendered file is the state: it's replaced only by reconfigurations
+    BIRD accepted, so the whole batch is applied at once.
+    """
+    name = "bird"
+    bulk = True
+    atomic_swap = True
+
+    def __init__(
+        self,
+        file: str,
+        control: ty.Optional[bird.BirdControl] = None,
+        protocol: str = "vroute",
+        route_to: str = "blackhole",
+        communities: ty.Iterable[str] = (),
+        table: ty.Optional[str] = None,
+        ipv6: bool = False,
+    ):
+        self.file = file
+        self.control = control or bird.BirdControl()
+        self.protocol = protocol
+        self.route_to = route_to
+        self.statements = bird.communities(communities)
+        self.table = table
+        self.ipv6 = ipv6
+        # changes of add() and remove(), applied by flush()
+        self._adds: ty.Set[int] = set()
+        self._removes: ty.Set[int] = set()
+        self.prepare()
+
+    @classmethod
+    def fromconf(cls, cfg: dict):
+        if not cfg.get("file"):
+            raise ValueError("Please specify file of BIRD routes in the configuration file.")
+        mgr = cls(
+            cfg["file"],
+            control=bird.BirdControl(cfg.get("socket", bird.DEFAULT_SOCKET)),
+            protocol=cfg.get("protocol", "vroute"),
+            route_to=cfg.get("route_to", "blackhole"),
+            communities=cfg.get("communities") or (),
+            table=cfg.get("table"),
+            ipv6=cfg.get("ipv6", False),
+        )
+        mgr.name = cfg.get("name", cls.name)
+        return mgr
+
+    def prepare(self):
+        # configuration including the file must be valid before the first sync
+        if not os.path.exists(self.file):
+            bird.replace(self.file, self._render(Networks()))
+
+    def add(self, network: str):
+        key = pack(network)
+        self._removes.discard(key)
+        self._adds.add(key)
+
+    def remove(self, network: str):
+        key = pack(network)
+        self._adds.discard(key)
+        self._removes.add(key)
+
+    def flush(self):
+        if not self._adds and not self._removes:
+            return
+        adds, removes = Networks.fromkeys(self._adds), Networks.fromkeys(self._removes)
+        self._adds, self._removes = set(), set()
+        self.apply_batch(adds, removes)
+
+    def disconnect(self):
+        self._adds, self._removes = set(), set()
+
+    def apply_batch(self, adds: Networks, removes: Networks) -> ty.Tuple[int, int]:
+        """ Renders the new set of routes and reconfigures BIRD, restores the file if it fails. """
+        kept, _ = current_networks(self).diff(removes)
+        kept.extend(adds)
+        kept.sort()
+        previous = bird.replace(self.file, self._render(kept))
+        try:
+            reply = self.control.configure()
+        except Exception:
+            if previous is not None:
+                os.replace(previous, self.file)
+            raise
+        log.info("%s: %s", self.name, reply)
+        return len(adds), len(removes)
+
+    def _render(self, networks: Networks) -> ty.Callable[[ty.TextIO], None]:
+        return lambda fd: bird.render(
+            fd, networks, self.protocol, self.route_to, self.statements, self.table, self.ipv6
+        )
+
+    def current(self) -> ty.Iterator[Route]:
+        try:
+            with open(self.file) as fd:
+                networks = list(bird.parse(fd))
+        except FileNotFoundError:
+            return iter(())
+        return (Route(x.split("/")[0], None, self.table, int(x.split("/")[1])) for x in networks)
+
+
+MANAGERS: ty.Dict[str, ty.Type[Manager]] = {
+    LinuxRouteManager.name: LinuxRouteManager,
+    RouterosManager.name: RouterosManager,
+    BirdManager.name: BirdManager,
+}
+
+
+def get_manager(device: dict) -> Manager:
+    """ Creates and connects manager for the device definition. """
+    try:
+        cls = MANAGERS[device["type"]]
+    except KeyError:
+        raise ValueError(f"Unknown device type {device['type']!r}") from None
+    mgr = cls.fromconf(device)
+    if "bucket_bits" in device:
+        mgr.buckets = Buckets(device["bucket_bits"])
+    if device.get("aggregate"):
+        mgr.aggregator = Aggregator.fromconf(device["aggregate"])
+    mgr.route_set = device.get("set", DEFAULT_SET)
+    return mgr
+
+
 # # # # # # # # # #
 # Rule exceptions #
 # # # # # # # # # #
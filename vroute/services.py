@@ -1,68 +1,821 @@
+from abc import ABC, abstractmethod
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime
 import typing as ty
 import logging
 
 import asyncpg
 
-from .routing import Manager
+from .extsort import sort_entries
+from .packed import (
+    InetCopyDecoder, NetworkError, Networks, is_v6, pack, pack_inet, pack_many, unpack
+)
+from .routing import DEFAULT_SET, BatchManager, Manager, as_batch
 
 log = logging.getLogger(__name__)
 
 
-EXISTS = "SELECT EXISTS (SELECT net FROM networks WHERE net=$1)"
+# server-side diff: device state is staged into a temporary table
+# and Postgres computes both anti-joins, so only the delta is transferred.
+CREATE_DEVICE_TABLE = "CREATE TEMP TABLE device_networks (net inet) ON COMMIT DROP;"
+INDEX_DEVICE_TABLE = "CREATE INDEX ON device_networks (net); ANALYZE device_networks;"
+TO_ADD = """
+SELECT n.net FROM networks n
+WHERE NOT EXISTS (SELECT 1 FROM device_networks d WHERE d.net = n.net);
+"""
+TO_REMOVE = """
+SELECT DISTINCT d.net FROM device_networks d
+WHERE NOT EXISTS (SELECT 1 FROM networks n WHERE n.net = d.net);
+"""
 
+DIFF_STRATEGIES = ("client", "server", "merge")
 
-class NetworkingService:
-    conn: asyncpg.Connection
+# connections of the service shared by concurrent calls
+POOL_SIZE = 10
+
+# keyset pagination over the primary key
+FIRST_PAGE = "SELECT net FROM networks ORDER BY net LIMIT $1;"
+NEXT_PAGE = "SELECT net FROM networks WHERE net > $1 ORDER BY net LIMIT $2;"
+
+# networks of the device missing in the database, by batches
+MISSING = """
+SELECT t.net FROM unnest($1::inet[]) AS t(net)
+WHERE NOT EXISTS (SELECT 1 FROM networks n WHERE n.net = t.net)
+ORDER BY t.net;
+"""
+
+# every network belongs to one or more sources (feeds), `networks` is their union.
+# Source generation is bumped by every replace, network generation
+# is the one it first appeared in.
+# Every source belongs to a route set, devices of the set route its networks.
+DEFAULT_SOURCE = "default"
+SCHEMA_LOCK = "SELECT pg_advisory_xact_lock(hashtext('vroute.schema'));"
+CREATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    name text PRIMARY KEY,
+    generation bigint NOT NULL DEFAULT 0,
+    loaded_at timestamptz
+);
+CREATE TABLE IF NOT EXISTS source_networks (
+    source text NOT NULL REFERENCES sources ON DELETE CASCADE,
+    net inet NOT NULL,
+    generation bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (source, net)
+);
+CREATE INDEX IF NOT EXISTS source_networks_net ON source_networks (net);
+ALTER TABLE sources ADD COLUMN IF NOT EXISTS route_set text NOT NULL DEFAULT 'default';
+"""
+# networks loaded before sources existed belong to the default one
+CREATE_DEFAULT_SOURCE = """
+INSERT INTO sources (name) VALUES ('default') ON CONFLICT DO NOTHING RETURNING name;
+"""
+ADOPT_NETWORKS = """
+INSERT INTO source_networks (source, net) SELECT 'default', net FROM networks
+ON CONFLICT DO NOTHING;
+"""
+
+# bulk loading: lines are COPY'd into a temporary table and inserted at once
+COPY_BATCH = 10000
+# chunks of changes waiting for the device while the diff goes on
+PIPELINE_DEPTH = 4
+CREATE_STAGED_TABLE = "CREATE TEMP TABLE staged_networks (net inet) ON COMMIT DROP;"
+INDEX_STAGED_TABLE = "CREATE INDEX ON staged_networks (net); ANALYZE staged_networks;"
+# bumps the generation and assigns the route set if given,
+# also locks the source against concurrent loads
+NEXT_GENERATION = """
+INSERT INTO sources (name, generation, loaded_at, route_set)
+VALUES ($1, 1, now(), COALESCE($2, 'default'))
+ON CONFLICT (name) DO UPDATE SET
+    generation = sources.generation + 1,
+    loaded_at = now(),
+    route_set = COALESCE($2, sources.route_set)
+RETURNING generation;
+"""
+INSERT_STAGED = """
+WITH added AS (
+    INSERT INTO source_networks (source, net, generation)
+    SELECT DISTINCT $1::text, net, $2::bigint FROM staged_networks
+    ON CONFLICT DO NOTHING RETURNING net
+), inserted AS (
+    INSERT INTO networks (net) SELECT net FROM added
+    ON CONFLICT DO NOTHING RETURNING net
+)
+SELECT (SELECT count(*) FROM inserted) AS count;
+"""
+# networks of the previous generation missing in the new one;
+# these are removed from `networks` unless other source has them
+REMOVE_UNSTAGED = """
+WITH removed AS (
+    DELETE FROM source_networks s
+    WHERE s.source = $1
+    AND NOT EXISTS (SELECT 1 FROM staged_networks t WHERE t.net = s.net)
+    RETURNING s.net
+), deleted AS (
+    DELETE FROM networks n USING removed r
+    WHERE n.net = r.net
+    AND NOT EXISTS (
+        SELECT 1 FROM source_networks o WHERE o.net = r.net AND o.source <> $1
+    )
+    RETURNING n.net
+)
+SELECT (SELECT count(*) FROM deleted) AS count;
+"""
+DELETE_STAGED = """
+WITH removed AS (
+    DELETE FROM source_networks s USING staged_networks t
+    WHERE s.source = $1 AND s.net = t.net
+    RETURNING s.net
+), deleted AS (
+    DELETE FROM networks n USING removed r
+    WHERE n.net = r.net
+    AND NOT EXISTS (
+        SELECT 1 FROM source_networks o WHERE o.net = r.net AND o.source <> $1
+    )
+    RETURNING n.net
+)
+SELECT (SELECT count(*) FROM deleted) AS count;
+"""
+# networks of route sets: the default one has networks no other set has,
+# so networks loaded before sets existed stay there.
+# Sets are read in one pass ordered by set, a NULL row ends every set.
+ROUTE_SETS = "SELECT route_set FROM sources UNION SELECT 'default' ORDER BY 1;"
+SET_NETWORKS = """
+WITH assigned AS (
+    SELECT DISTINCT s.route_set, n.net FROM source_networks n
+    JOIN sources s ON s.name = n.source
+    WHERE s.route_set <> 'default'
+)
+SELECT net FROM (
+    SELECT route_set, net FROM assigned
+    UNION ALL
+    SELECT 'default', n.net FROM networks n
+    WHERE NOT EXISTS (SELECT 1 FROM assigned a WHERE a.net = n.net)
+    UNION ALL
+    SELECT route_set, NULL FROM (SELECT route_set FROM sources UNION SELECT 'default') x
+) t ORDER BY route_set, net NULLS LAST
+"""
+# staged networks and ones covered by the prefixes are removed from every source,
+# containment is bounded by the range of the prefix so the primary key index is used
+COVERED = """
+n.net >= c.net AND n.net <<= c.net
+AND n.net <= set_masklen(broadcast(c.net), CASE family(c.net) WHEN 4 THEN 32 ELSE 128 END)
+"""
+REMOVE_NETWORKS = f"""
+WITH targets AS (
+    SELECT n.net FROM networks n JOIN staged_networks t ON t.net = n.net
+    UNION
+    SELECT n.net FROM networks n JOIN unnest($1::inet[]) AS c(net) ON {COVERED}
+), removed AS (
+    DELETE FROM networks n USING targets t WHERE n.net = t.net RETURNING n.net
+), unsourced AS (
+    DELETE FROM source_networks s USING removed r WHERE s.net = r.net
+)
+SELECT
+    (SELECT count(*) FROM removed) AS removed,
+    (
+        SELECT count(DISTINCT t.net) FROM staged_networks t
+        WHERE NOT EXISTS (SELECT 1 FROM networks n WHERE n.net = t.net)
+    ) + (
+        SELECT count(*) FROM unnest($1::inet[]) AS c(net)
+        WHERE NOT EXISTS (SELECT 1 FROM networks n WHERE {COVERED})
+    ) AS missing;
+"""
+
+
+class BaseNetworkingService(ABC):
+    """
+    Storage of networks. Every call uses its own connection,
+    so the service may be shared by concurrent tasks.
+    """
+
+    async def close(self):
+        """ Closes connections kept between calls. """
+
+    @abstractmethod
+    async def load_networks(
+        self,
+        file: ty.Union[ty.Iterable[str], ty.AsyncIterable[str]],
+        source: str = DEFAULT_SOURCE,
+        route_set: ty.Optional[str] = None,
+    ) -> ty.Tuple[int, int]:
+        """
+        Loads networks from file (or any iterable of lines),
+        returns how many added and how many already exists.
+        If `route_set` is given, the source is assigned to it.
+        """
+
+    @abstractmethod
+    async def replace_networks(
+        self,
+        file: ty.Union[ty.Iterable[str], ty.AsyncIterable[str]],
+        source: str,
+        route_set: ty.Optional[str] = None,
+    ) -> ty.Tuple[int, int]:
+        """
+        Replaces networks of the source with ones from file,
+        returns how many networks added and removed.
+        If `route_set` is given, the source is assigned to it.
+        """
+
+    @abstractmethod
+    async def delete_networks(
+        self,
+        file: ty.Union[ty.Iterable[str], ty.AsyncIterable[str]],
+        source: str = DEFAULT_SOURCE,
+    ) -> int:
+        """
+        Removes networks of the file from the source, returns how many networks
+        are removed, ones other sources have are kept.
+        """
+
+    @abstractmethod
+    async def remove_networks(
+        self,
+        file: ty.Union[ty.Iterable[str], ty.AsyncIterable[str]],
+        covered_by: ty.Iterable[str] = (),
+    ) -> ty.Tuple[int, int]:
+        """
+        Removes networks of the file and ones within `covered_by` prefixes
+        from every source, returns how many removed and how many
+        networks (or prefixes) are not found.
+        """
+
+    @abstractmethod
+    def iter_networks(
+        self, after: ty.Optional[str] = None, page_size: int = 10000
+    ) -> ty.AsyncIterator[str]:
+        """ Streams networks in order, starting after `after`. """
+
+    @abstractmethod
+    def missing(
+        self, networks: Networks, after: ty.Optional[str] = None, batch: int = 10000
+    ) -> ty.AsyncIterator[str]:
+        """ Streams networks (after `after`) that aren't stored. """
+
+    @abstractmethod
+    def iter_packed(self, max_chunks: int = 4) -> ty.AsyncIterator[Networks]:
+        """ Streams all networks in order as chunks of packed integers. """
+
+    @abstractmethod
+    async def route_sets(self) -> ty.List[str]:
+        """ Returns names of route sets sources belong to, always with the default one. """
+
+    @abstractmethod
+    def iter_sets(self, max_chunks: int = 4) -> ty.AsyncIterator[ty.Tuple[str, Networks]]:
+        """
+        Streams networks of all route sets in one pass, set by set,
+        as chunks of packed integers with the name of their set.
+        """
+
+    @abstractmethod
+    def _export_diff(
+        self, batch: BatchManager, strategy: str, skip: ty.Optional[ty.Callable[[int], bool]]
+    ) -> ty.AsyncIterator[ty.Tuple[Networks, Networks]]:
+        """ Yields networks missing on the device and ones missing here, by chunks. """
+
+    async def fetch_packed(self) -> Networks:
+        """ Returns all networks from the database, packed and sorted. """
+        result = Networks(sorted_=False)
+        async for chunk in self.iter_packed():
+            result.extend(chunk)
+        result.sort()
+        return result
+
+    async def fetch_sets(self) -> ty.Dict[str, Networks]:
+        """ Returns networks of every route set, packed and sorted. """
+        result: ty.Dict[str, Networks] = {}
+        async for name, chunk in self.iter_sets():
+            result.setdefault(name, Networks(sorted_=False)).extend(chunk)
+        for networks in result.values():
+            networks.sort()
+        return result
+
+    async def export(
+        self,
+        manager: Manager,
+        strategy: str = "client",
+        prune: bool = False,
+        sort_buffer: int = 100000,
+    ) -> ty.Tuple[int, int]:
+        """
+        Adds networks missing on the device and, if `prune` is set,
+        removes ones that aren't in the database.
+        `strategy` selects where the diff is computed:
+        "client" streams the whole table and compares it here,
+        "server" stages the device state in Postgres and fetches only the delta
+        (local storage has no server, it's the same as "client" there),
+        "merge" walks the table and the device state sorted by at most
+        `sort_buffer` entries in memory, together.
+        Networks of devices with aggregation, and of all devices once sources
+        are assigned to route sets, are always compared here.
+        Changes are applied by the batch protocol of the manager.
+        Returns how many networks added and removed.
+        """
+        if strategy not in DIFF_STRATEGIES:
+            raise ValueError(f"Unknown diff strategy {strategy!r}")
+        batch = as_batch(manager)
+        # IPv6 networks are exported only to managers supporting them
+        skip = None if getattr(manager, "ipv6", False) else is_v6
+        if manager.aggregator is not None or await self.route_sets() != [DEFAULT_SET]:
+            if strategy != "client":
+                log.warning(
+                    "%s diff isn't used for %s: networks of aggregated devices"
+                    " and of route sets are compared here.",
+                    strategy.capitalize(), manager.name,
+                )
+            chunks = self._export_fitted(manager, batch, skip)
+        elif strategy == "merge":
+            chunks = self._export_merge(manager, sort_buffer)
+        else:
+            chunks = self._export_diff(batch, strategy, skip)
+        return await pipeline(batch, chunks, prune)
+
+    async def _export_fitted(
+        self, manager: Manager, batch: BatchManager, skip=None
+    ) -> ty.AsyncIterator[ty.Tuple[Networks, Networks]]:
+        # aggregated networks and route sets aren't in the `networks` table,
+        # so they are compared here
+        desired = (await self.fetch_sets()).get(manager.route_set, Networks())
+        if skip is not None:
+            desired = desired.only_v4()
+        yield manager.fit(desired).networks.diff(await batch.networks())
+
+    def _export_merge(
+        self, manager: Manager, sort_buffer: int
+    ) -> ty.AsyncIterator[ty.Tuple[Networks, Networks]]:
+        """ Merge-joins the database with the device state sorted by `sort_buffer` entries. """
+        entries = ((pack(x.with_netmask()), "") for x in manager.current())
+        device = (key for key, _ in sort_entries(entries, sort_buffer))
+        return self._merge_join(device, getattr(manager, "ipv6", False))
+
+    async def _merge_join(
+        self, device: ty.Iterator[int], ipv6: bool
+    ) -> ty.AsyncIterator[ty.Tuple[Networks, Networks]]:
+        """
+        Walks sorted networks of the database and of the device together,
+        yields networks to add and to remove by chunks of the database.
+        """
+        # the first entry is ready when the device is dumped and sorted
+        theirs = await asyncio.get_event_loop().run_in_executor(None, next, device, None)
+        previous = -1
+        async for chunk in self.iter_packed():
+            adds, removes = Networks(), Networks()
+            for key in chunk:
+                if key <= previous:
+                    raise ValueError(
+                        f"Networks are out of order at {unpack(key)},"
+                        " some of them have host bits set."
+                    )
+                previous = key
+                if not ipv6 and is_v6(key):
+                    continue
+                while theirs is not None and theirs < key:
+                    removes.append(theirs)
+                    theirs = next(device, None)
+                if theirs is not None and theirs == key:
+                    theirs = next(device, None)
+                    continue
+                adds.append(key)
+            yield adds, removes
+        removes = Networks()
+        while theirs is not None:
+            removes.append(theirs)
+            theirs = next(device, None)
+        yield Networks(), removes
+
+
+async def pipeline(
+    batch: BatchManager,
+    chunks: ty.AsyncIterator[ty.Tuple[Networks, Networks]],
+    prune: bool,
+    depth: int = PIPELINE_DEPTH,
+) -> ty.Tuple[int, int]:
+    """
+    Applies chunks of changes while the next ones are computed.
+    At most `depth` chunks wait for the device, then the diff waits for it,
+    the device takes all waiting chunks at once.
+    Devices applying batches at once get the whole diff in one batch.
+    Returns how many networks added and removed.
+    """
+    if batch.atomic_swap:
+        adds, removes = Networks(sorted_=False), Networks(sorted_=False)
+        try:
+            async for chunk in chunks:
+                adds.extend(chunk[0])
+                removes.extend(chunk[1])
+        finally:
+            await chunks.aclose()
+        return await _apply(batch, adds, removes if prune else Networks())
+    queue: asyncio.Queue = asyncio.Queue(maxsize=depth)
+    sent = [0, 0]
+
+    async def write():
+        while True:
+            # takes everything queued while the previous chunk was applied
+            items = [await queue.get()]
+            while not queue.empty():
+                items.append(queue.get_nowait())
+            adds, removes = Networks(sorted_=False), Networks(sorted_=False)
+            for item in items:
+                if item is not None:
+                    adds.extend(item[0])
+                    removes.extend(item[1])
+            added, removed = await _apply(batch, adds, removes)
+            sent[0] += added
+            sent[1] += removed
+            # the end of input is queued last
+            if items[-1] is None:
+                return
+
+    writer = asyncio.ensure_future(write())
+    try:
+        async for adds, removes in chunks:
+            if not prune:
+                removes = Networks()
+            if adds or removes:
+                await _put(queue, (adds, removes), writer)
+        await _put(queue, None, writer)
+        await writer
+    finally:
+        writer.cancel()
+        await chunks.aclose()
+    return sent[0], sent[1]
+
+
+async def _apply(batch: BatchManager, adds: Networks, removes: Networks) -> ty.Tuple[int, int]:
+    if not adds and not removes:
+        return 0, 0
+    adds.sort()
+    removes.sort()
+    return await batch.apply(adds, removes)
+
+
+async def _put(queue: asyncio.Queue, item, writer: asyncio.Future):
+    """ Waits for the room in the queue, unless the writer fails. """
+    put = asyncio.ensure_future(queue.put(item))
+    await asyncio.wait([put, writer], return_when=asyncio.FIRST_COMPLETED)
+    if not put.done():
+        put.cancel()
+        # failed or finished early
+        writer.result()
+        raise RuntimeError("Writer of the device finished before its input")
+
+
+class NetworkingService(BaseNetworkingService):
+    """
+    PostgreSQL storage. Every call acquires its own connection of the pool,
+    the pool is created on first use in the event loop.
+    """
 
     def __init__(self, settings: ty.Mapping):
         self.settings = settings
-        self.conn = None
-
-    async def connect(self):
-        self.conn = await asyncpg.connect(
-            host=self.settings["host"],
-            user=self.settings["user"],
-            password=self.settings["password"],
-            database=self.settings["database"],
-        )
+        self._pool: ty.Optional[asyncio.Future] = None
+        self._pool_loop: ty.Optional[asyncio.AbstractEventLoop] = None
 
-    async def close(self):
-        await self.conn.close()
+    async def pool(self) -> asyncpg.pool.Pool:
+        loop = asyncio.get_event_loop()
+        if self._pool is None or self._pool_loop is not loop:
+            # pool is bound to the loop, every asyncio.run() gets its own
+            self._pool_loop = loop
+            self._pool = asyncio.ensure_future(
+                asyncpg.create_pool(
+                    host=self.settings["host"],
+                    user=self.settings["user"],
+                    password=self.settings["password"],
+                    database=self.settings["database"],
+                    min_size=1,
+                    max_size=POOL_SIZE,
+                )
+            )
+        pool = self._pool
+        try:
+            # concurrent first calls wait for the same pool
+            return await asyncio.shield(pool)
+        except Exception:
+            if self._pool is pool:
+                self._pool = None
+            raise
 
-    async def __aenter__(self):
-        await self.connect()
+    @asynccontextmanager
+    async def connection(self) -> ty.AsyncIterator[asyncpg.Connection]:
+        """ Connection of the pool, held by the single call. """
+        pool = await self.pool()
+        async with pool.acquire() as conn:
+            yield conn
 
-    async def __aexit__(self, exc_type, exc, tb):
-        await self.close()
+    async def close(self):
+        pool, self._pool = self._pool, None
+        if pool is None or self._pool_loop is not asyncio.get_event_loop():
+            return
+        try:
+            pool = await pool
+        except Exception:  # pylint:disable=broad-except
+            return
+        await pool.close()
 
-    async def load_networks(self, file: ty.Iterable[str]) -> ty.Tuple[int, int]:
+    async def load_networks(
+        self,
+        file: ty.Union[ty.Iterable[str], ty.AsyncIterable[str]],
+        source: str = DEFAULT_SOURCE,
+        route_set: ty.Optional[str] = None,
+    ) -> ty.Tuple[int, int]:
         """
-        Loads networks from file into the database,
+        Loads networks from file (or any iterable of lines) into the database,
         returns how many added and how many already exists.
+        Lines are staged with COPY by batches and inserted at once,
+        so file isn't read into memory.
+        """
+        async with self.connection() as conn:
+            async with conn.transaction():
+                await self.create_schema(conn)
+                staged = await self._stage(conn, file)
+                generation = await conn.fetchval(NEXT_GENERATION, source, route_set)
+                count = await conn.fetchval(INSERT_STAGED, source, generation)
+        return count, staged - count
+
+    async def replace_networks(
+        self,
+        file: ty.Union[ty.Iterable[str], ty.AsyncIterable[str]],
+        source: str,
+        route_set: ty.Optional[str] = None,
+    ) -> ty.Tuple[int, int]:
+        """
+        Replaces networks of the source with the new generation from file,
+        returns how many networks added to and removed from the database.
+        The delta against the previous generation is computed in SQL
+        and applied in one transaction, networks of other sources are kept.
+        """
+        async with self.connection() as conn:
+            async with conn.transaction():
+                await self.create_schema(conn)
+                staged = await self._stage(conn, file)
+                await conn.execute(INDEX_STAGED_TABLE)
+                generation = await conn.fetchval(NEXT_GENERATION, source, route_set)
+                removed = await conn.fetchval(REMOVE_UNSTAGED, source)
+                added = await conn.fetchval(INSERT_STAGED, source, generation)
+        log.info(
+            "Source %s generation %s: %s networks, %s added, %s removed",
+            source, generation, staged, added, removed,
+        )
+        return added, removed
+
+    async def delete_networks(
+        self,
+        file: ty.Union[ty.Iterable[str], ty.AsyncIterable[str]],
+        source: str = DEFAULT_SOURCE,
+    ) -> int:
+        async with self.connection() as conn:
+            async with conn.transaction():
+                await self.create_schema(conn)
+                await self._stage(conn, file)
+                await conn.execute(INDEX_STAGED_TABLE)
+                removed = await conn.fetchval(DELETE_STAGED, source)
+        log.info("Removed %s networks of source %s", removed, source)
+        return removed
+
+    async def remove_networks(
+        self,
+        file: ty.Union[ty.Iterable[str], ty.AsyncIterable[str]],
+        covered_by: ty.Iterable[str] = (),
+    ) -> ty.Tuple[int, int]:
+        """
+        Removes networks of the file and ones within `covered_by` prefixes
+        from every source, returns how many removed and how many not found.
+        Lines are staged with COPY and removed by one statement.
+        """
+        prefixes = [unpack(pack(x)) for x in covered_by]
+        async with self.connection() as conn:
+            async with conn.transaction():
+                await self.create_schema(conn)
+                await self._stage(conn, file)
+                await conn.execute(INDEX_STAGED_TABLE)
+                removed, missing = await conn.fetchrow(REMOVE_NETWORKS, prefixes)
+        log.info("Removed %s networks, %s not found", removed, missing)
+        return removed, missing
+
+    async def create_schema(self, conn: asyncpg.Connection):
+        """ Creates tables of sources, if they don't exist. """
+        await conn.execute(SCHEMA_LOCK)
+        await conn.execute(CREATE_SCHEMA)
+        if await conn.fetchval(CREATE_DEFAULT_SOURCE):
+            await conn.execute(ADOPT_NETWORKS)
+
+    async def _stage(self, conn: asyncpg.Connection, file) -> int:
+        """ Copies lines into the temporary table, returns their count. """
+        await conn.execute(CREATE_STAGED_TABLE)
+        staged = 0
+        async for batch in _batches(file, COPY_BATCH):
+            await conn.copy_records_to_table(
+                "staged_networks", records=[(unpack(x),) for x in batch], columns=["net"]
+            )
+            staged += len(batch)
+        return staged
+
+    async def iter_networks(
+        self, after: ty.Optional[str] = None, page_size: int = 10000
+    ) -> ty.AsyncIterator[str]:
+        """
+        Streams networks ordered by the primary key, starting after `after`.
+        Every page is a short query, so no long transaction or cursor is held.
+        """
+        async with self.connection() as conn:
+            while True:
+                if after is None:
+                    rows = await conn.fetch(FIRST_PAGE, page_size)
+                else:
+                    rows = await conn.fetch(NEXT_PAGE, after, page_size)
+                for row in rows:
+                    yield unpack(pack_inet(row["net"]))
+                if len(rows) < page_size:
+                    break
+                after = rows[-1]["net"]
+
+    async def missing(
+        self, networks: Networks, after: ty.Optional[str] = None, batch: int = 10000
+    ) -> ty.AsyncIterator[str]:
+        """ Streams networks (after `after`) that aren't in the database. """
+        start = pack(after) if after else -1
+        async with self.connection() as conn:
+            chunk: ty.List[str] = []
+            for key in networks:
+                if key <= start:
+                    continue
+                chunk.append(unpack(key))
+                if len(chunk) < batch:
+                    continue
+                for row in await conn.fetch(MISSING, chunk):
+                    yield unpack(pack_inet(row["net"]))
+                chunk = []
+            if chunk:
+                for row in await conn.fetch(MISSING, chunk):
+                    yield unpack(pack_inet(row["net"]))
+
+    async def iter_packed(self, max_chunks: int = 4) -> ty.AsyncIterator[Networks]:
         """
-        async with self:
-            return await self._load_networks(file)
-
-    async def _load_networks(self, file: ty.Iterable[str]) -> ty.Tuple[int, int]:
-        count, exists = 0, 0
-        for network in file:
-            network = network.rstrip()
-            net_exists = await self.conn.fetchval(EXISTS, network)
-            if net_exists:
-                log.debug("%s exists", network)
-                exists += 1
+        Streams networks from the database as chunks of packed integers
+        using binary COPY. At most `max_chunks` decoded chunks are buffered,
+        COPY is paused until consumer catches up.
+        """
+        async with self.connection() as conn:
+            query = "SELECT net FROM networks ORDER BY net"
+            async for _, chunk in self._copy_packed(conn, query, max_chunks):
+                yield chunk
+
+    async def route_sets(self) -> ty.List[str]:
+        async with self.connection() as conn:
+            return await self._route_sets(conn)
+
+    async def _route_sets(self, conn: asyncpg.Connection) -> ty.List[str]:
+        try:
+            # the savepoint keeps the outer transaction usable
+            async with conn.transaction():
+                return [x["route_set"] for x in await conn.fetch(ROUTE_SETS)]
+        except (asyncpg.UndefinedTableError, asyncpg.UndefinedColumnError):
+            # sources weren't loaded yet
+            return [DEFAULT_SET]
+
+    async def iter_sets(self, max_chunks: int = 4) -> ty.AsyncIterator[ty.Tuple[str, Networks]]:
+        """
+        Streams networks of route sets with one binary COPY ordered by set.
+        Without other sets the default one is the `networks` table.
+        """
+        if await self.route_sets() == [DEFAULT_SET]:
+            async for chunk in self.iter_packed(max_chunks):
+                yield DEFAULT_SET, chunk
+            return
+        async with self.connection() as conn:
+            # names and networks of sets are read from the same snapshot
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                names = await self._route_sets(conn)
+                async for group, chunk in self._copy_packed(conn, SET_NETWORKS, max_chunks):
+                    yield names[group], chunk
+
+    async def _copy_packed(
+        self, conn: asyncpg.Connection, query: str, max_chunks: int
+    ) -> ty.AsyncIterator[ty.Tuple[int, Networks]]:
+        """ Yields chunks of the query by binary COPY with numbers of their groups. """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=max_chunks)
+        decoder = InetCopyDecoder()
+        group = 0
+
+        async def output(data):
+            nonlocal group
+            chunk = decoder.feed(data)
+            while True:
+                if chunk:
+                    await queue.put((group, chunk))
+                if not decoder.group_ended:
+                    break
+                group += 1
+                chunk = decoder.feed(b"")
+
+        async def copy():
+            try:
+                await conn.copy_from_query(query, output=output, format="binary")
+            finally:
+                await queue.put(None)
+
+        task = asyncio.ensure_future(copy())
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                yield item
+            await task
+        finally:
+            task.cancel()
+        log.debug("Fetched %s networks with binary COPY", decoder.rows)
+
+    async def _export_diff(self, batch: BatchManager, strategy: str, skip=None):
+        current = set(await batch.networks())
+        async with self.connection() as conn:
+            async with conn.transaction(isolation="serializable"):
+                if strategy == "server":
+                    chunks = self._export_server(conn, current, skip)
+                else:
+                    chunks = self._export_client(conn, current, skip)
+                async for chunk in chunks:
+                    yield chunk
+
+    async def _export_client(
+        self, conn: asyncpg.Connection, current: ty.Set[int], skip=None
+    ):
+        adds = Networks()
+        cursor = conn.cursor("SELECT net FROM networks;", prefetch=COPY_BATCH)
+        async for record in cursor:
+            key = pack_inet(record["net"])
+            if skip and skip(key):
+                continue
+            if key in current:
+                # whatever left in the set is outdated
+                current.discard(key)
+                continue
+            adds.append(key)
+            if len(adds) >= COPY_BATCH:
+                yield adds, Networks()
+                adds = Networks()
+        yield adds, Networks.fromkeys(current)
+
+    async def _export_server(
+        self, conn: asyncpg.Connection, current: ty.Set[int], skip=None
+    ):
+        await conn.execute(CREATE_DEVICE_TABLE)
+        await conn.copy_records_to_table(
+            "device_networks", records=((unpack(x),) for x in current), columns=["net"]
+        )
+        await conn.execute(INDEX_DEVICE_TABLE)
+        adds = Networks()
+        count = 0
+        async for record in conn.cursor(TO_ADD, prefetch=COPY_BATCH):
+            key = pack_inet(record["net"])
+            if skip and skip(key):
                 continue
-            await self.conn.execute("INSERT INTO networks (net) VALUES ($1);", network)
+            adds.append(key)
             count += 1
-        return count, exists
-
-    async def export(self, manager: Manager):
-        async with self:
-            current: ty.Set[str] = {x.with_netmask() for x in manager.current()}
-            async with self.conn.transaction(isolation="serializable"):
-                async for record in self.conn.cursor("SELECT net FROM networks;"):
-                    network = str(record["net"])
-                    if network in current:
-                        continue
-                    manager.add(str(network))
+            if len(adds) >= COPY_BATCH:
+                yield adds, Networks()
+                adds = Networks()
+        outdated = [pack_inet(x["net"]) for x in await conn.fetch(TO_REMOVE)]
+        log.debug("Server-side diff: %s to add, %s outdated", count, len(outdated))
+        yield adds, Networks.fromkeys(outdated)
+
+
+async def _batches(
+    lines: ty.Union[ty.Iterable[str], ty.AsyncIterable[str]], size: int
+) -> ty.AsyncIterator[ty.List[int]]:
+    """ Groups non-empty lines into batches of packed networks, validating them. """
+    if hasattr(lines, "__aiter__"):
+        iterator = lines
+    else:
+        iterator = _aiter(lines)
+    batch: ty.List[str] = []
+    linenos: ty.List[int] = []
+    lineno = 0
+    async for line in iterator:
+        lineno += 1
+        line = line.strip()
+        if not line:
+            continue
+        batch.append(line)
+        linenos.append(lineno)
+        if len(batch) >= size:
+            yield _pack_batch(batch, linenos)
+            batch, linenos = [], []
+    if batch:
+        yield _pack_batch(batch, linenos)
+
+
+def _pack_batch(lines: ty.List[str], linenos: ty.List[int]) -> ty.List[int]:
+    try:
+        return pack_many(lines)
+    except NetworkError as exc:
+        # position in the batch -> line of the file
+        exc.lineno = linenos[exc.lineno - 1]
+        raise
+
+
+async def _aiter(iterable: ty.Iterable):
+    for item in iterable:
+        yield item
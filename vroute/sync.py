@@ -0,0 +1,291 @@
+"""
+Synchronization of many devices at once.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+import typing as ty
+from pathlib import Path
+
+from . import packed
+from .journal import ADD, REMOVE, Journal, Plan
+from .routing import (
+    DEFAULT_SET,
+    BatchManager,
+    Manager,
+    ThreadedBatchManager,
+    as_batch,
+    current_networks,
+    get_manager,
+)
+from .services import DIFF_STRATEGIES, BaseNetworkingService
+
+log = logging.getLogger(__name__)
+
+
+class SyncResult:
+    """ Outcome of the device synchronization. """
+
+    __slots__ = ("device", "added", "removed", "elapsed", "error", "resumed", "swept", "swept6")
+
+    def __init__(self, device: str):
+        self.device = device
+        self.added = 0
+        self.removed = 0
+        self.elapsed = 0.0
+        self.error: ty.Optional[str] = None
+        self.resumed = False
+        # addresses swept in by aggregation of the device networks
+        self.swept = 0
+        self.swept6 = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def asdict(self) -> dict:
+        return {x: getattr(self, x) for x in self.__slots__}
+
+    def __repr__(self):
+        return f"<SyncResult({self.device!r}, +{self.added}, -{self.removed})>"
+
+
+class Syncer:
+    """
+    Fans out synchronization to all devices.
+    Networks of all route sets are fetched from the database in one pass and shared,
+    devices are synchronized in threads, at most `workers` at the same time.
+    Slow or unreachable device fails by its timeout without stalling others.
+    If `journal_dir` is set, progress is journaled by batches of `batch_size`
+    and interrupted synchronization of the device is resumed.
+    With "server" and "merge" `strategy` every device is exported with the diff
+    computed by the storage instead, these stream changes and aren't journaled.
+    If `managers` dict is given, managers that can watch their devices
+    are kept in it between runs.
+    """
+
+    def __init__(
+        self,
+        service: BaseNetworkingService,
+        devices: ty.Sequence[dict],
+        workers: int = 4,
+        timeout: ty.Optional[float] = None,
+        prune: bool = False,
+        journal_dir: ty.Optional[Path] = None,
+        batch_size: int = 1000,
+        managers: ty.Optional[ty.Dict[str, Manager]] = None,
+        strategy: str = "client",
+        sort_buffer: int = 100000,
+    ):
+        if strategy not in DIFF_STRATEGIES:
+            raise ValueError(f"Unknown diff strategy {strategy!r}")
+        self.service = service
+        self.devices = devices
+        self.workers = workers
+        self.timeout = timeout
+        self.prune = prune
+        self.journal_dir = journal_dir
+        self.batch_size = batch_size
+        # device name -> manager, for closing managers of timed out devices
+        self._managers: ty.Dict[str, Manager] = {}
+        self.kept = managers
+        self.strategy = strategy
+        self.sort_buffer = sort_buffer
+        self._loop: ty.Optional[asyncio.AbstractEventLoop] = None
+
+    @classmethod
+    def fromconf(
+        cls,
+        cfg,
+        service: BaseNetworkingService,
+        prune: ty.Optional[bool] = None,
+        managers: ty.Optional[ty.Dict[str, Manager]] = None,
+        strategy: ty.Optional[str] = None,
+    ):
+        return cls(
+            service,
+            cfg.devices,
+            workers=cfg.sync_workers,
+            timeout=cfg.sync_timeout,
+            prune=cfg.prune if prune is None else prune,
+            journal_dir=cfg.journal_dir,
+            batch_size=cfg.sync_batch_size,
+            managers=managers,
+            strategy=strategy or cfg.diff_strategy,
+            sort_buffer=cfg.sort_buffer,
+        )
+
+    async def run(self) -> ty.List[SyncResult]:
+        self._loop = asyncio.get_event_loop()
+        sets: ty.Dict[str, packed.Networks] = {}
+        if self.strategy == "client":
+            sets = await self.service.fetch_sets()
+        for name, networks in sets.items():
+            log.info("%r of set %s in the database, %s bytes", networks, name, networks.nbytes)
+        semaphore = asyncio.Semaphore(self.workers)
+        # timed out threads can't be killed, so every device has its own thread
+        # and concurrency is limited by the semaphore
+        pool = ThreadPoolExecutor(max_workers=max(len(self.devices), 1))
+        desired = [sets.get(x.get("set", DEFAULT_SET), packed.Networks()) for x in self.devices]
+        try:
+            return await asyncio.gather(
+                *(
+                    self._run_device(x, networks, pool, semaphore)
+                    for x, networks in zip(self.devices, desired)
+                )
+            )
+        finally:
+            # don't wait for the threads of timed out devices
+            pool.shutdown(wait=False)
+
+    async def _run_device(self, device, desired, pool, semaphore) -> SyncResult:
+        result = SyncResult(device["name"])
+        timeout = device.get("timeout", self.timeout)
+        loop = asyncio.get_event_loop()
+        async with semaphore:
+            start = time.monotonic()
+            if self.strategy == "client":
+                future = loop.run_in_executor(pool, self.sync_device, device, desired, result)
+            else:
+                future = self.export_device(device, result, pool)
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                result.error = f"timed out after {timeout} seconds"
+                # break the connection so the thread fails as soon as possible
+                mgr = self._managers.get(result.device)
+                if self.kept is not None:
+                    self.kept.pop(result.device, None)
+                if mgr is not None:
+                    mgr.disconnect()
+            except Exception as exc:  # pylint:disable=broad-except
+                log.exception("Failed to synchronize %s:", result.device)
+                result.error = str(exc) or type(exc).__name__
+            result.elapsed = time.monotonic() - start
+        return result
+
+    def sync_device(self, device: dict, desired: packed.Networks, result: SyncResult):
+        if not device.get("ipv6"):
+            desired = desired.only_v4()
+        mgr = self.get_manager(device)
+        fitted = mgr.fit(desired)
+        desired, result.swept, result.swept6 = fitted.networks, fitted.swept, fitted.swept6
+        journal = self.get_journal(result.device)
+        ok = False
+        try:
+            plan = journal.load() if journal else None
+            if plan is not None:
+                log.info("Resuming synchronization of %s: %s", result.device, plan)
+                result.resumed = True
+                journal.resume()
+                if plan.pending_removes:
+                    # entries are removed by their IDs on the device, current() collects them
+                    for _ in mgr.current():
+                        pass
+                self._run_plan(mgr, journal, plan, desired, result)
+            # networks desired since the interrupted run aren't in its plan,
+            # so the resumed one is followed by the fresh diff
+            to_add, to_remove = desired.diff(current_networks(mgr))
+            if not self.prune:
+                to_remove = packed.Networks()
+            if journal:
+                plan = journal.begin(to_add, to_remove)
+            else:
+                plan = Plan(to_add, to_remove)
+            self._run_plan(mgr, journal, plan, desired, result)
+            if journal:
+                journal.finish()
+            mgr.synced(desired)
+            ok = True
+        finally:
+            if journal:
+                journal.close()
+            self._release(mgr, result.device, ok)
+
+    async def export_device(self, device: dict, result: SyncResult, pool: ThreadPoolExecutor):
+        """ Exports networks to the device with the diff of `strategy`. """
+        loop = asyncio.get_event_loop()
+        mgr = await loop.run_in_executor(pool, self.get_manager, device)
+        ok = False
+        try:
+            result.added, result.removed = await self.service.export(
+                mgr, strategy=self.strategy, prune=self.prune, sort_buffer=self.sort_buffer
+            )
+            ok = True
+        finally:
+            # the export is cancelled on timeout, so the manager is released here
+            self._managers.pop(result.device, None)
+            self._release(mgr, result.device, ok)
+
+    def _release(self, mgr: Manager, device: str, ok: bool):
+        """ Disconnects the manager unless it's kept between runs. """
+        kept = self.kept is not None and self.kept.get(device) is mgr
+        if kept and not ok:
+            # the connection may be broken, next run creates the new one
+            del self.kept[device]
+        if not (kept and ok):
+            mgr.disconnect()
+
+    def get_manager(self, device: dict) -> Manager:
+        """ Returns the kept manager of the device or connects the new one. """
+        mgr = self.kept.get(device["name"]) if self.kept is not None else None
+        if mgr is not None:
+            try:
+                mgr.prepare()
+            except Exception:
+                del self.kept[device["name"]]
+                mgr.disconnect()
+                raise
+        else:
+            mgr = get_manager(device)
+            # managers which can't watch the device aren't worth keeping
+            if self.kept is not None and device.get("mirror", True) and mgr.watch():
+                self.kept[device["name"]] = mgr
+        self._managers[device["name"]] = mgr
+        return mgr
+
+    def _run_plan(
+        self, mgr: Manager, journal, plan: Plan, desired: packed.Networks, result: SyncResult
+    ):
+        """ Applies the plan, skipping what isn't needed anymore if the plan is resumed. """
+        result.added += self._apply(
+            mgr, journal, ADD, plan.to_add, plan.added, lambda x: x in desired
+        )
+        result.removed += self._apply(
+            mgr, journal, REMOVE, plan.to_remove, plan.removed, lambda x: x not in desired
+        )
+
+    def _apply(self, mgr: Manager, journal, op, networks, done: int, needed) -> int:
+        """
+        Applies operations starting from `done` by the batch protocol of the manager,
+        confirms them batch by batch.
+        """
+        batch = as_batch(mgr)
+        count = 0
+        for start in range(done, len(networks), self.batch_size):
+            end = min(start + self.batch_size, len(networks))
+            selected = packed.Networks()
+            for network in networks[start:end]:
+                if needed(network):
+                    selected.append(network)
+            if selected:
+                empty = packed.Networks()
+                adds, removes = (selected, empty) if op == ADD else (empty, selected)
+                count += sum(self._apply_batch(batch, adds, removes))
+            if journal:
+                journal.confirm(op, end)
+        return count
+
+    def _apply_batch(
+        self, batch: BatchManager, adds: packed.Networks, removes: packed.Networks
+    ) -> ty.Tuple[int, int]:
+        """ apply() of the batch protocol, called from the thread of the device. """
+        if isinstance(batch, ThreadedBatchManager):
+            return batch.apply_batch(adds, removes)
+        return asyncio.run_coroutine_threadsafe(batch.apply(adds, removes), self._loop).result()
+
+    def get_journal(self, device: str) -> ty.Optional[Journal]:
+        if self.journal_dir is None:
+            return None
+        return Journal(self.journal_dir / f"{device}.journal")
@@ -0,0 +1,118 @@
+"""
+Adaptive write-rate control for devices that are easy to overload.
+"""
+import logging
+import time
+import typing as ty
+
+log = logging.getLogger(__name__)
+
+
+class AIMDController:
+    """
+    Additive increase / multiplicative decrease controller
+    of the request rate and the number of requests in flight.
+
+    While commands are fast and the device CPU isn't busy,
+    window grows by one per window of successful commands and rate by `rate_step`.
+    Errors, timeouts, slow commands or high CPU load
+    cut both by `backoff`, at most once per window of commands.
+    """
+
+    def __init__(
+        self,
+        initial_rate: float = 50.0,
+        min_rate: float = 5.0,
+        max_rate: float = 1000.0,
+        rate_step: float = 10.0,
+        max_window: int = 32,
+        target_latency: float = 0.2,
+        max_cpu: int = 80,
+        backoff: float = 0.5,
+        log_interval: int = 1000,
+    ):
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_step = rate_step
+        self.window = 1.0
+        self.max_window = max_window
+        self.target_latency = target_latency
+        self.max_cpu = max_cpu
+        self.backoff = backoff
+        self.log_interval = log_interval
+        # statistics
+        self.latency: ty.Optional[float] = None
+        self.cpu: ty.Optional[int] = None
+        self.commands = 0
+        self.errors = 0
+        self.timeouts = 0
+        self._next_send = 0.0
+        self._last_decrease = 0
+
+    @classmethod
+    def fromconf(cls, cfg: ty.Optional[dict]) -> "AIMDController":
+        try:
+            return cls(**(cfg or {}))
+        except TypeError as exc:
+            raise ValueError(f"Invalid throttle settings: {exc}") from None
+
+    @property
+    def in_flight(self) -> int:
+        """ How many commands may be sent without waiting for responses. """
+        return max(int(self.window), 1)
+
+    def wait(self):
+        """ Sleeps until the next command may be sent. """
+        now = time.monotonic()
+        if self._next_send > now:
+            time.sleep(self._next_send - now)
+            now = self._next_send
+        self._next_send = now + 1 / self.rate
+
+    def observe(self, latency: float, error: bool = False, timeout: bool = False):
+        """ Takes the result of the command into account. """
+        self.commands += 1
+        # exponentially weighted moving average
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if timeout:
+            self.timeouts += 1
+            self.decrease("timeout")
+        elif error:
+            self.errors += 1
+            self.decrease("error")
+        elif self.latency > self.target_latency:
+            self.decrease("latency")
+        elif self.cpu is not None and self.cpu > self.max_cpu:
+            self.decrease("cpu")
+        else:
+            self.increase()
+        if self.commands % self.log_interval == 0:
+            log.info("Throttle state: %s", self)
+
+    def observe_cpu(self, load: int):
+        self.cpu = load
+        if load > self.max_cpu:
+            self.decrease("cpu")
+
+    def increase(self):
+        self.window = min(self.window + 1 / self.window, self.max_window)
+        self.rate = min(self.rate + self.rate_step / self.window, self.max_rate)
+
+    def decrease(self, reason: str):
+        # react once per window of commands, these are results of the same congestion
+        if self.commands - self._last_decrease < self.in_flight:
+            return
+        self._last_decrease = self.commands
+        self.window = max(self.window * self.backoff, 1.0)
+        self.rate = max(self.rate * self.backoff, self.min_rate)
+        log.info("Throttle backed off (%s): %s", reason, self)
+
+    def __str__(self):
+        latency = f"{self.latency * 1000:.0f}ms" if self.latency is not None else "-"
+        cpu = f"{self.cpu}%" if self.cpu is not None else "-"
+        return (
+            f"rate={self.rate:.1f}/s window={self.window:.1f} latency={latency}"
+            f" cpu={cpu} commands={self.commands} errors={self.errors}"
+            f" timeouts={self.timeouts}"
+        )
@@ -10,6 +10,22 @@ def chunked(iterable, size):
 
 T = ty.TypeVar("T")
 
+
+def dig(mapping, pth: str):
+    """
+    Returns value from nested mappings by combined key or None.
+
+    >>> dig({"test": {"key": 1}}, "test.key")
+    1
+    """
+    val = mapping
+    for key in pth.split("."):
+        if not hasattr(val, "get"):
+            return None
+        val = val.get(key)
+    return val
+
+
 class WindowIterator:
     """
     Iterator with extras attributes, such as
@@ -54,14 +70,23 @@ class WindowIterator:
 
 
 ipv4_regex = re.compile(r"([\d.]+)(/\d+)?")
+ipv6_regex = re.compile(r"([\da-fA-F:.]+)(/\d+)?")
 
 
 def with_netmask(address) -> str:
+    """
+    Returns network in `address/prefixlen` form, adding the full prefix
+    length if there is none. Networks are validated by packed.pack().
+
+    >>> with_netmask("1.2.3.4")
+    '1.2.3.4/32'
+    """
     if not isinstance(address, str):
         address = str(address)
-    match = ipv4_regex.match(address)
+    v6 = ":" in address
+    match = (ipv6_regex if v6 else ipv4_regex).match(address)
     if not match:
         raise ValueError(address)
     addr = match.group(1)
-    netmask = match.group(2) or "/32"
+    netmask = match.group(2) or ("/128" if v6 else "/32")
     return addr + netmask
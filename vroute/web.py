@@ -1,184 +1,298 @@
+"""
+HTTP API of the vroute daemon.
+
+Networks are streamed in both directions as NDJSON (one JSON value per line)
+or plain text (one network per line), so bodies of any size
+are never buffered as a whole.
+"""
 import asyncio
+import json
 import logging
 import typing as ty
 
-from sanic import Sanic as SanicBase
-from sanic.response import json
+from aiohttp import web
 
-# from .util import chunked, WindowIterator
-# from .models import Addresses
+from . import VRoute, packed
+from .lock import Coalescer
+from .routing import DEFAULT_SET, current_networks, get_manager
+from .services import DEFAULT_SOURCE, BaseNetworkingService
+from .sync import Syncer
 
 log = logging.getLogger(__name__)
 
+routes = web.RouteTableDef()
+
+NDJSON = "application/x-ndjson"
+# how many lines are buffered before writing them into the response
+WRITE_BATCH = 1000
+MAX_LIMIT = 1000000
+
+
+def get_service(request) -> BaseNetworkingService:
+    """ Every request uses its own connection. """
+    return request.app["vroute"].create_service()
+
+
+def get_limit(request) -> ty.Optional[int]:
+    limit = request.query.get("limit")
+    if limit is None:
+        return None
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise web.HTTPBadRequest(reason="limit must be integer") from None
+    if not 0 < limit <= MAX_LIMIT:
+        raise web.HTTPBadRequest(reason=f"limit must be between 1 and {MAX_LIMIT}")
+    return limit
+
+
+async def stream_ndjson(
+    request, items: ty.AsyncIterable[ty.Any], limit: ty.Optional[int] = None, key=None
+) -> web.StreamResponse:
+    """
+    Writes items as NDJSON. If `limit` is reached,
+    the last line is `{"next": <key of the last item>}` to continue from.
+    """
+    response = web.StreamResponse(headers={"Content-Type": NDJSON})
+    await response.prepare(request)
+    buf: ty.List[str] = []
+    count = 0
+    last = None
+    try:
+        async for item in items:
+            if limit is not None and count >= limit:
+                buf.append(json.dumps({"next": key(last) if key else last}))
+                break
+            buf.append(json.dumps(item))
+            last = item
+            count += 1
+            if len(buf) >= WRITE_BATCH:
+                await response.write(("\n".join(buf) + "\n").encode())
+                buf.clear()
+    finally:
+        # release the database connection if stopped early
+        if hasattr(items, "aclose"):
+            await items.aclose()
+    if buf:
+        await response.write(("\n".join(buf) + "\n").encode())
+    await response.write_eof()
+    return response
+
+
+async def read_networks(request) -> ty.AsyncIterator[str]:
+    """ Yields networks from NDJSON or plain text body as it arrives. """
+    ndjson = request.content_type == NDJSON
+    lineno = 0
+    async for line in request.content:
+        lineno += 1
+        line = line.decode().strip()
+        if not line:
+            continue
+        if ndjson:
+            try:
+                value = json.loads(line)
+            except ValueError:
+                raise web.HTTPBadRequest(reason=f"Invalid JSON on line {lineno}") from None
+            line = value.get("net") if isinstance(value, dict) else value
+            if not isinstance(line, str):
+                raise web.HTTPBadRequest(reason=f"No network on line {lineno}")
+        yield line
+
+
+@routes.get("/networks")
+async def show_networks(request):
+    """ Streams networks from the database, `after` and `limit` paginate. """
+    service = get_service(request)
+    return await stream_ndjson(
+        request, service.iter_networks(after=request.query.get("after")), get_limit(request)
+    )
+
+
+@routes.post("/networks")
+async def add_networks(request):
+    """
+    Loads networks from the body into the database.
+    With `source` and `replace=true` networks of the source are replaced,
+    `set` assigns the source to the route set.
+    """
+    exclude = set(request.app["vroute"].cfg.get("exclude") or ())
+    source = request.query.get("source", DEFAULT_SOURCE)
+    replace = request.query.get("replace") in ("1", "true")
+    route_set = request.query.get("set")
+    if replace and source == DEFAULT_SOURCE:
+        raise web.HTTPBadRequest(reason="replace requires source")
+    if route_set and source == DEFAULT_SOURCE:
+        raise web.HTTPBadRequest(reason="set requires source")
+
+    async def networks():
+        async for network in read_networks(request):
+            if network not in exclude:
+                yield network
+
+    service = get_service(request)
+    try:
+        if replace:
+            added, removed = await service.replace_networks(networks(), source, route_set)
+            return web.json_response({"added": added, "removed": removed})
+        count, exists = await service.load_networks(networks(), source, route_set)
+    except ValueError as exc:
+        raise web.HTTPBadRequest(reason=str(exc)) from None
+    return web.json_response({"count": count, "exists": exists})
+
+
+@routes.get("/devices")
+async def show_devices(request):
+    devices = request.app["vroute"].cfg.devices
+    return web.json_response([{"name": x["name"], "type": x["type"]} for x in devices])
+
+
+@routes.get("/devices/{name}/diff")
+async def show_diff(request):
+    """
+    Streams `{"op": "add"|"remove", "net": ...}` lines:
+    networks missing on the device and ones it has in excess.
+    `op` selects one kind, `after` and `limit` paginate it.
+    """
+    cfg = request.app["vroute"].cfg
+    name = request.match_info["name"]
+    devices = {x["name"]: x for x in cfg.devices}
+    if name not in devices:
+        raise web.HTTPNotFound(reason=f"No device {name!r}")
+    op = request.query.get("op")
+    if op not in (None, "add", "remove"):
+        raise web.HTTPBadRequest(reason="op must be add or remove")
+    after = request.query.get("after")
+    if after is not None and op is None:
+        raise web.HTTPBadRequest(reason="after requires op")
+    device = devices[name]
+    current = await asyncio.get_event_loop().run_in_executor(None, dump_device, device)
+    if not device.get("ipv6"):
+        current = current.only_v4()
+    service = get_service(request)
+    if await service.route_sets() != [DEFAULT_SET]:
+        try:
+            start = packed.pack(after) if after else -1
+        except ValueError as exc:
+            raise web.HTTPBadRequest(reason=str(exc)) from None
+        desired = (await service.fetch_sets()).get(device.get("set", DEFAULT_SET))
+        return await stream_ndjson(
+            request,
+            set_diff(desired or packed.Networks(), current, device, op, start),
+            get_limit(request),
+            key=lambda x: x["net"],
+        )
 
-class Sanic(SanicBase):
-    pass
-
-app = Sanic()
-
-@app.post("/sync")
+    async def diff():
+        if op in (None, "add"):
+            async for network in service.iter_networks(after=after if op else None):
+                if not device.get("ipv6") and ":" in network:
+                    continue
+                if packed.pack(network) not in current:
+                    yield {"op": "add", "net": network}
+        if op in (None, "remove"):
+            async for network in service.missing(current, after=after if op else None):
+                yield {"op": "remove", "net": network}
+
+    return await stream_ndjson(request, diff(), get_limit(request), key=lambda x: x["net"])
+
+
+async def set_diff(
+    desired: packed.Networks,
+    current: packed.Networks,
+    device: dict,
+    op: ty.Optional[str],
+    start: int,
+) -> ty.AsyncIterator[dict]:
+    """ Diff of the device with networks of its route set, keys after `start` only. """
+    if not device.get("ipv6"):
+        desired = desired.only_v4()
+    adds, removes = desired.diff(current)
+    for kind, networks in (("add", adds), ("remove", removes)):
+        if op in (None, kind):
+            for key in networks:
+                if key > start:
+                    yield {"op": kind, "net": packed.unpack(key)}
+
+
+def dump_device(device: dict) -> packed.Networks:
+    mgr = get_manager(device)
+    try:
+        return current_networks(mgr)
+    finally:
+        mgr.disconnect()
+
+
+@routes.post("/sync")
 async def sync(request):
-    app = request.app
-    exclude = app["cfg"].get("exclude")
-    async with app["lock"]:
-        return await _sync(session, exclude, app["netlink"], app["ros"])
-
-
-async def _sync(session, exclude, ipr, ros):
-    """ Synchronizes routing tables with database. """
-    # Fetch all hosts and their IP addresses
-    addresses = await Addresses.fromdb(session, ignorelist=exclude)
-    json: ty.Dict[str, ty.Any] = {}
-    result = ipr.sync(addresses)
-    json.update(result)
-    stats = ros.sync(addresses)
-    json["routeros"] = stats
-    return web.json_response(json)
-
+    """
+    Synchronizes all devices, returns statistics per device.
+    Requests arriving during synchronization wait for one follow-up run.
+    """
+    results = await request.app["syncer"]()
+    return web.json_response({x.device: x.asdict() for x in results})
+
+
+async def run_sync(app: VRoute, managers: ty.Optional[dict] = None):
+    """
+    Synchronizes all devices holding the lock shared with CLI.
+    Managers watching their devices are kept in `managers` between runs.
+    """
+    await app.lock.acquire_async()
+    try:
+        syncer = Syncer.fromconf(app.cfg, app.network_service, managers=managers)
+        return await syncer.run()
+    finally:
+        app.lock.release()
+
+
+async def background_sync(webapp):
+    interval = webapp["vroute"].cfg.sync_interval
+    while True:
+        try:
+            log.info("Executing background sync...")
+            for result in await webapp["syncer"]():
+                if not result.ok:
+                    log.error("Failed to synchronize %s: %s", result.device, result.error)
+        except asyncio.CancelledError:
+            return
+        except Exception:  # pylint:disable=broad-except
+            log.exception("Background sync error:")
+        try:
+            await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            return
 
 
-async def startup_tasks(app):
-    app["sync"] = app.loop.create_task(background_sync(app))
+async def startup_tasks(webapp):
+    webapp["sync"] = asyncio.ensure_future(background_sync(webapp))
 
 
-async def shutdown_tasks(app):
-    app["sync"].cancel()
-    await app["sync"]
+async def shutdown_tasks(webapp):
+    webapp["sync"].cancel()
+    await webapp["sync"]
+    await webapp["syncer"].close()
+    for mgr in webapp["managers"].values():
+        mgr.disconnect()
+    webapp["managers"].clear()
 
 
-async def background_sync(app):
-    while 1:
-        try:
-            log.info("Executing background sync...")
-            await _sync(
-                app["vroute"].new_session(),
-                app["cfg"].get("exclude"),
-                app["netlink"],
-                app["ros"],
-            )
-        except asyncio.CancelledError:
-            return
-        except:  # pylint:disable=bare-except
-            log.exception("Background sync error:")
-        await asyncio.sleep(600)
+async def close_service(webapp):
+    await webapp["vroute"].network_service.close()
 
 
-def get_webapp(app, coroutines=False):
+def get_webapp(app: VRoute, coroutines=False) -> web.Application:
     webapp = web.Application()
     webapp["vroute"] = app
-    webapp["cfg"] = app.cfg
-    webapp["netlink"] = app.netlink
-    webapp["ros"] = app.ros
-    webapp["lock"] = asyncio.Lock()
+    webapp["managers"] = {}
+    webapp["syncer"] = Coalescer(lambda: run_sync(app, webapp["managers"]))
     if coroutines:
         webapp.on_startup.append(startup_tasks)
         webapp.on_cleanup.append(shutdown_tasks)
+    webapp.on_cleanup.append(close_service)
     webapp.add_routes(routes)
     return webapp
 
 
-
-# @app.post("/")
-# async def add_host(request):
-#     """
-#     Adds new Host record and resolved addresses.
-#     If host already exists, renews addresses.
-#     """
-#     if not request.has_body:
-#         return web.json_response({"error": "Provide body"}, status=400)
-#     json = await request.json()
-#     host = json["host"]
-#     session = getsession(request)
-#     already_exists = True
-#     try:
-#         record = session.query(Host).filter(Host.name == host).one()
-#     except NoResultFound:
-#         already_exists = False
-#         record = Host(name=host, comment=json.get("comment"))
-#         session.add(record)
-#         session.commit()
-#     addrs = await record.aresolve()
-#     session.add_all(addrs)
-#     session.commit()
-#     return web.json_response(
-#         {"exists": already_exists, "addrs": [x.value for x in addrs]}
-#     )
-
-
-@routes.post("/routes")
-async def add_routes(request):
-    if not request.has_body:
-        return web.json_response({"error": "Provide body"}, status=400)
-    json = await request.json()
-    routes = json["routes"]
-    session = getsession(request)
-    exists: ty.Set[Address] = set()
-    for chunk in chunked(routes, 100):
-        addrs = (
-            session.query(Address.value)
-            .filter(Address.value.in_(chunk))
-            .filter(Address.host_id.is_(None))
-        )
-        exists.update(addrs)
-
-    response = {"exists": len(exists), "count": len(routes) - len(exists)}
-    for item in filter(lambda x: x not in exists, routes):
-        # noinspection PyArgumentList
-        addr = Address(value=item)
-        session.add(addr)
-    session.commit()
-    return web.json_response(response)
-
-
-@routes.get("/")
-async def show(request):
-    """ Shows hosts with their addresses. """
-    session = getsession(request)
-    gen = WindowIterator(session.query(Host))
-    if not gen.has_any:
-        return web.Response(status=204)
-    output = {}
-    for host in gen:
-        addrs = session.query(Address).filter(Address.host_id == host.id)
-        output[host.name] = {
-            "comment": host.comment,
-            "addrs": [addr.value for addr in addrs],
-        }
-    return web.json_response(output)
-
-
-@routes.post("/rm")
-async def remove(request):
-    """ Removes host from the database. """
-    json = await request.json()
-    host = json["host"]
-    session = getsession(request)
-    host = session.query(Host).filter(Host.name == host).one()
-    if host is None:
-        return web.json_response({"error": "Host not found."}, status=404)
-    log.info("Removing host %s", host.id)
-    # TODO figure out why CASCADE doesn't work
-    host.get_addresses(session).delete()
-    session.delete(host)
-    session.commit()
-    return web.Response(status=204)
-
-
-@routes.post("/purge")
-async def purge(request):
-    async with request.app["lock"]:
-        return await _purge(request)
-
-
-async def _purge(request):
-    """ Removes routes that aren't present in the database. """
-    session = getsession(request)
-    addresses = await Addresses.fromdb(session)
-    netlink, ros = request.app["netlink"], request.app["ros"]
-    netlink.update()
-    count = netlink.remove_outdated(keep=addresses)
-    ros.update()
-    ros_count = ros.remove_outdated(keep=addresses)
-    return web.json_response({"removed": count, "removed_ros": ros_count})
-
-
+def run(app: VRoute):
+    webapp = get_webapp(app, coroutines=bool(app.cfg.sync_interval))
+    web.run_app(webapp, host="localhost", port=int(app.cfg.listen_port))